@@ -0,0 +1,86 @@
+"""
+Benchmark for rendering notification emails.
+
+Renders host request emails for a batch of generated notifications, comparing reading and compiling the templates with
+the unsubscribe section pasted in for every email (how _send_email_notification used to do it) against rendering the
+cached compiled templates with render_email. Doesn't need the database, but does need the usual config in the
+environment, run from app/backend/src with:
+
+    python -m benchmarks.notification_emails
+"""
+
+from datetime import date, datetime, timedelta, timezone
+from time import perf_counter
+from types import SimpleNamespace
+
+from couchers.templates.v2 import env, render_email, template_folder
+
+NOTIFICATIONS = 10_000
+TEMPLATE_NAMES = ["host_request__message", "host_request__plain"]
+
+
+def unsub_sections(i):
+    ta_link = f"https://couchers.org/unsubscribe?payload={i:08x}&sig=ta"
+    dne_link = f"https://couchers.org/unsubscribe?payload={i:08x}&sig=dne"
+    plain = (
+        "\n\n---\n\nEdit your notification settings at <https://couchers.org/account-settings/notifications>"
+        f"\n\nTurn off emails for messages in host request: <{ta_link}>"
+        f"\n\nDo not email me (disables hosting): <{dne_link}>"
+    )
+    html = (
+        '<a href="https://couchers.org/account-settings/notifications">Manage notification preferences</a>.'
+        f'<br />Turn off emails for: <a href="{ta_link}">messages in host request</a>.'
+        f'<br /><a href="{dne_link}">Do not email me (disables hosting)</a>.'
+    )
+    return plain, html
+
+
+def notification_emails():
+    """
+    (template name, template args, plain unsubscribe section, html unsubscribe section) for each notification
+    """
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for i in range(NOTIFICATIONS):
+        user = SimpleNamespace(name=f"User {i}", timezone="Europe/Helsinki", avatar_thumbnail_url=None)
+        other = SimpleNamespace(name=f"Surfer {i}", age=20 + i % 50, city="Melbourne", avatar_thumbnail_url=None)
+        template_args = {
+            "user": user,
+            "time": start + timedelta(minutes=i),
+            "view_link": f"https://couchers.org/messages/request/{i}",
+            "host_request": SimpleNamespace(from_date=date(2025, 2, 1), to_date=date(2025, 2, 1 + i % 20)),
+            "message": f"{other.name} sent you a host request",
+            "other": other,
+            "text": f"Hi!\nI'd love to stay with you, this is message {i}.",
+            "_year": 2025,
+            "_timezone_display": "Eastern European Time",
+        }
+        yield TEMPLATE_NAMES[i % len(TEMPLATE_NAMES)], template_args, *unsub_sections(i)
+
+
+def render_uncached(template_name, template_args, plain_unsub_section, html_unsub_section):
+    plain_tmplt = (template_folder / f"{template_name}.txt").read_text()
+    plain = env.from_string(plain_tmplt + plain_unsub_section).render(template_args)
+    html_tmplt = (template_folder / "generated_html" / f"{template_name}.html").read_text()
+    html = env.from_string(html_tmplt.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    return plain, html
+
+
+def timed(f):
+    start = perf_counter()
+    out = f()
+    return out, (perf_counter() - start) * 1000
+
+
+def main():
+    emails = list(notification_emails())
+
+    expected, uncached_ms = timed(lambda: [render_uncached(*email) for email in emails])
+    got, cached_ms = timed(lambda: [render_email(*email) for email in emails])
+    assert expected == got
+
+    print(f"{'emails':>8} {'uncached ms':>12} {'cached ms':>10} {'per email us':>13}")
+    print(f"{len(emails):>8} {uncached_ms:>12.2f} {cached_ms:>10.2f} {cached_ms * 1000 / len(emails):>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Micro-benchmark for stripping sensitive fields from api call logs.
+
+Compares the old approach (deepcopy every message and walk all of its fields checking options) against the cached
+sanitizer plans in couchers.api_call_log, on a few real API messages. Doesn't need a database, run from app/backend/src
+with:
+
+    python -m benchmarks.sanitizer
+"""
+
+import importlib
+import pkgutil
+from copy import deepcopy
+from timeit import timeit
+
+from google.protobuf import timestamp_pb2
+
+import proto
+from couchers.api_call_log import _sanitizer_plan, sanitized_bytes
+from proto import account_pb2, annotations_pb2, api_pb2, auth_pb2, search_pb2
+
+ITERATIONS = 2_000
+
+
+def legacy_sanitized_bytes(message):
+    new_proto = deepcopy(message)
+
+    def _sanitize_message(message):
+        for name, descriptor in message.DESCRIPTOR.fields_by_name.items():
+            if descriptor.GetOptions().Extensions[annotations_pb2.sensitive]:
+                message.ClearField(name)
+            if descriptor.message_type:
+                submessage = getattr(message, name)
+                if not submessage:
+                    continue
+                if descriptor.label == descriptor.LABEL_REPEATED:
+                    for msg in submessage:
+                        _sanitize_message(msg)
+                else:
+                    _sanitize_message(submessage)
+
+    _sanitize_message(new_proto)
+
+    return new_proto.SerializeToString()
+
+
+def make_user(i):
+    return api_pb2.User(
+        user_id=i,
+        username=f"user{i}",
+        name=f"User {i}",
+        city="Melbourne, Australia",
+        hometown="Hobart",
+        timezone="Australia/Melbourne",
+        lat=-37.8,
+        lng=144.9,
+        radius=500,
+        num_references=i % 20,
+        gender="Woman",
+        age=30,
+        joined=timestamp_pb2.Timestamp(seconds=1_600_000_000),
+        last_active=timestamp_pb2.Timestamp(seconds=1_700_000_000),
+        occupation="Baker",
+        about_me="Hello! " * 100,
+        things_i_like="Bread, cheese and long walks. " * 10,
+        regions_visited=["AUS", "NZL", "FJI"],
+    )
+
+
+CASES = {
+    "empty": api_pb2.PingReq(),
+    "User": make_user(1),
+    "UserSearchRes (50 users)": search_pb2.UserSearchRes(
+        results=[search_pb2.Result(rank=1.0, user=make_user(i)) for i in range(50)]
+    ),
+    "SignupFlowReq (sensitive)": auth_pb2.SignupFlowReq(
+        flow_token="token", account=auth_pb2.SignupAccount(username="user", password="secret", city="Melbourne")
+    ),
+    "ChangePasswordV2Req (sensitive)": account_pb2.ChangePasswordV2Req(old_password="old", new_password="new"),
+}
+
+
+def main():
+    message_types = [
+        message_type
+        for module_info in pkgutil.iter_modules(proto.__path__)
+        if module_info.name.endswith("_pb2")
+        for message_type in importlib.import_module(
+            f"proto.{module_info.name}"
+        ).DESCRIPTOR.message_types_by_name.values()
+    ]
+    with_plan = sum(1 for message_type in message_types if _sanitizer_plan(message_type))
+    print(f"{with_plan} of {len(message_types)} top level API message types have anything to sanitize")
+    print()
+
+    print(f"{'message':<35} {'bytes':>8} {'legacy µs':>10} {'plan µs':>10} {'speedup':>8}")
+    for name, message in CASES.items():
+        # the request thread serializes anyway, the writer thread then sanitizes from the bytes
+        raw = message.SerializeToString()
+        message_type = type(message)
+        assert legacy_sanitized_bytes(message) == sanitized_bytes(message_type, raw)
+        legacy = timeit(lambda message=message: legacy_sanitized_bytes(message), number=ITERATIONS) / ITERATIONS * 1e6
+        planned = timeit(lambda t=message_type, raw=raw: sanitized_bytes(t, raw), number=ITERATIONS) / ITERATIONS * 1e6
+        print(f"{name:<35} {len(raw):>8} {legacy:>10.2f} {planned:>10.2f} {legacy / planned:>7.1f}x")
+        print(f"{'':<35} plan: {_sanitizer_plan(message_type.DESCRIPTOR)}")
+
+
+if __name__ == "__main__":
+    main()
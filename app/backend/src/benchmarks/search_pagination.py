@@ -0,0 +1,108 @@
+"""
+Benchmark for paginating deep into search results.
+
+Fills a temporary table shaped like the bits of users that UserSearch sorts and filters on, then compares fetching a
+page with LIMIT/OFFSET against seeking to it with a (recommendation_score, id) cursor at increasing depths, and an exact
+count(*) against couchers.sql.approximate_count. Needs the database from DATABASE_CONNECTION_STRING, run from
+app/backend/src with:
+
+    python -m benchmarks.search_pagination
+"""
+
+from time import perf_counter
+
+from sqlalchemy import BigInteger, Boolean, Column, Float, Index, MetaData, Table, func, text, tuple_
+
+from couchers.db import session_scope
+from couchers.sql import approximate_count
+from couchers.sql import couchers_select as select
+
+ROWS = 1_000_000
+PAGE_SIZE = 25
+DEPTHS = [0, 1_000, 10_000, 100_000, 500_000]
+
+metadata = MetaData()
+fake_users = Table(
+    "benchmark_search_users",
+    metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("recommendation_score", Float, nullable=False),
+    Column("is_banned", Boolean, nullable=False),
+    Column("is_deleted", Boolean, nullable=False),
+    Index(
+        "ix_benchmark_search_users_score_id",
+        "recommendation_score",
+        "id",
+        postgresql_where=text("NOT is_banned AND NOT is_deleted"),
+    ),
+    prefixes=["TEMPORARY"],
+)
+
+
+def timed(f):
+    start = perf_counter()
+    out = f()
+    return out, (perf_counter() - start) * 1000
+
+
+def main():
+    with session_scope() as session:
+        conn = session.connection()
+        metadata.create_all(conn)
+        conn.execute(
+            text(
+                f"""
+                INSERT INTO benchmark_search_users (id, recommendation_score, is_banned, is_deleted)
+                SELECT i, floor(random() * 1000), random() < 0.01, random() < 0.02
+                FROM generate_series(1, {ROWS}) AS i
+                """
+            )
+        )
+        conn.execute(text("ANALYZE benchmark_search_users"))
+
+        statement = select(fake_users.c.id).where(~fake_users.c.is_banned).where(~fake_users.c.is_deleted)
+        ordered = statement.order_by(fake_users.c.recommendation_score.desc(), fake_users.c.id.desc())
+
+        print(f"{'depth':>8} {'offset ms':>10} {'keyset ms':>10}")
+        for depth in DEPTHS:
+            # find the cursor of the row just before the page first, this is what the previous page's token holds
+            cursor = None
+            if depth:
+                cursor = session.execute(
+                    select(fake_users.c.recommendation_score, fake_users.c.id)
+                    .where(~fake_users.c.is_banned)
+                    .where(~fake_users.c.is_deleted)
+                    .order_by(fake_users.c.recommendation_score.desc(), fake_users.c.id.desc())
+                    .offset(depth - 1)
+                    .limit(1)
+                ).one()
+
+            offset_page, offset_ms = timed(
+                lambda depth=depth: session.execute(ordered.offset(depth).limit(PAGE_SIZE)).scalars().all()
+            )
+            keyset = ordered
+            if cursor:
+                keyset = keyset.where(
+                    tuple_(fake_users.c.recommendation_score, fake_users.c.id)
+                    < tuple_(cursor.recommendation_score, cursor.id)
+                )
+            keyset_page, keyset_ms = timed(
+                lambda keyset=keyset: session.execute(keyset.limit(PAGE_SIZE)).scalars().all()
+            )
+            assert offset_page == keyset_page
+            print(f"{depth:>8} {offset_ms:>10.2f} {keyset_ms:>10.2f}")
+        print()
+
+        exact, exact_ms = timed(
+            lambda: session.execute(select(func.count()).select_from(statement.subquery())).scalar_one()
+        )
+        approximate, approximate_ms = timed(lambda: approximate_count(session, statement))
+        _, cached_ms = timed(lambda: approximate_count(session, statement))
+        print(f"count(*):           {exact:>10} in {exact_ms:.2f} ms")
+        print(f"approximate_count:  {approximate:>10} in {approximate_ms:.2f} ms ({cached_ms:.3f} ms cached)")
+
+        session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark for sending emails over SMTP.
+
+Starts a local stand-in SMTP server that waits HANDSHAKE_DELAY_MS when a connection is opened (roughly what STARTTLS and
+LOGIN cost against a real server), then sends a batch of emails with inline images, comparing opening a new connection
+and re-reading the attachment images for every email (how send_smtp_email used to do it) against send_smtp_emails with
+the connection pool and cached images. Doesn't need the database, but does need the usual config in the environment,
+run from app/backend/src with:
+
+    python -m benchmarks.smtp_sender
+"""
+
+import smtplib
+import socketserver
+from threading import Thread
+from time import perf_counter, sleep
+
+from couchers.config import config
+from couchers.email import smtp
+from couchers.email.smtp import send_smtp_emails, smtp_pool
+
+EMAILS = 500
+HANDSHAKE_DELAY_MS = 20
+
+HTML = (
+    '<img src="attachment_imgs/logo-with-couchers.org-small.png" /><p>Hi!</p>'
+    '<img src="attachment_imgs/logo-grey.png" />'
+)
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of SMTP for smtplib to send mail, throwing the mail away
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sleep(HANDSHAKE_DELAY_MS / 1000)
+        self.reply("220 localhost stand-in")
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b".\r\n":
+                    in_data = False
+                    self.reply("250 OK")
+                continue
+            command = line.decode().strip().split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.reply("250 localhost")
+            elif command == "DATA":
+                in_data = True
+                self.reply("354 go ahead")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+def emails():
+    return [
+        dict(
+            sender_name="Couchers.org",
+            sender_email="notify@couchers.org.invalid",
+            recipient=f"user{i}@couchers.org.invalid",
+            subject=f"Benchmark email {i}",
+            plain=f"Hi!\n\nThis is benchmark email {i}.",
+            html=HTML,
+            list_unsubscribe_header=None,
+            source_data=None,
+        )
+        for i in range(EMAILS)
+    ]
+
+
+def send_unpooled(email_args):
+    """
+    A new connection and freshly read attachment images for every email
+    """
+    for args in email_args:
+        smtp._attachment_imgs.cache_clear()
+        msg, _ = smtp._make_email(**args)
+        with smtplib.SMTP(config["SMTP_HOST"], config["SMTP_PORT"]) as server:
+            server.ehlo()
+            server.sendmail(args["sender_email"], args["recipient"], msg.as_string())
+
+
+def timed(f):
+    start = perf_counter()
+    out = f()
+    return out, (perf_counter() - start) * 1000
+
+
+def main():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    # the stand-in doesn't do STARTTLS or LOGIN, the handshake delay stands in for them
+    config["DEV"] = True
+    config["SMTP_HOST"], config["SMTP_PORT"] = server.server_address
+
+    email_args = emails()
+    _, unpooled_ms = timed(lambda: send_unpooled(email_args))
+    results, pooled_ms = timed(lambda: send_smtp_emails(email_args))
+    assert not [result for result in results if isinstance(result, Exception)]
+    smtp_pool.close()
+    server.shutdown()
+
+    print(f"{'emails':>8} {'unpooled ms':>12} {'pooled ms':>10} {'per email ms':>13}")
+    print(f"{len(email_args):>8} {unpooled_ms:>12.2f} {pooled_ms:>10.2f} {pooled_ms / len(email_args):>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
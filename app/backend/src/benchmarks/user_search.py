@@ -0,0 +1,130 @@
+"""
+Benchmark for substring queries in user search.
+
+Fills a temporary table with generated users' free text fields, then compares ORing an ILIKE per field (which can only
+sequentially scan) against narrowing down on the trigram indexed search document first and rechecking the fields, like
+UserSearch does. Needs the database from DATABASE_CONNECTION_STRING, run from app/backend/src with:
+
+    python -m benchmarks.user_search
+"""
+
+from time import perf_counter
+
+from sqlalchemy import text
+
+from couchers.db import session_scope
+
+ROWS = 200_000
+QUERIES = ["kahlo", "melbourne", "sourdough", "ing", "zzqx", "Mexico City"]
+
+FIELDS = ["name", "username", "city", "hometown", "about_me", "things_i_like", "about_place", "additional_information"]
+
+SEARCH_DOCUMENT = " || ' ' || ".join(f"coalesce({field}, '')" for field in FIELDS)
+
+WORDS = [
+    "hiking",
+    "cooking",
+    "sourdough",
+    "travelling",
+    "guitar",
+    "climbing",
+    "photography",
+    "cycling",
+    "languages",
+    "board games",
+    "gardening",
+    "painting",
+    "Melbourne",
+    "Berlin",
+    "Mexico",
+    "City",
+    "Kahlo",
+    "coffee",
+    "books",
+    "cats",
+]
+
+
+def random_text(words):
+    """
+    SQL for a random sentence of the given number of words from WORDS, for each row of generate_series(...) AS i
+    """
+    array = "ARRAY[" + ", ".join(f"'{word}'" for word in WORDS) + "]"
+    # referencing i makes the subquery correlated, otherwise postgres evaluates it once and every row gets the same text
+    word = f"({array})[1 + floor(random() * {len(WORDS)})::int + 0 * i]"
+    return f"(SELECT string_agg({word}, ' ') FROM generate_series(1, {words}))"
+
+
+def timed(f):
+    start = perf_counter()
+    out = f()
+    return out, (perf_counter() - start) * 1000
+
+
+def main():
+    with session_scope() as session:
+        conn = session.connection()
+        conn.execute(
+            text(
+                f"""
+                CREATE TEMPORARY TABLE benchmark_user_search (
+                    id bigint PRIMARY KEY,
+                    name varchar NOT NULL,
+                    username varchar NOT NULL,
+                    city varchar NOT NULL,
+                    hometown varchar,
+                    about_me varchar,
+                    things_i_like varchar,
+                    about_place varchar,
+                    additional_information varchar,
+                    search_document varchar GENERATED ALWAYS AS ({SEARCH_DOCUMENT}) STORED NOT NULL
+                )
+                """
+            )
+        )
+        conn.execute(
+            text(
+                f"""
+                INSERT INTO benchmark_user_search
+                    (id, name, username, city, hometown, about_me, things_i_like, about_place, additional_information)
+                SELECT
+                    i,
+                    'User ' || md5(i::text),
+                    'user_' || i,
+                    {random_text(1)},
+                    {random_text(1)},
+                    {random_text(60)},
+                    {random_text(15)},
+                    {random_text(30)},
+                    CASE WHEN random() < 0.5 THEN {random_text(20)} END
+                FROM generate_series(1, {ROWS}) AS i
+                """
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE INDEX ix_benchmark_user_search_document_trgm "
+                "ON benchmark_user_search USING gin (search_document gin_trgm_ops)"
+            )
+        )
+        conn.execute(text("ANALYZE benchmark_user_search"))
+
+        fields_match = " OR ".join(f"{field} ILIKE :pattern" for field in FIELDS)
+        ilike_fan_out = text(f"SELECT id FROM benchmark_user_search WHERE {fields_match} ORDER BY id")
+        search_document = text(
+            f"SELECT id FROM benchmark_user_search WHERE search_document ILIKE :pattern AND ({fields_match}) ORDER BY id"
+        )
+
+        print(f"{'query':<15} {'matches':>8} {'ilike ms':>10} {'trigram ms':>11}")
+        for query in QUERIES:
+            params = {"pattern": f"%{query}%"}
+            expected, fan_out_ms = timed(lambda params=params: conn.execute(ilike_fan_out, params).scalars().all())
+            got, document_ms = timed(lambda params=params: conn.execute(search_document, params).scalars().all())
+            assert expected == got
+            print(f"{query:<15} {len(got):>8} {fan_out_ms:>10.2f} {document_ms:>11.2f}")
+
+        session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark for sending web push notifications.
+
+Starts a local stand-in push service that accepts everything, then sends a batch of pushes to it, comparing parsing the
+VAPID key, signing a new VAPID header and making a new connection for every push (how send_push used to do it) against
+send_pushes with cached VAPID headers, kept alive per-origin sessions and concurrent sending. Doesn't need the database,
+run from app/backend/src with:
+
+    python -m benchmarks.web_push
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter, time
+
+import http_ece
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+
+from couchers.notifications.push_api import _origin, gen_vapid_keys, send_pushes
+
+PUSHES = 1000
+VAPID_SUB = "mailto:benchmark@couchers.org.invalid"
+
+
+class StandInPushServiceHandler(BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def pushes(endpoint_base, vapid_private_key):
+    receiver_key = (
+        ec.generate_private_key(ec.SECP256R1())
+        .public_key()
+        .public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    )
+    return [
+        dict(
+            data=f'{{"title": "Benchmark push {i}", "body": "Hi!"}}'.encode(),
+            endpoint=f"{endpoint_base}/push/{i}",
+            auth_key=b"0123456789abcdef",
+            receiver_key=receiver_key,
+            vapid_sub=VAPID_SUB,
+            vapid_private_key=vapid_private_key,
+            ttl=3600,
+        )
+        for i in range(PUSHES)
+    ]
+
+
+def send_uncached(push_args):
+    """
+    A freshly parsed key, newly signed header and new connection for every push
+    """
+    for args in push_args:
+        vapid_claim = {"sub": args["vapid_sub"], "aud": _origin(args["endpoint"]), "exp": int(time()) + 12 * 60 * 60}
+        headers = {
+            "authorization": Vapid.from_string(private_key=args["vapid_private_key"]).sign(vapid_claim)[
+                "Authorization"
+            ],
+            "content-encoding": "aes128gcm",
+            "ttl": str(args["ttl"]),
+        }
+        encrypted = http_ece.encrypt(
+            args["data"],
+            private_key=ec.generate_private_key(ec.SECP256R1()),
+            auth_secret=args["auth_key"],
+            dh=args["receiver_key"],
+        )
+        assert requests.post(args["endpoint"], timeout=20, data=encrypted, headers=headers).status_code == 201
+
+
+def timed(f):
+    start = perf_counter()
+    out = f()
+    return out, (perf_counter() - start) * 1000
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInPushServiceHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    vapid_private_key, _ = gen_vapid_keys()
+    push_args = pushes(f"http://127.0.0.1:{server.server_address[1]}", vapid_private_key)
+
+    _, uncached_ms = timed(lambda: send_uncached(push_args))
+    results, batched_ms = timed(lambda: send_pushes(push_args))
+    assert all(not isinstance(result, Exception) and result.status_code == 201 for result in results)
+    server.shutdown()
+
+    print(f"{'pushes':>8} {'uncached ms':>12} {'batched ms':>11} {'per push ms':>12}")
+    print(f"{len(push_args):>8} {uncached_ms:>12.2f} {batched_ms:>11.2f} {batched_ms / len(push_args):>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Keeps session bookkeeping off the critical path of authenticated calls.
+
+Session lookups and the viewer independent parts of user profiles are cached in-process for a few seconds, and the api
+call counts and last seen times for users, sessions and user activity are aggregated in memory and written out in
+batches by a background thread.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from itertools import chain
+from time import sleep
+
+from sqlalchemy import BigInteger, DateTime, Integer, String, event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import column, func, values
+
+from couchers.cache import TTLCache, invalidate_on_commit, pending_invalidations
+from couchers.constants import (
+    ACTIVITY_FLUSH_INTERVAL,
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+    USER_PROFILE_CACHE_SIZE,
+    USER_PROFILE_CACHE_TTL,
+)
+from couchers.db import session_scope
+from couchers.models import (
+    LanguageAbility,
+    User,
+    UserActivity,
+    UserSession,
+)
+from couchers.utils import now
+
+logger = logging.getLogger(__name__)
+
+
+class _SessionTokenCache(TTLCache):
+    """
+    token -> (is_api_key, auth_info), with an index of each user's tokens so they can be dropped without going over
+    every cached session
+    """
+
+    def __init__(self, ttl, max_size):
+        super().__init__(ttl, max_size)
+        # user_id -> set of tokens
+        self._tokens_by_user = {}
+
+    def _added(self, token, entry):
+        self._tokens_by_user.setdefault(entry[1][0], set()).add(token)
+
+    def _dropped(self, token, entry):
+        user_id = entry[1][0]
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                for token in self._tokens_by_user.pop(user_id, ()):
+                    self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries = OrderedDict()
+            self._tokens_by_user = {}
+
+
+class SessionCache:
+    """
+    Caches the auth info tuple for session tokens for a short while.
+
+    Entries for a user are dropped as soon as a transaction in this process that touched that user (or anything of
+    theirs with a user_id, like their sessions or activeness probes) commits, so revocations in this process are seen
+    immediately. Revocations from other processes are picked up once the TTL runs out.
+    """
+
+    def __init__(self, ttl, max_size, bulk_models):
+        # bulk UPDATE/DELETE statements on these clear the cache, since they don't tell us which users they touched
+        self.bulk_models = bulk_models
+        self._cache = _SessionTokenCache(ttl, max_size)
+
+    @property
+    def generation(self):
+        return self._cache.generation
+
+    def get(self, token, is_api_key):
+        entry = self._cache.get(token)
+        if not entry:
+            return None
+        entry_is_api_key, auth_info = entry
+        _, _, _, token_expiry, _ = auth_info
+        if entry_is_api_key != is_api_key or token_expiry <= now():
+            return None
+        return auth_info
+
+    def put(self, token, is_api_key, auth_info, generation):
+        self._cache.put(token, (is_api_key, auth_info), generation)
+
+    def invalidate(self, user_ids):
+        self._cache.invalidate_users(user_ids)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class UserProfileCache:
+    """
+    Caches the viewer independent profile part of api_pb2.User messages by user id for a short while.
+
+    Invalidated the same way as the session cache, so profile updates in this process are seen immediately and ones
+    from other processes once the TTL runs out.
+    """
+
+    def __init__(self, ttl, max_size, bulk_models):
+        # bulk UPDATE/DELETE statements on these clear the cache, since they don't tell us which users they touched.
+        # Ones that only touch one user's rows should instead invalidate_on_commit that user.
+        self.bulk_models = bulk_models
+        # user_id -> profile
+        self._cache = TTLCache(ttl, max_size)
+
+    @property
+    def generation(self):
+        return self._cache.generation
+
+    def get_many(self, session, user_ids):
+        """
+        Returns a dict of user_id -> profile for the users that are cached. Users with changes pending or flushed in
+        the given session are never returned, since the cache can't know about those yet.
+        """
+        touched = users_touched_by(session, self)
+        return self._cache.get_many(user_id for user_id in user_ids if user_id not in touched)
+
+    def put_many(self, session, profiles, generation):
+        touched = users_touched_by(session, self)
+        self._cache.put_many(
+            {user_id: profile for user_id, profile in profiles.items() if user_id not in touched}, generation
+        )
+
+    def invalidate(self, user_ids):
+        self._cache.invalidate(user_ids)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class ActivityBuffer:
+    """
+    Aggregates api call counts and last seen times per (user, session, hour, ip address, user agent), and writes them
+    out with one statement per table every ACTIVITY_FLUSH_INTERVAL.
+    """
+
+    # flush inline if we somehow pile up this many distinct keys between flushes
+    MAX_PENDING = 10_000
+
+    def __init__(self, flush_interval):
+        self._flush_interval = flush_interval.total_seconds()
+        self._lock = threading.Lock()
+        # (user_id, token, period, ip_address, user_agent) -> [api_calls, last_seen]
+        self._pending = {}
+        self._thread = None
+
+    def record(self, user_id, token, ip_address, user_agent):
+        t = now()
+        # same binning as date_bin('1 hour', ..., '2000-01-01') in UTC
+        period = t.replace(minute=0, second=0, microsecond=0)
+        with self._lock:
+            entry = self._pending.setdefault((user_id, token, period, ip_address, user_agent), [0, t])
+            entry[0] += 1
+            entry[1] = t
+            overflowing = len(self._pending) >= self.MAX_PENDING
+        if overflowing:
+            self.flush()
+
+    def clear(self):
+        """
+        Drops anything pending without writing it out
+        """
+        with self._lock:
+            self._pending = {}
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        users = {}
+        sessions = {}
+        activity = {}
+        for (user_id, token, period, ip_address, user_agent), (api_calls, last_seen) in pending.items():
+            users[user_id] = max(users.get(user_id, last_seen), last_seen)
+            session_calls, session_last_seen = sessions.get(token, (0, last_seen))
+            sessions[token] = (session_calls + api_calls, max(session_last_seen, last_seen))
+            activity_key = (user_id, period, ip_address, user_agent)
+            activity[activity_key] = activity.get(activity_key, 0) + api_calls
+
+        with session_scope() as session:
+            # these go through the connection rather than the ORM session, so they don't count as changes that need to
+            # invalidate the session cache. rows are sorted so that concurrent flushes lock them in the same order
+            conn = session.connection()
+
+            user_values = values(
+                column("user_id", BigInteger), column("last_seen", DateTime(timezone=True)), name="user_values"
+            ).data(sorted(users.items()))
+            conn.execute(
+                User.__table__.update()
+                .where(User.id == user_values.c.user_id)
+                # only touch users.last_active if it's been a while
+                .where(User.last_active < user_values.c.last_seen - timedelta(minutes=5))
+                .values(last_active=user_values.c.last_seen)
+            )
+
+            session_values = values(
+                column("token", String),
+                column("api_calls", Integer),
+                column("last_seen", DateTime(timezone=True)),
+                name="session_values",
+            ).data(sorted((token, api_calls, last_seen) for token, (api_calls, last_seen) in sessions.items()))
+            conn.execute(
+                UserSession.__table__.update()
+                .where(UserSession.token == session_values.c.token)
+                .values(
+                    api_calls=UserSession.api_calls + session_values.c.api_calls,
+                    last_seen=func.greatest(UserSession.last_seen, session_values.c.last_seen),
+                )
+            )
+
+            activity_insert = insert(UserActivity).values(
+                [
+                    {
+                        "user_id": user_id,
+                        "period": period,
+                        "ip_address": ip_address,
+                        "user_agent": user_agent,
+                        "api_calls": api_calls,
+                    }
+                    for (user_id, period, ip_address, user_agent), api_calls in sorted(
+                        activity.items(), key=lambda item: (item[0][0], item[0][1], str(item[0][2]), str(item[0][3]))
+                    )
+                ]
+            )
+            conn.execute(
+                activity_insert.on_conflict_do_update(
+                    index_elements=[
+                        UserActivity.user_id,
+                        UserActivity.period,
+                        UserActivity.ip_address,
+                        UserActivity.user_agent,
+                    ],
+                    set_={"api_calls": UserActivity.api_calls + activity_insert.excluded.api_calls},
+                )
+            )
+
+        logger.debug(f"Flushed activity for {len(users)} users and {len(sessions)} sessions")
+
+    def _run(self):
+        while True:
+            sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Failed to flush activity buffer", exc_info=e)
+
+    def start(self):
+        """
+        Starts the background flusher thread
+        """
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name="activity-flusher", daemon=True)
+            self._thread.start()
+
+
+session_cache = SessionCache(SESSION_CACHE_TTL, SESSION_CACHE_SIZE, bulk_models={User, UserSession})
+user_profile_cache = UserProfileCache(
+    USER_PROFILE_CACHE_TTL, USER_PROFILE_CACHE_SIZE, bulk_models={User, LanguageAbility}
+)
+activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL)
+
+# caches that are invalidated on commit for the users touched by the transaction
+_USER_CACHES = [session_cache, user_profile_cache]
+
+
+def _user_ids_of(objs):
+    user_ids = set()
+    for obj in objs:
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+        elif user_id := getattr(obj, "user_id", None):
+            user_ids.add(user_id)
+    return user_ids
+
+
+def users_touched_by(session, cache):
+    """
+    Ids of users that have uncommitted changes (flushed or not) in the given session that the given user cache doesn't
+    know about yet, or EVERYTHING
+    """
+    return pending_invalidations(session, cache) | _user_ids_of(chain(session.new, session.dirty, session.deleted))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_cache_invalidations(session, flush_context):
+    user_ids = _user_ids_of(chain(session.new, session.dirty, session.deleted))
+    if user_ids:
+        for cache in _USER_CACHES:
+            invalidate_on_commit(session, cache, user_ids)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_user_cache_invalidations(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper:
+            for cache in _USER_CACHES:
+                if mapper.class_ in cache.bulk_models:
+                    invalidate_on_commit(orm_execute_state.session, cache)
@@ -0,0 +1,250 @@
+"""
+Writes api call logs to logging.api_calls off the request thread.
+
+The request thread only serializes the request and response and puts a record onto a bounded queue. A background
+thread strips sensitive fields and writes the records out with one multi-row insert per batch. If the queue is full,
+records are dropped rather than slowing down calls, and counted in couchers_api_call_logs_dropped_total.
+"""
+
+import functools
+import logging
+import queue
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from time import sleep
+
+from sqlalchemy import insert
+
+from couchers.constants import API_CALL_LOG_BATCH_SIZE, API_CALL_LOG_FLUSH_INTERVAL, API_CALL_LOG_QUEUE_SIZE
+from couchers.db import session_scope
+from couchers.metrics import (
+    api_call_logs_dropped_counter,
+    api_call_logs_sampled_out_counter,
+    api_call_logs_written_counter,
+)
+from couchers.models import APICall
+from proto import annotations_pb2
+
+logger = logging.getLogger(__name__)
+
+# responses are truncated to this length when logged
+RESPONSE_TRUNCATE_LENGTH = 16 * 1024  # 16 kB
+
+
+def _reachable_message_types(descriptor):
+    seen = {descriptor}
+    stack = [descriptor]
+    while stack:
+        for field in stack.pop().fields:
+            if field.message_type and field.message_type not in seen:
+                seen.add(field.message_type)
+                stack.append(field.message_type)
+    return seen
+
+
+@functools.cache
+def _has_sensitive_fields(descriptor):
+    """
+    Whether this message type or anything nested in it has fields marked sensitive
+    """
+    return any(
+        field.GetOptions().Extensions[annotations_pb2.sensitive]
+        for message_type in _reachable_message_types(descriptor)
+        for field in message_type.fields
+    )
+
+
+@functools.cache
+def _sanitizer_plan(descriptor):
+    """
+    Works out once per message type what sanitizing it involves, as a tuple of (field name, action) for fields that are
+    either sensitive themselves or contain something sensitive. None if there is nothing to sanitize.
+    """
+    if not _has_sensitive_fields(descriptor):
+        return None
+    plan = []
+    for field in descriptor.fields:
+        if field.GetOptions().Extensions[annotations_pb2.sensitive]:
+            plan.append((field.name, "clear"))
+        elif field.message_type and _has_sensitive_fields(field.message_type):
+            if field.message_type.GetOptions().map_entry:
+                plan.append((field.name, "map"))
+            elif field.label == field.LABEL_REPEATED:
+                plan.append((field.name, "repeated"))
+            else:
+                plan.append((field.name, "message"))
+    return tuple(plan)
+
+
+def sanitize_message(message):
+    """
+    Clears fields marked sensitive in place, recursing into submessages
+    """
+    plan = _sanitizer_plan(message.DESCRIPTOR)
+    if not plan:
+        return
+    for name, action in plan:
+        if action == "clear":
+            message.ClearField(name)
+        elif action == "message":
+            if message.HasField(name):
+                sanitize_message(getattr(message, name))
+        elif action == "repeated":
+            for submessage in getattr(message, name):
+                sanitize_message(submessage)
+        elif action == "map":
+            for submessage in getattr(message, name).values():
+                sanitize_message(submessage)
+
+
+def sanitized_bytes(message_type, raw):
+    """
+    Takes a serialized message and returns it serialized again with the fields marked sensitive removed
+    """
+    if raw is None:
+        return None
+    if not _sanitizer_plan(message_type.DESCRIPTOR):
+        # nothing to strip, so no need to parse it at all
+        return raw
+    message = message_type.FromString(raw)
+    sanitize_message(message)
+    return message.SerializeToString()
+
+
+def parse_sample_rates(value):
+    """
+    Parses "method=rate,method=rate" into a dict of method -> rate
+    """
+    rates = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        method, rate = pair.rsplit("=", 1)
+        rates[method.strip()] = float(rate)
+    return rates
+
+
+@dataclass
+class APICallRecord:
+    time: datetime
+    method: str
+    status_code: str | None
+    duration: float
+    user_id: int | None
+    is_api_key: bool | None
+    request_type: type | None
+    request: bytes | None
+    response_type: type | None
+    response: bytes | None
+    traceback: str | None
+    perf_report: str | None
+    ip_address: str | None
+    user_agent: str | None
+
+    def to_row(self):
+        req_bytes = sanitized_bytes(self.request_type, self.request)
+        res_bytes = sanitized_bytes(self.response_type, self.response)
+        response_truncated = False
+        if res_bytes and len(res_bytes) > RESPONSE_TRUNCATE_LENGTH:
+            res_bytes = res_bytes[:RESPONSE_TRUNCATE_LENGTH]
+            response_truncated = True
+        return {
+            "time": self.time,
+            "is_api_key": bool(self.is_api_key),
+            "method": self.method,
+            "status_code": self.status_code,
+            "duration": self.duration,
+            "user_id": self.user_id,
+            "request": req_bytes,
+            "response": res_bytes,
+            "response_truncated": response_truncated,
+            "traceback": self.traceback,
+            "perf_report": self.perf_report,
+            "ip_address": self.ip_address,
+            "user_agent": self.user_agent,
+        }
+
+
+class APICallLog:
+    """
+    Bounded queue of api call records, written out in batches by a background thread
+    """
+
+    def __init__(self, flush_interval, batch_size, max_queued):
+        self._flush_interval = flush_interval.total_seconds()
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queued)
+        # serializes explicit flushes with the background thread, so a flush() returns once everything queued before
+        # it is in the database
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def should_log(self, method, sample_rates):
+        """
+        Decides whether to log a successful call to the given method
+        """
+        rate = sample_rates.get(method)
+        if rate is None or rate >= 1 or random.random() < rate:
+            return True
+        api_call_logs_sampled_out_counter.labels(method).inc()
+        return False
+
+    def put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            api_call_logs_dropped_counter.labels(record.method).inc()
+
+    def clear(self):
+        """
+        Drops anything queued without writing it out
+        """
+        with self._flush_lock:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    return
+
+    def _take_batch(self):
+        batch = []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        with self._flush_lock:
+            while batch := self._take_batch():
+                try:
+                    with session_scope() as session:
+                        session.execute(insert(APICall).values([record.to_row() for record in batch]))
+                except Exception:
+                    for record in batch:
+                        api_call_logs_dropped_counter.labels(record.method).inc()
+                    raise
+                api_call_logs_written_counter.inc(len(batch))
+                logger.debug(f"Wrote {len(batch)} api call logs")
+
+    def _run(self):
+        while True:
+            sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Failed to write api call logs", exc_info=e)
+
+    def start(self):
+        """
+        Starts the background writer thread
+        """
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name="api-call-log-writer", daemon=True)
+            self._thread.start()
+
+
+api_call_log = APICallLog(API_CALL_LOG_FLUSH_INTERVAL, API_CALL_LOG_BATCH_SIZE, API_CALL_LOG_QUEUE_SIZE)
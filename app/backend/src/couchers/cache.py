@@ -0,0 +1,165 @@
+"""
+Small in-process caches, and dropping their entries once a transaction that changed what they hold commits.
+
+Caches live per process, so a change committed in one process is only seen by the others once the entries they hold
+expire: each cache's TTL bounds how stale it can be elsewhere.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class _Everything:
+    """
+    Stands in for the set of all keys, when a transaction invalidates a whole cache
+    """
+
+    def __contains__(self, key):
+        return True
+
+    def __or__(self, other):
+        return self
+
+    __ror__ = __or__
+
+    def __repr__(self):
+        return "EVERYTHING"
+
+
+EVERYTHING = _Everything()
+
+
+class TTLCache:
+    """
+    A thread safe key -> value cache whose entries expire after a TTL, optionally holding at most max_size entries, in
+    which case the least recently used are dropped first. Expired entries are dropped when they are looked up, or on a
+    put once they are the least recently used.
+
+    Values are looked up in the database on a miss and put back with the generation read before the lookup. The
+    generation is bumped on every invalidation, so a lookup racing with one doesn't put back a stale value.
+    """
+
+    def __init__(self, ttl, max_size=None):
+        self._ttl = ttl.total_seconds()
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # key -> (fetched_at, value), least recently used first
+        self._entries = OrderedDict()
+        self.generation = 0
+
+    def _added(self, key, value):
+        """
+        Called with the lock held whenever an entry is put in the cache, for subclasses that keep an index over it
+        """
+
+    def _dropped(self, key, value):
+        """
+        Called with the lock held whenever an entry is dropped from the cache, other than by clear()
+        """
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._dropped(key, entry[1])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if monotonic() - entry[0] > self._ttl:
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_many(self, keys):
+        """
+        Returns a dict of key -> value for the keys that are cached
+        """
+        out = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                out[key] = value
+        return out
+
+    def put(self, key, value, generation):
+        self.put_many({key: value}, generation)
+
+    def put_many(self, values, generation):
+        t = monotonic()
+        with self._lock:
+            if generation != self.generation:
+                return
+            for key, value in values.items():
+                self._pop(key)
+                self._entries[key] = (t, value)
+                self._added(key, value)
+            # drop the least recently used entries while there are too many, or they have expired
+            cutoff = t - self._ttl
+            while self._entries:
+                key, (fetched_at, _) = next(iter(self._entries.items()))
+                if fetched_at >= cutoff and (self._max_size is None or len(self._entries) <= self._max_size):
+                    break
+                self._pop(key)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._pop(key)
+
+    def invalidate_where(self, predicate):
+        """
+        Drops the entries for which predicate(key, value) is true
+        """
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._entries.items() if predicate(key, entry[1])]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries = OrderedDict()
+
+
+def invalidate_on_commit(session, cache, keys=EVERYTHING):
+    """
+    Has the given keys (by default everything) dropped from the cache once the session's transaction commits, or
+    forgotten if it rolls back.
+
+    The cache needs an invalidate(keys) and a clear() method.
+    """
+    pending = session.info.setdefault("cache_invalidations", {})
+    if keys is EVERYTHING or pending.get(cache) is EVERYTHING:
+        pending[cache] = EVERYTHING
+    else:
+        pending.setdefault(cache, set()).update(keys)
+
+
+def pending_invalidations(session, cache):
+    """
+    The keys that the session's transaction will drop from the cache when it commits, which the cache doesn't know
+    have changed yet. Either a set or EVERYTHING
+    """
+    return session.info.get("cache_invalidations", {}).get(cache, set())
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_cache_invalidations(session):
+    for cache, keys in session.info.pop("cache_invalidations", {}).items():
+        if keys is EVERYTHING:
+            cache.clear()
+        else:
+            cache.invalidate(keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_cache_invalidations(session):
+    session.info.pop("cache_invalidations", None)
@@ -14,6 +14,10 @@ CONFIG_OPTIONS = [
     ("ROLE", ["api", "scheduler", "worker", "all"], "all"),
     # number of bg worker processes, requires worker or all above
     ("BACKGROUND_WORKER_COUNT", int, 2),
+    # number of jobs each bg worker process claims per transaction, 1 keeps the classic one-job-at-a-time loop
+    ("BACKGROUND_WORKER_BATCH_SIZE", int, 1),
+    # number of threads each bg worker process runs claimed jobs on, only used when batching
+    ("BACKGROUND_WORKER_THREADS", int, 1),
     # Version string
     ("VERSION", str, "unknown"),
     # Base URL of frontend, e.g. https://couchers.org
@@ -30,6 +34,9 @@ CONFIG_OPTIONS = [
     ("DATABASE_CONNECTION_STRING", str),
     # OpenTelemetry endpoint to send traces to
     ("OPENTELEMETRY_ENDPOINT", str, ""),
+    # Fraction of successful calls to log to logging.api_calls per method, as comma separated method=rate pairs, e.g.
+    # "/org.couchers.api.core.API/Ping=0.1". Methods not listed are always logged, as are all failed calls
+    ("API_CALL_LOG_SAMPLE_RATES", str, ""),
     # Path to a GeoLite2-City.mmdb file for geocoding IPs in user session info
     ("GEOLITE2_CITY_MMDB_FILE_LOCATION", str, ""),
     ("GEOLITE2_ASN_MMDB_FILE_LOCATION", str, ""),
@@ -31,6 +31,100 @@ SERVER_THREADS = 128
 
 WORKER_THREADS = 1
 
+# how long a batch-claimed background job stays invisible to other workers before it's considered abandoned
+BACKGROUND_JOB_LEASE_DURATION = timedelta(minutes=15)
+
+# idle bg workers wait for a NOTIFY, but poll anyway after this long to pick up retries and expired leases
+BACKGROUND_JOB_WAKEUP_TIMEOUT = timedelta(seconds=5)
+# after a wakeup that didn't yield a job, back off exponentially starting here, up to the max
+BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF = timedelta(milliseconds=25)
+BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF_MAX = timedelta(seconds=1)
+
+# max number of queued send_email jobs a bg worker sends in one go, over the same SMTP connection
+SEND_EMAIL_BATCH_SIZE = 20
+
+# how many idle authenticated SMTP connections each worker process keeps around for reuse
+SMTP_POOL_MAX_IDLE = 4
+# pooled SMTP connections are closed after this long, before the server gets around to dropping them
+SMTP_CONNECTION_MAX_AGE = timedelta(minutes=5)
+# a pooled SMTP connection that's been idle for longer than this is checked with a NOOP before it's reused
+SMTP_CONNECTION_CHECK_AFTER = timedelta(seconds=15)
+# socket timeout for SMTP connections
+SMTP_TIMEOUT = timedelta(seconds=30)
+
+# how long the VAPID authorization headers we sign for web push are valid for
+PUSH_VAPID_EXPIRY = timedelta(hours=12)
+# signed VAPID headers are cached per push service and reused until this long before they expire
+PUSH_VAPID_REFRESH_MARGIN = timedelta(hours=1)
+# max number of queued send_raw_push_notification jobs a bg worker sends in one go
+PUSH_BATCH_SIZE = 50
+# max number of pushes from one batch that are in flight at the same time
+PUSH_BATCH_CONCURRENCY = 8
+
+# max number of queued handle_notification jobs a bg worker delivers in one go, loading their users and preferences
+# together
+NOTIFICATION_BATCH_SIZE = 100
+
+# handle_email_digests streams users due a digest and marks their digests sent this many users at a time
+EMAIL_DIGEST_CHUNK_SIZE = 1000
+
+# how long a session lookup is cached in-process, bounds how long a session revoked from another process stays usable,
+# and how many sessions are kept
+SESSION_CACHE_TTL = timedelta(seconds=10)
+SESSION_CACHE_SIZE = 50_000
+
+# how long the viewer independent part of a user profile is cached in-process, bounds how long an update from another
+# process takes to show up, and how many users' profiles are kept
+USER_PROFILE_CACHE_TTL = timedelta(seconds=30)
+USER_PROFILE_CACHE_SIZE = 50_000
+
+# how long users' notification preferences are cached in-process, bounds how long a change made from another process
+# takes to be respected, and how many users' preferences are kept
+NOTIFICATION_PREFERENCE_CACHE_TTL = timedelta(seconds=30)
+NOTIFICATION_PREFERENCE_CACHE_SIZE = 10_000
+
+# how often buffered api_calls/last seen bookkeeping for sessions and user activity is written out
+ACTIVITY_FLUSH_INTERVAL = timedelta(seconds=5)
+
+# api call logs are queued in memory and written out in batches of up to API_CALL_LOG_BATCH_SIZE this often, calls
+# beyond API_CALL_LOG_QUEUE_SIZE waiting to be written are dropped
+API_CALL_LOG_FLUSH_INTERVAL = timedelta(seconds=1)
+API_CALL_LOG_BATCH_SIZE = 500
+API_CALL_LOG_QUEUE_SIZE = 10_000
+
+# paginated lists count their total number of items exactly up to this many, and beyond that show the query planner's
+# estimate, which is cached for this long
+APPROXIMATE_COUNT_EXACT_LIMIT = 10_000
+APPROXIMATE_COUNT_CACHE_TTL = timedelta(minutes=5)
+
+# incremental runs of background tasks also look at changes from this long before their watermark, to pick up changes
+# from transactions that were still in flight when the previous run started
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# the node hierarchy (parents and official clusters) is cached in-process for this long, changes made in this process
+# are seen immediately
+NODE_HIERARCHY_CACHE_TTL = timedelta(minutes=5)
+# a cached node hierarchy at least this old is reloaded when asked about a node it doesn't know, younger ones remember
+# the node as unknown until they expire
+NODE_HIERARCHY_CACHE_MIN_REFETCH_AGE = timedelta(seconds=10)
+
+# how many queued users to recompute lite_users rows for per transaction
+LITE_USERS_REFRESH_BATCH_SIZE = 5000
+
+# clustered users map tiles are built for zooms up to this, past it the map shows individual users
+CLUSTERED_USERS_TILES_MAX_ZOOM = 12
+# users are clustered on a grid of this many by this many cells in each tile
+CLUSTERED_USERS_TILES_GRID_SIZE = 8
+# how many dirty clustered users tiles to rebuild per transaction
+CLUSTERED_USERS_TILES_BATCH_SIZE = 1000
+
+# how many distinct response times each user's response time sketch keeps, beyond this the closest ones are merged
+USER_RESPONSE_TIMES_SKETCH_SIZE = 64
+# requests that haven't been responded to count as taking this long in the response time percentiles
+UNANSWERED_RESPONSE_TIME = timedelta(days=1000)
+# how many users' response rates to recompute per transaction when fixing drift
+USER_RESPONSE_RATES_CHECK_BATCH_SIZE = 1000
+
 # how long the user has to undelete their account
 UNDELETE_DAYS = 7
 
@@ -3,28 +3,48 @@ import inspect
 import logging
 import os
 from contextlib import contextmanager
+from itertools import chain
 from os import getpid
 from threading import get_ident
+from time import monotonic
 
 from alembic import command
 from alembic.config import Config
 from opentelemetry import trace
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.session import Session
 from sqlalchemy.pool import QueuePool
-from sqlalchemy.sql import and_, func, literal, or_
+from sqlalchemy.sql import and_, delete, func, or_
 
+from couchers.cache import TTLCache, invalidate_on_commit, pending_invalidations
 from couchers.config import config
-from couchers.constants import SERVER_THREADS, WORKER_THREADS
+from couchers.constants import (
+    NODE_HIERARCHY_CACHE_MIN_REFETCH_AGE,
+    NODE_HIERARCHY_CACHE_TTL,
+    SERVER_THREADS,
+    WORKER_THREADS,
+)
 from couchers.models import (
+    ActivenessProbe,
     Cluster,
     ClusterRole,
     ClusterSubscription,
     FriendRelationship,
     FriendStatus,
+    HostRequest,
+    LiteUserChange,
+    Message,
     Node,
+    StrongVerificationAttempt,
     TimezoneArea,
+    Upload,
+    User,
+    UserNode,
+    Watermark,
 )
+from couchers.response_rates import update_user_response_rates
 from couchers.sql import couchers_select as select
 
 logger = logging.getLogger(__name__)
@@ -54,8 +74,9 @@ def _get_base_engine():
         pool_pre_ping=True,
         # one connection per thread
         poolclass=QueuePool,
-        # main threads + a few extra in case
-        pool_size=SERVER_THREADS + WORKER_THREADS + 12,
+        # main threads + bg job threads (which hold the job row lock while the handler opens its own session) + a few
+        # extra in case
+        pool_size=SERVER_THREADS + 2 * max(WORKER_THREADS, config["BACKGROUND_WORKER_THREADS"]) + 12,
     )
 
 
@@ -124,6 +145,22 @@ def worker_repeatable_read_session_scope():
                     logger.debug(f"SScope (worker): closed {backend_pid=}")
 
 
+@contextmanager
+def listen_scope(channel):
+    """
+    Yields the raw psycopg2 connection of a dedicated autocommit connection that is LISTENing on `channel`.
+
+    Wait on it with select() and then call poll() to collect notifications into its `notifies` list.
+    """
+    with _get_base_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"LISTEN {channel};"))
+        try:
+            yield conn.connection.dbapi_connection
+        finally:
+            # the connection goes back to the pool, so we don't want it to keep listening
+            conn.execute(text(f"UNLISTEN {channel};"))
+
+
 def db_post_fork():
     """
     Fix post-fork issues with sqlalchemy
@@ -170,32 +207,95 @@ def get_parent_node_at_location(session, shape):
     )
 
 
+class NodeHierarchyCache(TTLCache):
+    """
+    Caches the parent and official cluster of every node.
+
+    There are only a few thousand nodes and they hardly ever change, so walking up the tree in Python beats running a
+    recursive CTE on every call. The cache is dropped when a transaction in this process that changed nodes or clusters
+    commits, and reloaded after NODE_HIERARCHY_CACHE_TTL or when asked about a node it doesn't know, to pick up changes
+    from other processes.
+
+    So that unknown ids can't reload the whole table on every call, a copy younger than min_refetch_age isn't reloaded
+    for them: the id is remembered as unknown until the copy expires.
+    """
+
+    # the whole hierarchy is cached as one entry: (fetched_at, nodes, unknown_node_ids), where nodes is
+    # node_id -> (parent_node_id, official_cluster_id)
+    _NODES = "nodes"
+
+    def __init__(self, ttl, min_refetch_age):
+        super().__init__(ttl)
+        self._min_refetch_age = min_refetch_age.total_seconds()
+
+    def _fetch(self, session):
+        return {
+            node_id: (parent_node_id, cluster_id)
+            for node_id, parent_node_id, cluster_id in session.execute(
+                select(Node.id, Node.parent_node_id, Cluster.id).outerjoin(
+                    Cluster, and_(Cluster.parent_node_id == Node.id, Cluster.is_official_cluster)
+                )
+            ).all()
+        }
+
+    def _get_nodes(self, session, node_id):
+        if pending_invalidations(session, self):
+            # this transaction has changes the cache doesn't know about yet
+            return self._fetch(session)
+        cached = self.get(self._NODES)
+        if cached:
+            fetched_at, nodes, unknown_node_ids = cached
+            if node_id in nodes or node_id in unknown_node_ids:
+                return nodes
+            if monotonic() - fetched_at < self._min_refetch_age:
+                unknown_node_ids.add(node_id)
+                return nodes
+        generation = self.generation
+        fetched_at = monotonic()
+        nodes = self._fetch(session)
+        self.put(self._NODES, (fetched_at, nodes, set()), generation)
+        return nodes
+
+    def get_ancestry(self, session, node_id):
+        """
+        Returns a list of (node_id, parent_node_id, official_cluster_id) for the given node and its ancestors, from the
+        node up to the root
+        """
+        nodes = self._get_nodes(session, node_id)
+        ancestry = []
+        while node_id in nodes:
+            parent_node_id, cluster_id = nodes[node_id]
+            ancestry.append((node_id, parent_node_id, cluster_id))
+            node_id = parent_node_id
+        return ancestry
+
+
+node_hierarchy_cache = NodeHierarchyCache(NODE_HIERARCHY_CACHE_TTL, NODE_HIERARCHY_CACHE_MIN_REFETCH_AGE)
+
+
 def get_node_parents_recursively(session, node_id):
     """
     Gets the upwards hierarchy of parents, ordered by level, for a given node
 
-    Returns SQLAlchemy rows of (node_id, parent_node_id, level, cluster)
+    Returns tuples of (node_id, parent_node_id, level, cluster)
     """
-    parents = (
-        select(Node.id, Node.parent_node_id, literal(0).label("level"))
-        .where(Node.id == node_id)
-        .cte("parents", recursive=True)
-    )
-
-    subquery = select(
-        parents.union(
-            select(Node.id, Node.parent_node_id, (parents.c.level + 1).label("level")).join(
-                parents, Node.id == parents.c.parent_node_id
-            )
+    ancestry = [
+        (level, node_id, parent_node_id, cluster_id)
+        for level, (node_id, parent_node_id, cluster_id) in enumerate(
+            node_hierarchy_cache.get_ancestry(session, node_id)
         )
-    ).subquery()
-
-    return session.execute(
-        select(subquery, Cluster)
-        .join(Cluster, Cluster.parent_node_id == subquery.c.id)
-        .where(Cluster.is_official_cluster)
-        .order_by(subquery.c.level.desc())
-    ).all()
+        if cluster_id is not None
+    ]
+    clusters = {
+        cluster.id: cluster
+        for cluster in session.execute(
+            select(Cluster).where(Cluster.id.in_([cluster_id for _, _, _, cluster_id in ancestry]))
+        ).scalars()
+    }
+    return [
+        (node_id, parent_node_id, level, clusters[cluster_id])
+        for level, node_id, parent_node_id, cluster_id in reversed(ancestry)
+    ]
 
 
 def _can_moderate_any_cluster(session, user_id, cluster_ids):
@@ -232,10 +332,65 @@ def can_moderate_node(session, user_id, node_id):
     Returns True if the user_id can moderate the given node (i.e., if they are admin of any community that is a parent of the node)
     """
     return _can_moderate_any_cluster(
-        session, user_id, [cluster.id for _, _, _, cluster in get_node_parents_recursively(session, node_id)]
+        session,
+        user_id,
+        [
+            cluster_id
+            for _, _, cluster_id in node_hierarchy_cache.get_ancestry(session, node_id)
+            if cluster_id is not None
+        ],
+    )
+
+
+def users_who_are_cluster_admins(session, user_ids, cluster_ids):
+    """
+    Returns the set of the given user_ids that are admins of any of the given clusters
+    """
+    if not user_ids or not cluster_ids:
+        return set()
+    return set(
+        session.execute(
+            select(ClusterSubscription.user_id)
+            .where(ClusterSubscription.role == ClusterRole.admin)
+            .where(ClusterSubscription.user_id.in_(user_ids))
+            .where(ClusterSubscription.cluster_id.in_(cluster_ids))
+        ).scalars()
+    )
+
+
+def users_who_can_moderate_node(session, user_ids, node_id):
+    """
+    Returns the set of the given user_ids that can moderate the given node, like can_moderate_node for many users at once
+    """
+    return users_who_are_cluster_admins(
+        session,
+        user_ids,
+        [
+            cluster_id
+            for _, _, cluster_id in node_hierarchy_cache.get_ancestry(session, node_id)
+            if cluster_id is not None
+        ],
     )
 
 
+def users_who_can_moderate_at(session, user_ids, shape):
+    """
+    Returns the set of the given user_ids that can moderate the given geo-shape, like can_moderate_at for many users at
+    once
+    """
+    cluster_ids = (
+        session.execute(
+            select(Cluster.id)
+            .join(Node, Node.id == Cluster.parent_node_id)
+            .where(Cluster.is_official_cluster)
+            .where(func.ST_Contains(Node.geom, shape))
+        )
+        .scalars()
+        .all()
+    )
+    return users_who_are_cluster_admins(session, user_ids, cluster_ids)
+
+
 def timezone_at_coordinate(session, geom):
     area = session.execute(
         select(TimezoneArea.tzid).where(func.ST_Contains(TimezoneArea.geom, geom))
@@ -243,3 +398,144 @@ def timezone_at_coordinate(session, geom):
     if area:
         return area.tzid
     return None
+
+
+def get_watermark(session, name):
+    """
+    Returns how far the incremental task with the given name has got, or None if it has never run
+    """
+    return session.execute(select(Watermark.watermark).where(Watermark.name == name)).scalar_one_or_none()
+
+
+def set_watermark(session, name, watermark):
+    statement = insert(Watermark).values(name=name, watermark=watermark)
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Watermark.name], set_={"watermark": statement.excluded.watermark}
+        )
+    )
+
+
+def _geom_changed(obj):
+    return sa_inspect(obj).attrs.geom.history.has_changes()
+
+
+@event.listens_for(Session, "after_flush")
+def _update_user_nodes(session, flush_context):
+    """
+    Keeps user_nodes in sync with users' and nodes' geoms, and notes when the node hierarchy changed
+    """
+    user_ids = set()
+    node_ids = set()
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, User) and _geom_changed(obj):
+            user_ids.add(obj.id)
+        elif isinstance(obj, Node) and _geom_changed(obj):
+            node_ids.add(obj.id)
+    if any(isinstance(obj, (Node, Cluster)) for obj in chain(session.new, session.dirty, session.deleted)):
+        invalidate_on_commit(session, node_hierarchy_cache)
+
+    if not user_ids and not node_ids:
+        return
+
+    # goes through the connection, flushing is already underway
+    conn = session.connection()
+    contained = select(User.id, Node.id).join(Node, func.ST_Contains(Node.geom, User.geom))
+    if user_ids:
+        conn.execute(delete(UserNode).where(UserNode.user_id.in_(user_ids)))
+        conn.execute(
+            insert(UserNode)
+            .from_select([UserNode.user_id, UserNode.node_id], contained.where(User.id.in_(user_ids)))
+            .on_conflict_do_nothing()
+        )
+    if node_ids:
+        conn.execute(delete(UserNode).where(UserNode.node_id.in_(node_ids)))
+        conn.execute(
+            insert(UserNode)
+            .from_select([UserNode.user_id, UserNode.node_id], contained.where(Node.id.in_(node_ids)))
+            .on_conflict_do_nothing()
+        )
+
+
+# the User attributes that a lite_users row is computed from
+_LITE_USER_ATTRS = (
+    "username",
+    "name",
+    "city",
+    "birthdate",
+    "gender",
+    "has_passport_sex_gender_exception",
+    "geom",
+    "geom_radius",
+    "is_banned",
+    "is_deleted",
+    "avatar_key",
+    "about_me",
+)
+
+
+def _lite_user_changed(obj):
+    attrs = sa_inspect(obj).attrs
+    return any(attrs[attr].history.has_changes() for attr in _LITE_USER_ATTRS)
+
+
+@event.listens_for(Session, "after_flush")
+def _queue_lite_user_changes(session, flush_context):
+    """
+    Queues users whose lite_users row is out of date, in the same transaction as the change so none are missed
+    """
+    user_ids = set()
+    upload_keys = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, User):
+            if obj in session.dirty and not _lite_user_changed(obj):
+                continue
+            user_ids.add(obj.id)
+        elif isinstance(obj, StrongVerificationAttempt):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, Upload):
+            upload_keys.add(obj.key)
+
+    if not user_ids and not upload_keys:
+        return
+
+    conn = session.connection()
+    if upload_keys:
+        user_ids.update(conn.execute(select(User.id).where(User.avatar_key.in_(upload_keys))).scalars())
+    if user_ids:
+        statement = insert(LiteUserChange).values([{"user_id": user_id} for user_id in sorted(user_ids)])
+        # a no-op update rather than doing nothing, so already queued rows are locked until this commits, otherwise the
+        # refresh could take them before this transaction's changes are visible and the changes would be missed
+        conn.execute(
+            statement.on_conflict_do_update(
+                index_elements=[LiteUserChange.user_id], set_={"changed": LiteUserChange.changed}
+            )
+        )
+
+
+@event.listens_for(Session, "after_flush")
+def _update_user_response_rates(session, flush_context):
+    """
+    Counts new host requests and activeness probes, and responses to them, towards the users' response rates
+    """
+    request_user_ids = []
+    message_ids = []
+    responded_probe_ids = []
+    for obj in session.new:
+        if isinstance(obj, HostRequest):
+            request_user_ids.append(obj.host_user_id)
+        elif isinstance(obj, Message):
+            message_ids.append(obj.id)
+        elif isinstance(obj, ActivenessProbe):
+            request_user_ids.append(obj.user_id)
+            if obj.responded is not None:
+                responded_probe_ids.append(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, ActivenessProbe):
+            history = sa_inspect(obj).attrs.responded.history
+            # only when it goes from not responded to responded
+            if history.added and history.added[0] is not None and not any(history.deleted):
+                responded_probe_ids.append(obj.id)
+
+    if request_user_ids or message_ids or responded_probe_ids:
+        update_user_response_rates(session.connection(), request_user_ids, message_ids, responded_probe_ids)
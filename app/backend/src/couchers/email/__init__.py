@@ -2,15 +2,16 @@ import logging
 from pathlib import Path
 
 import yaml
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment
 
 from couchers.config import config
 from couchers.jobs.enqueue import queue_job
+from couchers.templates.loader import SystemEmailTemplateLoader
 from proto.internal import jobs_pb2
 
 logger = logging.getLogger(__name__)
 
-loader = FileSystemLoader(Path(__file__).parent / ".." / ".." / ".." / "templates")
+loader = SystemEmailTemplateLoader(Path(__file__).parent / ".." / ".." / ".." / "templates")
 env = Environment(loader=loader, trim_blocks=True)
 
 
@@ -55,13 +56,12 @@ def queue_email(
 
 
 def enqueue_system_email(session, recipient, template_name, template_args):
-    source, _, _ = loader.get_source(env, f"system/{template_name}.md")
-    _, frontmatter_source, text_source = source.split("---", 2)
-
-    rendered_frontmatter = env.from_string(frontmatter_source).render(**template_args, plain=True, html=False)
+    rendered_frontmatter = env.get_template(f"system/{template_name}.md:frontmatter").render(
+        **template_args, plain=True, html=False
+    )
     frontmatter = yaml.load(rendered_frontmatter, Loader=yaml.FullLoader)
 
-    plain = env.from_string(text_source.strip()).render(
+    plain = env.get_template(f"system/{template_name}.md:body").render(
         {**template_args, "frontmatter": frontmatter}, plain=True, html=False
     )
 
@@ -1,13 +1,28 @@
+import functools
+import logging
+import os
 import smtplib
+from collections import deque
 from email.headerregistry import Address
 from email.message import EmailMessage
 from email.utils import make_msgid
 from pathlib import Path
+from threading import Lock
+from time import monotonic
 
 from couchers.config import config
+from couchers.constants import (
+    SMTP_CONNECTION_CHECK_AFTER,
+    SMTP_CONNECTION_MAX_AGE,
+    SMTP_POOL_MAX_IDLE,
+    SMTP_TIMEOUT,
+)
 from couchers.crypto import EMAIL_SOURCE_DATA_KEY_NAME, random_hex, simple_hash_signature
+from couchers.metrics import smtp_connections_counter
 from couchers.models import Email
 
+logger = logging.getLogger(__name__)
+
 template_base = Path(Path(__file__).parent / ".." / ".." / ".." / "templates" / "v2")
 
 
@@ -17,11 +32,133 @@ def make_cid(sender_email):
     return cid, without_tag
 
 
-def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+@functools.cache
+def _attachment_imgs():
     """
-    Sends out the email through SMTP, settings from config.
+    The (path as used in the html, png data) of each image in attachment_imgs/, read once per process
+    """
+    return [
+        (str(attachment.relative_to(template_base)), attachment.read_bytes())
+        for attachment in sorted((template_base / "attachment_imgs").glob("*.png"))
+    ]
 
-    Returns a models.Email object that can be straight away added to the database.
+
+class _PooledConnection:
+    def __init__(self, server):
+        self.server = server
+        self.opened = monotonic()
+        self.last_used = self.opened
+        self.reused = False
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP connections around so that each email doesn't need a new connection, STARTTLS and login.
+
+    Connections are handed out to one thread at a time, most recently used first, and are checked with a NOOP if
+    they've been idle for a while. Connections that error are thrown away rather than put back.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = Lock()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        server = smtplib.SMTP(config["SMTP_HOST"], config["SMTP_PORT"], timeout=SMTP_TIMEOUT.total_seconds())
+        try:
+            server.ehlo()
+            if not config["DEV"]:
+                server.starttls()
+                # stmplib docs recommend calling ehlo() before and after starttls()
+                server.ehlo()
+                server.login(config["SMTP_USERNAME"], config["SMTP_PASSWORD"])
+        except Exception:
+            server.close()
+            raise
+        smtp_connections_counter.labels("opened").inc()
+        return _PooledConnection(server)
+
+    def _discard(self, conn):
+        smtp_connections_counter.labels("discarded").inc()
+        try:
+            conn.server.quit()
+        except Exception:
+            conn.server.close()
+
+    def _is_usable(self, conn):
+        if monotonic() - conn.opened > SMTP_CONNECTION_MAX_AGE.total_seconds():
+            return False
+        if monotonic() - conn.last_used > SMTP_CONNECTION_CHECK_AFTER.total_seconds():
+            try:
+                return conn.server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                return False
+        return True
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    # we've been forked, the connections belong to the parent
+                    self._idle.clear()
+                    self._pid = os.getpid()
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if self._is_usable(conn):
+                smtp_connections_counter.labels("reused").inc()
+                conn.reused = True
+                return conn
+            self._discard(conn)
+        return self._connect()
+
+    def _release(self, conn):
+        conn.last_used = monotonic()
+        with self._lock:
+            if os.getpid() == self._pid and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Sends a message over a pooled connection
+        """
+        conn = self._acquire()
+        try:
+            conn.server.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            self._discard(conn)
+            if not conn.reused:
+                raise
+            # the server dropped the connection while it sat in the pool, so try once more on a new one
+            logger.info("Pooled SMTP connection was closed by the server, reconnecting")
+            conn = self._connect()
+            try:
+                conn.server.sendmail(from_addr, to_addrs, msg)
+            except Exception:
+                self._discard(conn)
+                raise
+        except Exception:
+            self._discard(conn)
+            raise
+        self._release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn in idle:
+            self._discard(conn)
+
+
+smtp_pool = SMTPConnectionPool(SMTP_POOL_MAX_IDLE)
+
+
+def _make_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+    """
+    Builds the message to send and the models.Email to record it
     """
     message_id = random_hex()
     msg = EmailMessage()
@@ -42,12 +179,10 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
     if html:
         # for any png files in attachment_imgs/, goes through and replaces instances of the filename with attachment
         used_attachments = []
-        for attachment in (template_base / "attachment_imgs").glob("*.png"):
-            attachment_html_path = str(attachment.relative_to(template_base))
+        for attachment_html_path, data in _attachment_imgs():
             if attachment_html_path not in html:
                 continue
             # it's used in this template, so attach and replace it
-            data = attachment.read_bytes()
             cid, wcid = make_cid(sender_email)
             html = html.replace(attachment_html_path, f"cid:{wcid}")
             used_attachments.append((cid, "image", "png", data))
@@ -57,16 +192,7 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
         for cid, mime_type, mime_subtype, data in used_attachments:
             msg.get_payload()[1].add_related(data, mime_type, mime_subtype, cid=cid)
 
-    with smtplib.SMTP(config["SMTP_HOST"], config["SMTP_PORT"]) as server:
-        server.ehlo()
-        if not config["DEV"]:
-            server.starttls()
-            # stmplib docs recommend calling ehlo() before and after starttls()
-            server.ehlo()
-            server.login(config["SMTP_USERNAME"], config["SMTP_PASSWORD"])
-        server.sendmail(sender_email, recipient, msg.as_string())
-
-    return Email(
+    return msg, Email(
         id=message_id,
         sender_name=sender_name,
         sender_email=sender_email,
@@ -77,3 +203,34 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
         list_unsubscribe_header=list_unsubscribe_header,
         source_data=source_data,
     )
+
+
+def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+    """
+    Sends out the email through SMTP, settings from config.
+
+    Returns a models.Email object that can be straight away added to the database.
+    """
+    msg, email = _make_email(
+        sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data
+    )
+    smtp_pool.sendmail(sender_email, recipient, msg.as_string())
+    return email
+
+
+def send_smtp_emails(emails):
+    """
+    Sends out several emails through SMTP one after the other, reusing the same connection. Takes a list of dicts of
+    arguments to send_smtp_email.
+
+    Returns a list with, for each email, either the models.Email to add to the database, or the exception if it
+    couldn't be sent.
+    """
+    results = []
+    for email_args in emails:
+        try:
+            results.append(send_smtp_email(**email_args))
+        except Exception as e:
+            logger.warning(f"Failed to send email to {email_args['recipient']}", exc_info=e)
+            results.append(e)
+    return results
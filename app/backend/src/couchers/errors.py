@@ -86,10 +86,12 @@ INVALID_LANGUAGE = "Invalid language."
 INVALID_MESSAGE = "Invalid message."
 INVALID_NAME = "Name not supported."
 INVALID_NOTIFICATION_PREFERENCE = "Invalid notification preference."
+INVALID_PAGE_TOKEN = "Invalid page token."
 INVALID_PASSWORD = "Wrong password."
 INVALID_PHONE = "Phone number must be in international format without punctuation."
 INVALID_RECIPIENTS = "Invalid recipients list."
 INVALID_REGION = "Invalid region."
+INVALID_TILE = "Invalid map tile."
 INVALID_TOKEN = "Invalid token."
 INVALID_USERNAME = "Invalid username."
 INVITE_PERMISSION_DENIED = "You're not allowed to invite users."
@@ -1,5 +1,7 @@
 from sqlalchemy.sql import delete
 
+from couchers.activity import user_profile_cache
+from couchers.cache import invalidate_on_commit
 from couchers.models import UserBadge
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict
@@ -27,6 +29,7 @@ def user_add_badge(session, user_id, badge_id, do_notify=True):
 def user_remove_badge(session, user_id, badge_id):
     badge = get_badge_dict()[badge_id]
     session.execute(delete(UserBadge).where(UserBadge.user_id == user_id, UserBadge.badge_id == badge_id))
+    invalidate_on_commit(session, user_profile_cache, [user_id])
     session.flush()
     notify(
         session,
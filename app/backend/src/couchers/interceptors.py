@@ -1,6 +1,4 @@
 import logging
-from copy import deepcopy
-from datetime import timedelta
 from os import getpid
 from threading import get_ident
 from time import perf_counter_ns
@@ -9,13 +7,15 @@ from traceback import format_exception
 import grpc
 import sentry_sdk
 from opentelemetry import trace
-from sqlalchemy.sql import and_, func
 
 from couchers import errors
+from couchers.activity import activity_buffer, session_cache
+from couchers.api_call_log import APICallRecord, api_call_log, parse_sample_rates
+from couchers.config import config
 from couchers.db import session_scope
 from couchers.descriptor_pool import get_descriptor_pool
 from couchers.metrics import observe_in_servicer_duration_histogram
-from couchers.models import APICall, User, UserActivity, UserSession
+from couchers.models import User, UserSession
 from couchers.sql import couchers_select as select
 from couchers.utils import (
     create_lang_cookie,
@@ -31,67 +31,41 @@ from proto import annotations_pb2
 logger = logging.getLogger(__name__)
 
 
-def _binned_now():
-    return func.date_bin("1 hour", func.now(), "2000-01-01")
-
-
 def _try_get_and_update_user_details(token, is_api_key, ip_address, user_agent):
     """
     Tries to get session and user info corresponding to this token.
 
-    Also updates the user last active time, token last active time, and increments API call count.
+    Also records the call towards the user last active time, token last active time, and API call count. Those are
+    buffered and written out in the background by couchers.activity.
     """
     if not token:
         return None
 
-    with session_scope() as session:
-        result = session.execute(
-            select(User, UserSession, UserActivity)
-            .join(User, User.id == UserSession.user_id)
-            .outerjoin(
-                UserActivity,
-                and_(
-                    UserActivity.user_id == User.id,
-                    UserActivity.period == _binned_now(),
-                    UserActivity.ip_address == ip_address,
-                    UserActivity.user_agent == user_agent,
-                ),
-            )
-            .where(User.is_visible)
-            .where(UserSession.token == token)
-            .where(UserSession.is_valid)
-            .where(UserSession.is_api_key == is_api_key)
-        ).one_or_none()
-
-        if not result:
-            return None
-        else:
-            user, user_session, user_activity = result
-
-            # update user last active time if it's been a while
-            if now() - user.last_active > timedelta(minutes=5):
-                user.last_active = func.now()
-
-            # let's update the token
-            user_session.last_seen = func.now()
-            user_session.api_calls += 1
-
-            if user_activity:
-                user_activity.api_calls += 1
-            else:
-                session.add(
-                    UserActivity(
-                        user_id=user.id,
-                        period=_binned_now(),
-                        ip_address=ip_address,
-                        user_agent=user_agent,
-                        api_calls=1,
-                    )
-                )
+    auth_info = session_cache.get(token, is_api_key)
+
+    if not auth_info:
+        generation = session_cache.generation
+        with session_scope() as session:
+            result = session.execute(
+                select(User, UserSession)
+                .join(User, User.id == UserSession.user_id)
+                .where(User.is_visible)
+                .where(UserSession.token == token)
+                .where(UserSession.is_valid)
+                .where(UserSession.is_api_key == is_api_key)
+            ).one_or_none()
+
+            if not result:
+                return None
 
-            session.commit()
+            user, user_session = result
+            auth_info = user.id, user.is_jailed, user.is_superuser, user_session.expiry, user.ui_language_preference
 
-            return user.id, user.is_jailed, user.is_superuser, user_session.expiry, user.ui_language_preference
+        session_cache.put(token, is_api_key, auth_info, generation)
+
+    activity_buffer.record(auth_info[0], token, ip_address, user_agent)
+
+    return auth_info
 
 
 def abort_handler(message, status_code):
@@ -333,32 +307,8 @@ class TracingInterceptor(grpc.ServerInterceptor):
     Measures and logs the time it takes to service each incoming call.
     """
 
-    def _sanitized_bytes(self, proto):
-        """
-        Remove fields marked sensitive and return serialized bytes
-        """
-        if not proto:
-            return None
-
-        new_proto = deepcopy(proto)
-
-        def _sanitize_message(message):
-            for name, descriptor in message.DESCRIPTOR.fields_by_name.items():
-                if descriptor.GetOptions().Extensions[annotations_pb2.sensitive]:
-                    message.ClearField(name)
-                if descriptor.message_type:
-                    submessage = getattr(message, name)
-                    if not submessage:
-                        continue
-                    if descriptor.label == descriptor.LABEL_REPEATED:
-                        for msg in submessage:
-                            _sanitize_message(msg)
-                    else:
-                        _sanitize_message(submessage)
-
-        _sanitize_message(new_proto)
-
-        return new_proto.SerializeToString()
+    def __init__(self):
+        self._sample_rates = parse_sample_rates(config["API_CALL_LOG_SAMPLE_RATES"])
 
     def _store_log(
         self,
@@ -374,30 +324,25 @@ class TracingInterceptor(grpc.ServerInterceptor):
         ip_address,
         user_agent,
     ):
-        req_bytes = self._sanitized_bytes(request)
-        res_bytes = self._sanitized_bytes(response)
-        with session_scope() as session:
-            response_truncated = False
-            truncate_res_bytes_length = 16 * 1024  # 16 kB
-            if res_bytes and len(res_bytes) > truncate_res_bytes_length:
-                res_bytes = res_bytes[:truncate_res_bytes_length]
-                response_truncated = True
-            session.add(
-                APICall(
-                    is_api_key=is_api_key,
-                    method=method,
-                    status_code=status_code,
-                    duration=duration,
-                    user_id=user_id,
-                    request=req_bytes,
-                    response=res_bytes,
-                    response_truncated=response_truncated,
-                    traceback=traceback,
-                    perf_report=perf_report,
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                )
+        # only serialize here, sanitizing and writing to the db happens on the api call log thread
+        api_call_log.put(
+            APICallRecord(
+                time=now(),
+                method=method,
+                status_code=status_code,
+                duration=duration,
+                user_id=user_id,
+                is_api_key=is_api_key,
+                request_type=type(request) if request is not None else None,
+                request=request.SerializeToString() if request is not None else None,
+                response_type=type(response) if response is not None else None,
+                response=response.SerializeToString() if response is not None else None,
+                traceback=traceback,
+                perf_report=perf_report,
+                ip_address=ip_address,
+                user_agent=user_agent,
             )
+        )
         logger.debug(f"{user_id=}, {method=}, {duration=} ms")
 
     def intercept_service(self, continuation, handler_call_details):
@@ -417,9 +362,10 @@ class TracingInterceptor(grpc.ServerInterceptor):
                 duration = (finished - start) / 1e6  # ms
                 user_id = getattr(context, "user_id", None)
                 is_api_key = getattr(context, "is_api_key", None)
-                self._store_log(
-                    method, None, duration, user_id, is_api_key, request, res, None, None, ip_address, user_agent
-                )
+                if api_call_log.should_log(method, self._sample_rates):
+                    self._store_log(
+                        method, None, duration, user_id, is_api_key, request, res, None, None, ip_address, user_agent
+                    )
                 observe_in_servicer_duration_histogram(method, user_id, "", "", duration / 1000)
             except Exception as e:
                 finished = perf_counter_ns()
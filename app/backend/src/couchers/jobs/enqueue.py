@@ -4,10 +4,38 @@ Background jobs
 
 import logging
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import insert, text
+
 from couchers.models import BackgroundJob
 
 logger = logging.getLogger(__name__)
 
+# max rows per multi-row INSERT, keeps us well clear of the limit on bind parameters per statement
+BULK_INSERT_CHUNK_SIZE = 1000
+
+# postgres channel idle workers LISTEN on, we NOTIFY it whenever a job is queued
+JOB_QUEUE_CHANNEL = "background_jobs"
+
+
+def notify_job_queued(session):
+    """
+    Wakes up idle workers once the current transaction commits. Postgres folds identical notifications within a
+    transaction into one anyway, so we only send it once per transaction, and queueing many jobs one at a time costs no
+    round trips until the jobs are flushed (together, as one multi-row INSERT).
+    """
+    if session.info.get("job_queue_notified"):
+        return
+    session.execute(text(f"NOTIFY {JOB_QUEUE_CHANNEL};"))
+    session.info["job_queue_notified"] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _reset_job_queue_notified(session, transaction):
+    # also on savepoints ending, since a NOTIFY inside a savepoint that's rolled back is gone
+    session.info.pop("job_queue_notified", None)
+
 
 def queue_job(session, job_type: str, payload, max_tries=None, priority=None):
     session.add(
@@ -18,3 +46,33 @@ def queue_job(session, job_type: str, payload, max_tries=None, priority=None):
             priority=priority,
         )
     )
+    notify_job_queued(session)
+
+
+def queue_jobs_bulk(session, job_type: str, payloads, max_tries=None, priority=None):
+    """
+    Queues one job of the given type per payload, with multi-row INSERTs instead of one round trip per job.
+
+    Returns the ids of the new jobs.
+    """
+    values = {"job_type": job_type}
+    if max_tries is not None:
+        values["max_tries"] = max_tries
+    if priority is not None:
+        values["priority"] = priority
+
+    rows = [{**values, "payload": payload.SerializeToString()} for payload in payloads]
+    if not rows:
+        return []
+
+    job_ids = []
+    for i in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        job_ids += (
+            session.execute(
+                insert(BackgroundJob).values(rows[i : i + BULK_INSERT_CHUNK_SIZE]).returning(BackgroundJob.id)
+            )
+            .scalars()
+            .all()
+        )
+    notify_job_queued(session)
+    return job_ids
@@ -18,16 +18,21 @@ from couchers.constants import (
     ACTIVENESS_PROBE_EXPIRY_TIME,
     ACTIVENESS_PROBE_INACTIVITY_PERIOD,
     ACTIVENESS_PROBE_TIME_REMINDERS,
+    NOTIFICATION_BATCH_SIZE,
+    PUSH_BATCH_SIZE,
+    SEND_EMAIL_BATCH_SIZE,
 )
 from couchers.crypto import asym_encrypt, b64decode, simple_decrypt
 from couchers.db import session_scope
 from couchers.email.dev import print_dev_email
-from couchers.email.smtp import send_smtp_email
+from couchers.email.smtp import send_smtp_email, send_smtp_emails
 from couchers.helpers.badges import user_add_badge, user_remove_badge
 from couchers.materialized_views import (
+    check_lite_users,
+    check_user_response_rates,
     refresh_materialized_views,
     refresh_materialized_views_rapid,
-    user_response_rates,
+    update_clustered_users_tiles,
 )
 from couchers.metrics import strong_verification_completions_counter
 from couchers.models import (
@@ -53,11 +58,18 @@ from couchers.models import (
     StrongVerificationAttemptStatus,
     User,
     UserBadge,
+    UserResponseRate,
+)
+from couchers.notifications.background import (
+    handle_email_digests,
+    handle_notification,
+    handle_notifications,
+    send_raw_push_notification,
+    send_raw_push_notifications,
 )
-from couchers.notifications.background import handle_email_digests, handle_notification, send_raw_push_notification
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict, get_static_badge_dict
-from couchers.servicers.api import user_model_to_pb
+from couchers.servicers.api import user_model_to_pb, users_to_pb
 from couchers.servicers.blocking import are_blocked
 from couchers.servicers.conversations import generate_message_notifications
 from couchers.servicers.discussions import generate_create_discussion_notifications
@@ -80,11 +92,16 @@ logger = logging.getLogger(__name__)
 
 # these were straight up imported
 handle_notification.PAYLOAD = jobs_pb2.HandleNotificationPayload
+handle_notification.BATCH_HANDLER = handle_notifications
+handle_notification.BATCH_SIZE = NOTIFICATION_BATCH_SIZE
 
 send_raw_push_notification.PAYLOAD = jobs_pb2.SendRawPushNotificationPayload
+send_raw_push_notification.BATCH_HANDLER = send_raw_push_notifications
+send_raw_push_notification.BATCH_SIZE = PUSH_BATCH_SIZE
 
 handle_email_digests.PAYLOAD = empty_pb2.Empty
 handle_email_digests.SCHEDULE = timedelta(minutes=15)
+handle_email_digests.CONCURRENCY = 1
 
 generate_message_notifications.PAYLOAD = jobs_pb2.GenerateMessageNotificationsPayload
 
@@ -103,17 +120,28 @@ generate_event_delete_notifications.PAYLOAD = jobs_pb2.GenerateEventDeleteNotifi
 
 refresh_materialized_views.PAYLOAD = empty_pb2.Empty
 refresh_materialized_views.SCHEDULE = timedelta(minutes=5)
+refresh_materialized_views.CONCURRENCY = 1
 
 refresh_materialized_views_rapid.PAYLOAD = empty_pb2.Empty
 refresh_materialized_views_rapid.SCHEDULE = timedelta(seconds=30)
+refresh_materialized_views_rapid.CONCURRENCY = 1
 
+check_lite_users.PAYLOAD = empty_pb2.Empty
+check_lite_users.SCHEDULE = timedelta(hours=1)
+check_lite_users.CONCURRENCY = 1
 
-def send_email(payload):
-    logger.info(f"Sending email with subject '{payload.subject}' to '{payload.recipient}'")
-    # selects a "sender", which either prints the email to the logger or sends it out with SMTP
-    sender = send_smtp_email if config["ENABLE_EMAIL"] else print_dev_email
-    # the sender must return a models.Email object that can be added to the database
-    email = sender(
+# also backfills, since scheduled jobs run when the worker starts
+check_user_response_rates.PAYLOAD = empty_pb2.Empty
+check_user_response_rates.SCHEDULE = timedelta(hours=24)
+check_user_response_rates.CONCURRENCY = 1
+
+update_clustered_users_tiles.PAYLOAD = empty_pb2.Empty
+update_clustered_users_tiles.SCHEDULE = timedelta(minutes=1)
+update_clustered_users_tiles.CONCURRENCY = 1
+
+
+def _send_email_args(payload):
+    return dict(
         sender_name=payload.sender_name,
         sender_email=payload.sender_email,
         recipient=payload.recipient,
@@ -123,11 +151,48 @@ def send_email(payload):
         list_unsubscribe_header=payload.list_unsubscribe_header,
         source_data=payload.source_data,
     )
+
+
+def send_email(payload):
+    logger.info(f"Sending email with subject '{payload.subject}' to '{payload.recipient}'")
+    # selects a "sender", which either prints the email to the logger or sends it out with SMTP
+    sender = send_smtp_email if config["ENABLE_EMAIL"] else print_dev_email
+    # the sender must return a models.Email object that can be added to the database
+    email = sender(**_send_email_args(payload))
     with session_scope() as session:
         session.add(email)
 
 
+def send_emails(payloads):
+    """
+    Sends the emails for a batch of send_email jobs, over one SMTP connection, and returns for each either None if it
+    was sent or the exception if it failed
+    """
+    for payload in payloads:
+        logger.info(f"Sending email with subject '{payload.subject}' to '{payload.recipient}'")
+    if config["ENABLE_EMAIL"]:
+        results = send_smtp_emails([_send_email_args(payload) for payload in payloads])
+    else:
+        results = [print_dev_email(**_send_email_args(payload)) for payload in payloads]
+    errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            errors.append(result)
+            continue
+        # each email is recorded on its own, so that failing to record one doesn't get the others retried and sent twice
+        try:
+            with session_scope() as session:
+                session.add(result)
+            errors.append(None)
+        except Exception as e:
+            logger.warning(f"Failed to record email to {result.recipient}", exc_info=e)
+            errors.append(e)
+    return errors
+
+
 send_email.PAYLOAD = jobs_pb2.SendEmailPayload
+send_email.BATCH_HANDLER = send_emails
+send_email.BATCH_SIZE = SEND_EMAIL_BATCH_SIZE
 
 
 def purge_login_tokens(payload):
@@ -230,6 +295,10 @@ def send_message_notifications(payload):
                 else:
                     return f"You missed {count_unseen} message(s) in {group_chat.title}"
 
+            authors = users_to_pb(
+                session, [message.author for _, message, _ in unseen_messages], SimpleNamespace(user_id=user.id)
+            )
+
             notify(
                 session,
                 user_id=user.id,
@@ -237,16 +306,12 @@ def send_message_notifications(payload):
                 data=notification_data_pb2.ChatMissedMessages(
                     messages=[
                         notification_data_pb2.ChatMessage(
-                            author=user_model_to_pb(
-                                message.author,
-                                session,
-                                SimpleNamespace(user_id=user.id),
-                            ),
+                            author=author,
                             message=format_title(message, group_chat, count_unseen),
                             text=message.text,
                             group_chat_id=message.conversation_id,
                         )
-                        for group_chat, message, count_unseen in unseen_messages
+                        for (group_chat, message, count_unseen), author in zip(unseen_messages, authors)
                     ],
                 ),
             )
@@ -531,11 +596,24 @@ add_users_to_email_list.SCHEDULE = timedelta(hours=1)
 
 
 def enforce_community_membership(payload):
-    tasks_enforce_community_memberships()
+    tasks_enforce_community_memberships(incremental=True)
 
 
 enforce_community_membership.PAYLOAD = empty_pb2.Empty
 enforce_community_membership.SCHEDULE = timedelta(minutes=15)
+enforce_community_membership.CONCURRENCY = 1
+
+
+def enforce_all_community_memberships(payload):
+    """
+    Full run to catch users who became eligible without moving, e.g. by being unbanned
+    """
+    tasks_enforce_community_memberships()
+
+
+enforce_all_community_memberships.PAYLOAD = empty_pb2.Empty
+enforce_all_community_memberships.SCHEDULE = timedelta(days=1)
+enforce_all_community_memberships.CONCURRENCY = 1
 
 
 def update_recommendation_scores(payload):
@@ -676,9 +754,9 @@ def update_recommendation_scores(payload):
 
         # response rate
         hr_subquery = select(
-            user_response_rates.c.user_id,
-            float_(extract("epoch", user_response_rates.c.response_time_33p) / 60.0).label("response_time_33p"),
-            float_(extract("epoch", user_response_rates.c.response_time_66p) / 60.0).label("response_time_66p"),
+            UserResponseRate.user_id,
+            float_(extract("epoch", UserResponseRate.response_time_33p) / 60.0).label("response_time_33p"),
+            float_(extract("epoch", UserResponseRate.response_time_66p) / 60.0).label("response_time_66p"),
         ).subquery()
         response_time_33p = hr_subquery.c.response_time_33p
         response_time_66p = hr_subquery.c.response_time_66p
@@ -713,6 +791,7 @@ def update_recommendation_scores(payload):
 
 update_recommendation_scores.PAYLOAD = empty_pb2.Empty
 update_recommendation_scores.SCHEDULE = timedelta(hours=24)
+update_recommendation_scores.CONCURRENCY = 1
 
 
 def update_badges(payload):
@@ -756,6 +835,7 @@ def update_badges(payload):
 
 update_badges.PAYLOAD = empty_pb2.Empty
 update_badges.SCHEDULE = timedelta(minutes=15)
+update_badges.CONCURRENCY = 1
 
 
 def finalize_strong_verification(payload):
@@ -3,7 +3,10 @@ Background job workers
 """
 
 import logging
+import selectors
 import traceback
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import timedelta
 from inspect import getmembers, isfunction
 from multiprocessing import Process
@@ -16,13 +19,20 @@ from google.protobuf import empty_pb2
 from opentelemetry import trace
 
 from couchers.config import config
-from couchers.db import db_post_fork, session_scope, worker_repeatable_read_session_scope
+from couchers.constants import (
+    BACKGROUND_JOB_LEASE_DURATION,
+    BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF,
+    BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF_MAX,
+    BACKGROUND_JOB_WAKEUP_TIMEOUT,
+)
+from couchers.db import db_post_fork, listen_scope, session_scope, worker_repeatable_read_session_scope
 from couchers.jobs import handlers
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import JOB_QUEUE_CHANNEL, queue_job
 from couchers.metrics import (
     background_jobs_got_job_counter,
     background_jobs_no_jobs_counter,
     background_jobs_serialization_errors_counter,
+    background_jobs_spurious_wakeups_counter,
     jobs_queued_histogram,
     observe_in_jobs_duration_histogram,
 )
@@ -36,12 +46,114 @@ trace = trace.get_tracer(__name__)
 
 JOBS = {}
 SCHEDULE = []
+# max number of jobs of a given type that one worker process runs at the same time when batching
+CONCURRENCY = {}
+# job types that can be run several at a time: job_type -> (batch handler, max number of jobs per batch). The batch
+# handler takes a list of payloads and returns a list with None for each that succeeded or the exception if it failed
+BATCHES = {}
 
 for name, func in getmembers(handlers, isfunction):
     if hasattr(func, "PAYLOAD"):
         JOBS[name] = (func.PAYLOAD, func)
         if hasattr(func, "SCHEDULE"):
             SCHEDULE.append((name, func.SCHEDULE))
+        if hasattr(func, "CONCURRENCY"):
+            CONCURRENCY[name] = func.CONCURRENCY
+        if hasattr(func, "BATCH_HANDLER"):
+            BATCHES[name] = (func.BATCH_HANDLER, func.BATCH_SIZE)
+
+
+def _job_completed(job, duration):
+    job.state = BackgroundJobState.completed
+    observe_in_jobs_duration_histogram(job.job_type, job.state.name, job.try_count, "", duration)
+    logger.info(f"Job #{job.id} complete on try number {job.try_count}")
+
+
+def _job_errored(job, e, duration):
+    logger.error(f"Job #{job.id} raised an exception", exc_info=e)
+    sentry_sdk.set_tag("context", "job")
+    sentry_sdk.set_tag("job", job.job_type)
+    sentry_sdk.capture_exception(e)
+
+    if job.try_count >= job.max_tries:
+        # if we already tried max_tries times, it's permanently failed
+        job.state = BackgroundJobState.failed
+        logger.info(f"Job #{job.id} failed on try number {job.try_count}")
+    else:
+        job.state = BackgroundJobState.error
+        # exponential backoff
+        job.next_attempt_after += timedelta(seconds=15 * (2**job.try_count))
+        logger.info(f"Job #{job.id} error on try number {job.try_count}, next try at {job.next_attempt_after}")
+    observe_in_jobs_duration_histogram(job.job_type, job.state.name, job.try_count, type(e).__name__, duration)
+    # add some info for debugging
+    job.failure_info = "".join(traceback.format_exception(e))
+
+
+def _run_locked_job(job):
+    """
+    Runs a job whose row we hold the lock on, recording the outcome on the job. The caller commits.
+    """
+    job.try_count += 1
+
+    message_type, func = JOBS[job.job_type]
+
+    jobs_queued_histogram.observe((now() - job.queued).total_seconds())
+    try:
+        with trace.start_as_current_span(job.job_type) as rollspan:
+            start = perf_counter_ns()
+            ret = func(message_type.FromString(job.payload))
+            finished = perf_counter_ns()
+        _job_completed(job, (finished - start) / 1e9)
+    except Exception as e:
+        finished = perf_counter_ns()
+        _job_errored(job, e, (finished - start) / 1e9)
+
+        if config["IN_TEST"]:
+            raise e
+
+
+def _run_locked_jobs(jobs):
+    """
+    Runs several jobs of the same batchable type whose rows we hold the locks on with the batch handler, recording the
+    outcome on each job. The caller commits.
+    """
+    if len(jobs) == 1:
+        return _run_locked_job(jobs[0])
+
+    job_type = jobs[0].job_type
+    message_type, _ = JOBS[job_type]
+    batch_func, _ = BATCHES[job_type]
+
+    for job in jobs:
+        job.try_count += 1
+        jobs_queued_histogram.observe((now() - job.queued).total_seconds())
+
+    with trace.start_as_current_span(job_type):
+        start = perf_counter_ns()
+        try:
+            errors = batch_func([message_type.FromString(job.payload) for job in jobs])
+        except Exception as e:
+            # the whole batch fell over
+            errors = [e] * len(jobs)
+        finished = perf_counter_ns()
+
+    if len(errors) != len(jobs):
+        # we can't tell which jobs went through, so fail them all rather than silently dropping some
+        e = Exception(f"Batch handler for {job_type} returned {len(errors)} results for {len(jobs)} jobs")
+        errors = [e] * len(jobs)
+
+    # each job gets an even share of the time the batch took
+    duration = (finished - start) / 1e9 / len(jobs)
+    for job, e in zip(jobs, errors, strict=True):
+        if e is None:
+            _job_completed(job, duration)
+        else:
+            _job_errored(job, e, duration)
+
+    if config["IN_TEST"]:
+        for e in errors:
+            if e is not None:
+                raise e
 
 
 def process_job():
@@ -81,58 +193,266 @@ def process_job():
 
         # we've got a lock for a job now, it's "pending" until we commit or the lock is gone
         logger.info(f"Job #{job.id} of type {job.job_type} grabbed")
-        job.try_count += 1
+        if job.job_type in BATCHES:
+            # grab more ready jobs of the same type to run along with it
+            _, batch_size = BATCHES[job.job_type]
+            jobs = [job] + (
+                session.execute(
+                    select(BackgroundJob)
+                    .where(BackgroundJob.ready_for_retry)
+                    .where(BackgroundJob.job_type == job.job_type)
+                    .where(BackgroundJob.id != job.id)
+                    .order_by(BackgroundJob.priority.desc(), BackgroundJob.next_attempt_after.asc())
+                    .limit(batch_size - 1)
+                    .with_for_update(skip_locked=True)
+                )
+                .scalars()
+                .all()
+            )
+            if len(jobs) > 1:
+                background_jobs_got_job_counter.inc(len(jobs) - 1)
+                logger.info(f"Running it along with {len(jobs) - 1} more jobs of the same type")
+            _run_locked_jobs(jobs)
+        else:
+            _run_locked_job(job)
 
-        message_type, func = JOBS[job.job_type]
+        # exiting ctx manager commits and releases the row lock
+    return True
 
-        jobs_queued_histogram.observe((now() - job.queued).total_seconds())
+
+class JobQueueListener:
+    """
+    Lets an idle worker block until a job is queued (queue_job NOTIFYs the job queue channel on commit), instead of
+    polling the database.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(conn, selectors.EVENT_READ)
+        self.woken = False
+        self.spurious_wakeups = 0
+
+    def wait(self, timeout):
+        """
+        Blocks for up to `timeout` seconds, returns True if we got a notification
+        """
+        if self.selector.select(timeout):
+            self.conn.poll()
+        woken = bool(self.conn.notifies)
+        self.conn.notifies.clear()
+        return woken
+
+    def found_job(self):
+        self.woken = False
+        self.spurious_wakeups = 0
+
+    def idle(self):
+        """
+        Called when we looked for a job and found none: waits until there is probably one ready
+        """
+        if self.woken:
+            # we got notified but somebody else got the job first, back off a little so that bursts of notifications
+            # don't have every idle worker hammering the queue at once
+            self.spurious_wakeups += 1
+            background_jobs_spurious_wakeups_counter.inc()
+            backoff = BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF * 2 ** (self.spurious_wakeups - 1)
+            sleep(min(backoff, BACKGROUND_JOB_SPURIOUS_WAKEUP_BACKOFF_MAX).total_seconds())
+        else:
+            self.spurious_wakeups = 0
+        # jobs being retried or with expired leases don't send notifications, so we still poll every so often
+        self.woken = self.wait(BACKGROUND_JOB_WAKEUP_TIMEOUT.total_seconds())
+
+
+def claim_jobs(limit, running=None):
+    """
+    Claims up to `limit` ready jobs in one transaction and returns their ids and types as a list of (id, job_type).
+
+    Claimed jobs are leased: their next_attempt_after is pushed out by BACKGROUND_JOB_LEASE_DURATION so that other
+    workers skip them, and if we die before finishing them, they become ready again once the lease runs out.
+
+    `running` maps job_type to the number of jobs of that type this worker is already running, and is used to respect
+    the per-job-type CONCURRENCY limits.
+    """
+    running = running or {}
+    slots = {job_type: limit - running.get(job_type, 0) for job_type, limit in CONCURRENCY.items()}
+
+    with worker_repeatable_read_session_scope() as session:
+        # same locking trick as in process_job, except we grab several rows at a time
         try:
-            with trace.start_as_current_span(job.job_type) as rollspan:
-                start = perf_counter_ns()
-                ret = func(message_type.FromString(job.payload))
-                finished = perf_counter_ns()
-            job.state = BackgroundJobState.completed
-            observe_in_jobs_duration_histogram(
-                job.job_type, job.state.name, job.try_count, "", (finished - start) / 1e9
+            jobs = (
+                session.execute(
+                    select(BackgroundJob)
+                    .where(BackgroundJob.ready_for_retry)
+                    .where(BackgroundJob.job_type.not_in([job_type for job_type, free in slots.items() if free <= 0]))
+                    .order_by(BackgroundJob.priority.desc(), BackgroundJob.next_attempt_after.asc())
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                )
+                .scalars()
+                .all()
             )
-            logger.info(f"Job #{job.id} complete on try number {job.try_count}")
-        except Exception as e:
-            finished = perf_counter_ns()
-            logger.exception(e)
-            sentry_sdk.set_tag("context", "job")
-            sentry_sdk.set_tag("job", job.job_type)
-            sentry_sdk.capture_exception(e)
-
-            if job.try_count >= job.max_tries:
-                # if we already tried max_tries times, it's permanently failed
-                job.state = BackgroundJobState.failed
-                logger.info(f"Job #{job.id} failed on try number {job.try_count}")
-            else:
-                job.state = BackgroundJobState.error
-                # exponential backoff
-                job.next_attempt_after += timedelta(seconds=15 * (2**job.try_count))
-                logger.info(f"Job #{job.id} error on try number {job.try_count}, next try at {job.next_attempt_after}")
-            observe_in_jobs_duration_histogram(
-                job.job_type, job.state.name, job.try_count, type(e).__name__, (finished - start) / 1e9
+        except sqlalchemy.exc.OperationalError:
+            background_jobs_serialization_errors_counter.inc()
+            logger.debug("Serialization error")
+            return []
+
+        claimed = []
+        for job in jobs:
+            if job.job_type in slots:
+                if slots[job.job_type] <= 0:
+                    # leave it for a later batch, the row lock is released when we commit
+                    continue
+                slots[job.job_type] -= 1
+            job.next_attempt_after = now() + BACKGROUND_JOB_LEASE_DURATION
+            claimed.append((job.id, job.job_type))
+
+    if claimed:
+        background_jobs_got_job_counter.inc(len(claimed))
+        logger.info(f"Claimed {len(claimed)} jobs: {', '.join(f'#{job_id}' for job_id, _ in claimed)}")
+    else:
+        background_jobs_no_jobs_counter.inc()
+        logger.debug("No pending jobs")
+    return claimed
+
+
+# a claimed job is still ours to run unless somebody else grabbed it after our lease ran out and finished it (or used up
+# its tries). Unlike ready_for_retry, this doesn't look at next_attempt_after, which our lease pushed out
+_claimed_job_still_runnable = BackgroundJob.state.in_([BackgroundJobState.pending, BackgroundJobState.error]) & (
+    BackgroundJob.try_count < BackgroundJob.max_tries
+)
+
+
+def process_claimed_job(job_id):
+    """
+    Runs a job previously leased with claim_jobs, in its own transaction.
+    """
+    with worker_repeatable_read_session_scope() as session:
+        job = session.execute(
+            select(BackgroundJob)
+            .where(BackgroundJob.id == job_id)
+            .where(_claimed_job_still_runnable)
+            .with_for_update(skip_locked=True)
+        ).scalar_one_or_none()
+
+        if not job:
+            # somebody else grabbed it after our lease ran out
+            logger.info(f"Claimed job #{job_id} is gone, locked or already done, skipping")
+            return
+
+        # drop the lease, so the backoff on error is counted from now
+        job.next_attempt_after = now()
+        _run_locked_job(job)
+
+
+def process_claimed_jobs(job_ids):
+    """
+    Runs several jobs of the same batchable type previously leased with claim_jobs, together in one transaction.
+    """
+    with worker_repeatable_read_session_scope() as session:
+        jobs = (
+            session.execute(
+                select(BackgroundJob)
+                .where(BackgroundJob.id.in_(job_ids))
+                .where(_claimed_job_still_runnable)
+                .order_by(BackgroundJob.id)
+                .with_for_update(skip_locked=True)
             )
-            # add some info for debugging
-            job.failure_info = traceback.format_exc()
+            .scalars()
+            .all()
+        )
 
-            if config["IN_TEST"]:
-                raise e
+        if len(jobs) < len(job_ids):
+            logger.info(f"{len(job_ids) - len(jobs)} claimed jobs are gone, locked or already done, skipping them")
+        if not jobs:
+            return
+
+        for job in jobs:
+            job.next_attempt_after = now()
+        _run_locked_jobs(jobs)
 
-        # exiting ctx manager commits and releases the row lock
-    return True
+
+def _group_claimed_jobs(claimed):
+    """
+    Splits up claimed jobs into what to run on each thread: lists of up to the batch size of jobs of batchable types,
+    and single jobs otherwise. Returns a list of (job_type, job ids).
+    """
+    groups = []
+    batches = {}
+    for job_id, job_type in claimed:
+        if job_type not in BATCHES:
+            groups.append((job_type, [job_id]))
+            continue
+        _, batch_size = BATCHES[job_type]
+        if job_type not in batches or len(batches[job_type]) >= batch_size:
+            batches[job_type] = []
+            groups.append((job_type, batches[job_type]))
+        batches[job_type].append(job_id)
+    return groups
+
+
+def service_jobs_batched(listener, batch_size, threads):
+    """
+    Service jobs in an infinite loop, claiming up to `batch_size` jobs per transaction and running them on a pool of
+    `threads` threads. Each job commits on its own.
+    """
+    running = Counter()
+    in_flight = {}
+
+    with ThreadPoolExecutor(threads, thread_name_prefix="job") as executor:
+        while True:
+            claimed = []
+            free = threads - len(in_flight)
+            if free > 0:
+                claimed = claim_jobs(min(free, batch_size), running)
+                for job_type, job_ids in _group_claimed_jobs(claimed):
+                    running[job_type] += len(job_ids)
+                    if len(job_ids) == 1:
+                        future = executor.submit(process_claimed_job, job_ids[0])
+                    else:
+                        future = executor.submit(process_claimed_jobs, job_ids)
+                    in_flight[future] = (job_type, len(job_ids))
+
+            if claimed:
+                listener.found_job()
+            elif not in_flight:
+                # nothing found and nothing running, wait for something to be queued
+                listener.idle()
+                continue
+
+            if claimed and len(in_flight) < threads:
+                # there's probably more work queued, go straight back for it
+                continue
+
+            # wait for a slot to free up, but come back for new jobs every second if we have spare threads
+            done, _ = wait(in_flight, timeout=1 if len(in_flight) < threads else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_type, count = in_flight.pop(future)
+                running[job_type] -= count
+                # exceptions are logged and recorded on the job in _run_locked_job, this just surfaces anything else
+                if future.exception():
+                    logger.error("Unhandled exception running claimed job", exc_info=future.exception())
 
 
 def service_jobs():
     """
     Service jobs in an infinite loop
     """
-    while True:
-        # if no job was found, sleep for a second, otherwise query for another job straight away
-        if not process_job():
-            sleep(1)
+    batch_size = config["BACKGROUND_WORKER_BATCH_SIZE"]
+    threads = config["BACKGROUND_WORKER_THREADS"]
+
+    with listen_scope(JOB_QUEUE_CHANNEL) as conn:
+        listener = JobQueueListener(conn)
+
+        if batch_size > 1 or threads > 1:
+            return service_jobs_batched(listener, batch_size, threads)
+
+        while True:
+            # if no job was found, wait until one is queued, otherwise query for another job straight away
+            if process_job():
+                listener.found_job()
+            else:
+                listener.idle()
 
 
 def _run_job_and_schedule(sched, schedule_id):
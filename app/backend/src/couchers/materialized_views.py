@@ -1,19 +1,26 @@
 import logging
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
+from geoalchemy2.types import Geometry
 from google.protobuf import empty_pb2
-from sqlalchemy import Float, Index, Integer, event
+from sqlalchemy import BigInteger, Boolean, Column, Float, Index, Integer, String, Table, event, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import (
-    and_,
-    case,
     cast,
+    column,
+    delete,
     func,
     literal,
     literal_column,
+    or_,
+    true,
+    tuple_,
     union_all,
+    update,
+    values,
 )
 from sqlalchemy.sql import select as sa_select
-from sqlalchemy.sql.functions import percentile_disc
 from sqlalchemy_utils.view import (
     CreateView,
     DropView,
@@ -22,23 +29,44 @@ from sqlalchemy_utils.view import (
     refresh_materialized_view,
 )
 
-from couchers.db import session_scope
+from couchers.constants import (
+    CLUSTERED_USERS_TILES_BATCH_SIZE,
+    CLUSTERED_USERS_TILES_GRID_SIZE,
+    CLUSTERED_USERS_TILES_MAX_ZOOM,
+    LITE_USERS_REFRESH_BATCH_SIZE,
+    USER_RESPONSE_RATES_CHECK_BATCH_SIZE,
+)
+from couchers.db import session_scope, set_watermark
+from couchers.metrics import (
+    lite_users_drift_counter,
+    lite_users_refresh_lag_histogram,
+    materialized_view_refresh_histogram,
+    materialized_view_up_to_date_gauge,
+    user_response_rates_drift_counter,
+)
 from couchers.models import (
-    ActivenessProbe,
-    ActivenessProbeStatus,
     Base,
+    ClusteredUsersDirtyTile,
+    ClusteredUsersPoint,
+    ClusteredUsersTile,
     ClusterRole,
     ClusterSubscription,
-    HostRequest,
-    Message,
-    MessageType,
+    LiteUserChange,
+    MaterializedViewRefresh,
     StrongVerificationAttempt,
     Upload,
     User,
+    UserResponseRate,
 )
+from couchers.response_rates import all_responses, recompute_user_response_rates
+from couchers.utils import now
 
 logger = logging.getLogger(__name__)
 
+# watermarks set to when these were last changed, so that things rendered from them can be cached until then
+LITE_USERS_WATERMARK = "lite_users"
+CLUSTERED_USERS_WATERMARK = "clustered_users"
+
 
 def create_materialized_view_with_different_ddl(
     name, select_selectable, create_selectable, metadata, indexes=None, aliases=None
@@ -107,20 +135,12 @@ cluster_admin_counts = create_materialized_view(
 )
 
 
-def make_lite_users_selectable(create=False):
-    if create:
-        # because this is rendered as a select when emitting the CREATE VIEW, using User.geom would be rendered as
-        # `ST_AsEWKB(users.geom)` instead of the literal column, the following fixes it
-        geom_column = literal_column("users.geom")
-    else:
-        geom_column = User.geom
-
-    strong_verification_subquery = (
-        sa_select(User.id, literal(True).label("true"))
-        .select_from(StrongVerificationAttempt)
+def make_lite_users_selectable():
+    has_strong_verification = (
+        sa_select(StrongVerificationAttempt.id)
+        .where(StrongVerificationAttempt.user_id == User.id)
         .where(StrongVerificationAttempt.has_strong_verification(User))
-        .distinct()
-        .subquery(name="sv_subquery")
+        .exists()
     )
 
     return (
@@ -130,40 +150,39 @@ def make_lite_users_selectable(create=False):
             User.name.label("name"),
             User.city.label("city"),
             User.age.label("age"),
-            geom_column.label("geom"),
+            User.geom.label("geom"),
             User.geom_radius.label("radius"),
             User.is_visible.label("is_visible"),
             Upload.filename.label("avatar_filename"),
             User.has_completed_profile.label("has_completed_profile"),
-            func.coalesce(strong_verification_subquery.c.true, False).label("has_strong_verification"),
+            has_strong_verification.label("has_strong_verification"),
         )
         .select_from(User)
         .outerjoin(Upload, Upload.key == User.avatar_key)
-        .outerjoin(strong_verification_subquery, strong_verification_subquery.c.id == User.id)
     )
 
 
-lite_users_selectable_select = make_lite_users_selectable(create=False)
-lite_users_selectable_create = make_lite_users_selectable(create=True)
+lite_users_selectable = make_lite_users_selectable()
 
-lite_users = create_materialized_view_with_different_ddl(
+# used to be a materialized view, but refreshing that means recomputing every user every time, so this is a table kept
+# up to date incrementally: changes to users are queued in lite_user_changes on flush and applied in the background,
+# see refresh_materialized_views_rapid
+lite_users = Table(
     "lite_users",
-    lite_users_selectable_select,
-    lite_users_selectable_create,
     Base.metadata,
-    [
-        Index("uq_lite_users_id", lite_users_selectable_create.c.id, unique=True),
-        Index(
-            "uq_lite_users_id_visible",
-            lite_users_selectable_create.c.id,
-            postgresql_where=lite_users_selectable_create.c.is_visible,
-        ),
-        Index(
-            "uq_lite_users_username_visible",
-            lite_users_selectable_create.c.username,
-            postgresql_where=lite_users_selectable_create.c.is_visible,
-        ),
-    ],
+    Column("id", BigInteger, primary_key=True, autoincrement=False),
+    Column("username", String),
+    Column("name", String),
+    Column("city", String),
+    Column("age", Float),
+    Column("geom", Geometry(geometry_type="POINT", srid=4326)),
+    Column("radius", Float),
+    Column("is_visible", Boolean),
+    Column("avatar_filename", String),
+    Column("has_completed_profile", Boolean),
+    Column("has_strong_verification", Boolean),
+    Index("uq_lite_users_id_visible", "id", postgresql_where=text("is_visible")),
+    Index("uq_lite_users_username_visible", "username", postgresql_where=text("is_visible")),
 )
 
 
@@ -195,15 +214,17 @@ def make_clustered_users_selectable(create=False):
         centroid_geom = func.ST_Centroid(func.ST_Collect(cluster_cte.c.geom))
         cluster_geom = cluster_cte.c.geom
 
+    # each user is in exactly one row, so the smallest user id in it identifies the row, which refreshing concurrently
+    # needs
     clustered_users = (
-        sa_select(centroid_geom.label("geom"), func.count().label("count"))
+        sa_select(centroid_geom.label("geom"), func.count().label("count"), func.min(cluster_cte.c.id).label("id"))
         .select_from(cluster_cte)
         .where(cluster_cte.c.cluster_id != None)
         .group_by(cluster_cte.c.cluster_id)
     )
 
     isolated_users = (
-        sa_select(cluster_geom.label("geom"), literal(1, type_=Integer).label("count"))
+        sa_select(cluster_geom.label("geom"), literal(1, type_=Integer).label("count"), cluster_cte.c.id.label("id"))
         .select_from(cluster_cte)
         .where(cluster_cte.c.cluster_id == None)
     )
@@ -215,7 +236,11 @@ clustered_users_selectable_select = make_clustered_users_selectable(create=False
 clustered_users_selectable_create = make_clustered_users_selectable(create=True)
 
 clustered_users = create_materialized_view_with_different_ddl(
-    "clustered_users", clustered_users_selectable_select, clustered_users_selectable_create, Base.metadata
+    "clustered_users",
+    clustered_users_selectable_select,
+    clustered_users_selectable_create,
+    Base.metadata,
+    [Index("uq_clustered_users_id", "id", unique=True)],
 )
 
 
@@ -223,73 +248,352 @@ def float_(stmt):
     return func.coalesce(cast(stmt, Float), 0.0)
 
 
-# this subquery gets the time that the request was sent
-t = sa_select(Message.conversation_id, Message.time).where(Message.message_type == MessageType.chat_created).subquery()
-# this subquery gets the time that the user responded to the request
-s = (
-    sa_select(Message.conversation_id, Message.author_id, func.min(Message.time).label("time"))
-    .group_by(Message.conversation_id, Message.author_id)
-    .subquery()
-)
-all_responses = union_all(
-    # host request responses
-    sa_select(
-        HostRequest.host_user_id.label("user_id"),
-        (s.c.time - t.c.time).label("response_time"),
-    )
-    .join(t, t.c.conversation_id == HostRequest.conversation_id)
-    .outerjoin(s, and_(s.c.conversation_id == HostRequest.conversation_id, s.c.author_id == HostRequest.host_user_id)),
-    # activeness probes
-    sa_select(
-        ActivenessProbe.user_id,
-        (
-            # expired probes have a responded time for when they were marked responded
-            case(
-                (
-                    ActivenessProbe.response != ActivenessProbeStatus.expired,
-                    ActivenessProbe.responded - ActivenessProbe.probe_initiated,
-                ),
-                else_=None,
-            )
-        ).label("response_time"),
-    ),
-).subquery()
-
-user_response_rates_selectable = sa_select(
-    all_responses.c.user_id.label("user_id"),
-    # number of requests received
-    func.count().label("requests"),
-    # percentage of requests responded to
-    (func.count(all_responses.c.response_time) / func.count()).label("response_rate"),
-    func.avg(all_responses.c.response_time).label("avg_response_time"),
-    # the 33rd percentile response time
-    percentile_disc(0.33)
-    .within_group(func.coalesce(all_responses.c.response_time, timedelta(days=1000)))
-    .label("response_time_33p"),
-    # the 66th percentile response time
-    percentile_disc(0.66)
-    .within_group(func.coalesce(all_responses.c.response_time, timedelta(days=1000)))
-    .label("response_time_66p"),
-).group_by(all_responses.c.user_id)
-
-user_response_rates = create_materialized_view(
-    "user_response_rates",
-    user_response_rates_selectable,
-    Base.metadata,
-    [Index("uq_user_response_rates_id", user_response_rates_selectable.c.user_id, unique=True)],
-)
+# the tables each materialized view is computed from. The views read users, but only columns that lite_users also
+# follows (geom and visibility), so lite_users stands in for it: users itself changes all the time as people use the app
+MATERIALIZED_VIEW_SOURCES = {
+    "cluster_subscription_counts": ["cluster_subscriptions", "lite_users"],
+    "cluster_admin_counts": ["cluster_subscriptions", "lite_users"],
+    "clustered_users": ["lite_users"],
+}
+
+
+def _source_version(session, tables):
+    """
+    A number that changes whenever rows are inserted, updated or deleted in any of the given tables.
+
+    Comes from the cumulative statistics system, which backends only report to every so often, so a change can show up
+    a little late, in which case the view is refreshed a run later than it could have been.
+    """
+    return session.execute(
+        text(
+            "SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables "
+            "WHERE schemaname = current_schema() AND relname = ANY(:tables)"
+        ),
+        {"tables": tables},
+    ).scalar_one()
+
+
+def _refresh_materialized_view_if_changed(name):
+    """
+    Refreshes the given materialized view in its own transaction, unless its source tables are unchanged since the last
+    refresh
+    """
+    start = perf_counter()
+    with session_scope() as session:
+        session.execute(insert(MaterializedViewRefresh).values(name=name).on_conflict_do_nothing())
+        state = session.execute(
+            sa_select(MaterializedViewRefresh).where(MaterializedViewRefresh.name == name).with_for_update()
+        ).scalar_one()
+        # read before refreshing, so changes made during the refresh get picked up by the next one
+        checked = now()
+        source_version = _source_version(session, MATERIALIZED_VIEW_SOURCES[name])
+        if source_version == state.source_version:
+            outcome = "skipped"
+        else:
+            outcome = "refreshed"
+            refresh_materialized_view(session, name, concurrently=True)
+            state.source_version = source_version
+            state.refreshed = checked
+            if name == "clustered_users":
+                set_watermark(session, CLUSTERED_USERS_WATERMARK, checked)
+        state.checked = checked
+    materialized_view_refresh_histogram.labels(name, outcome).observe(perf_counter() - start)
+    materialized_view_up_to_date_gauge.labels(name).set(checked.timestamp())
+    logger.info(f"Materialized view {name}: {outcome} in {perf_counter() - start:.3f}s")
 
 
 def refresh_materialized_views(payload: empty_pb2.Empty):
+    """
+    Refreshes the materialized views side by side, each on its own connection, so one slow view doesn't hold up (or
+    hold a transaction open for) the others
+    """
     logger.info("Refreshing materialized views")
-    with session_scope() as session:
-        refresh_materialized_view(session, "cluster_subscription_counts", concurrently=True)
-        refresh_materialized_view(session, "cluster_admin_counts", concurrently=True)
-        refresh_materialized_view(session, "clustered_users")
-        refresh_materialized_view(session, "user_response_rates", concurrently=True)
+    with ThreadPoolExecutor(max_workers=len(MATERIALIZED_VIEW_SOURCES)) as executor:
+        futures = [executor.submit(_refresh_materialized_view_if_changed, name) for name in MATERIALIZED_VIEW_SOURCES]
+    # raise the first failure once all views are done, rather than leaving the rest half way
+    for future in futures:
+        future.result()
+
+
+def _recompute_lite_users(session, user_ids):
+    """
+    Recomputes the lite_users rows of the given users, removing those of users that no longer exist
+    """
+    statement = insert(lite_users).from_select(
+        [column.name for column in lite_users.c], lite_users_selectable.where(User.id.in_(user_ids))
+    )
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[lite_users.c.id],
+            set_={column.name: statement.excluded[column.name] for column in lite_users.c if column.name != "id"},
+        )
+    )
+    session.execute(
+        delete(lite_users)
+        .where(lite_users.c.id.in_(user_ids))
+        .where(~sa_select(User.id).where(User.id == lite_users.c.id).exists())
+    )
 
 
 def refresh_materialized_views_rapid(payload: empty_pb2.Empty):
-    logger.info("Refreshing materialized views (rapid)")
+    """
+    Applies the changes queued in lite_user_changes to lite_users
+    """
+    logger.info("Refreshing lite_users")
+    while True:
+        with session_scope() as session:
+            # rows locked by a transaction that's still queueing a change are left for the next run
+            batch = (
+                sa_select(LiteUserChange.user_id)
+                .order_by(LiteUserChange.changed)
+                .limit(LITE_USERS_REFRESH_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            )
+            changes = session.execute(
+                delete(LiteUserChange)
+                .where(LiteUserChange.user_id.in_(batch.scalar_subquery()))
+                .returning(LiteUserChange.user_id, LiteUserChange.changed)
+            ).all()
+            if not changes:
+                return
+            _recompute_lite_users(session, [user_id for user_id, _ in changes])
+            set_watermark(session, LITE_USERS_WATERMARK, now())
+            refreshed = session.execute(sa_select(func.now())).scalar_one()
+
+        for _, changed in changes:
+            lite_users_refresh_lag_histogram.observe((refreshed - changed).total_seconds())
+        logger.info(f"Refreshed {len(changes)} lite_users rows")
+        if len(changes) < LITE_USERS_REFRESH_BATCH_SIZE:
+            return
+
+
+def check_lite_users(payload: empty_pb2.Empty):
+    """
+    Fixes lite_users rows that don't match what they're computed from.
+
+    The change log only sees changes made through the ORM, so this catches what it misses: bulk updates, and rows that
+    change just with time passing (ages on birthdays, passports expiring).
+    """
+    logger.info("Checking lite_users for drift")
     with session_scope() as session:
-        refresh_materialized_view(session, "lite_users", concurrently=True)
+        stale = lite_users_selectable.except_(sa_select(lite_users)).subquery()
+        drifted_ids = set(session.execute(sa_select(stale.c.id)).scalars())
+        drifted_ids.update(
+            session.execute(
+                sa_select(lite_users.c.id).where(~sa_select(User.id).where(User.id == lite_users.c.id).exists())
+            ).scalars()
+        )
+        if drifted_ids:
+            _recompute_lite_users(session, list(drifted_ids))
+            set_watermark(session, LITE_USERS_WATERMARK, now())
+    lite_users_drift_counter.inc(len(drifted_ids))
+    logger.info(f"Fixed {len(drifted_ids)} drifted lite_users rows")
+
+
+def check_user_response_rates(payload: empty_pb2.Empty):
+    """
+    Fixes user_response_rates rows that don't match the requests and responses they're counted from, and fills in any
+    that are missing (which is how they're backfilled).
+
+    Only the counts and total response time are compared: once a sketch has had to merge response times its
+    percentiles are approximate, and recomputing them from scratch would give slightly different ones.
+    """
+    logger.info("Checking user_response_rates for drift")
+    response_time = func.extract("epoch", all_responses.c.response_time)
+    computed = (
+        sa_select(
+            all_responses.c.user_id,
+            func.count().label("requests"),
+            func.count(all_responses.c.response_time).label("responses"),
+            func.coalesce(func.sum(response_time), 0).label("response_time_sum"),
+        )
+        .group_by(all_responses.c.user_id)
+        .subquery()
+    )
+    with session_scope() as session:
+        drifted_ids = (
+            session.execute(
+                sa_select(func.coalesce(computed.c.user_id, UserResponseRate.user_id))
+                .select_from(computed)
+                .join(UserResponseRate, UserResponseRate.user_id == computed.c.user_id, full=True)
+                .where(
+                    or_(
+                        computed.c.user_id == None,
+                        UserResponseRate.user_id == None,
+                        UserResponseRate.requests != computed.c.requests,
+                        UserResponseRate.responses != computed.c.responses,
+                        # the sums are added up in different orders, so don't quite match
+                        func.abs(UserResponseRate.response_time_sum - computed.c.response_time_sum) > 1,
+                    )
+                )
+            )
+            .scalars()
+            .all()
+        )
+    for i in range(0, len(drifted_ids), USER_RESPONSE_RATES_CHECK_BATCH_SIZE):
+        with session_scope() as session:
+            recompute_user_response_rates(
+                session.connection(), drifted_ids[i : i + USER_RESPONSE_RATES_CHECK_BATCH_SIZE]
+            )
+    user_response_rates_drift_counter.inc(len(drifted_ids))
+    logger.info(f"Fixed {len(drifted_ids)} drifted user_response_rates rows")
+
+
+# half the width of the world in web mercator (EPSG:3857) metres, it spans [-this, this] in both directions
+_WEB_MERCATOR_EXTENT = 20037508.342789244
+# web mercator can't represent the poles, the world is cut off square at these latitudes
+_WEB_MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+
+def _to_web_mercator(geom):
+    latitude = func.greatest(func.least(func.ST_Y(geom), _WEB_MERCATOR_MAX_LATITUDE), -_WEB_MERCATOR_MAX_LATITUDE)
+    return func.ST_Transform(func.ST_SetSRID(func.ST_MakePoint(func.ST_X(geom), latitude), 4326), 3857)
+
+
+def _tile_index(distance, z, divisions=1):
+    """
+    Which tile (or cell, when each tile is split into `divisions` cells) along one axis at zoom z contains the point
+    `distance` web mercator metres from the west or north edge of the world
+    """
+    count = func.power(2, z) * divisions
+    return cast(func.least(func.floor(distance / (2 * _WEB_MERCATOR_EXTENT) * count), count - 1), Integer)
+
+
+def _tile_x(geom, z, divisions=1):
+    return _tile_index(func.ST_X(geom) + _WEB_MERCATOR_EXTENT, z, divisions)
+
+
+def _tile_y(geom, z, divisions=1):
+    return _tile_index(_WEB_MERCATOR_EXTENT - func.ST_Y(geom), z, divisions)
+
+
+def _queue_dirty_clustered_users_tiles(session):
+    """
+    Brings clustered_users_points up to date with lite_users, and queues the tiles covering every point that was added,
+    removed or moved, at every zoom.
+
+    This is a single statement so that the diff and the update see the same snapshot and no change slips between them.
+    """
+    points = ClusteredUsersPoint.__table__
+    old_points = points.alias("old_points")
+    current = (
+        sa_select(lite_users.c.id.label("user_id"), _to_web_mercator(lite_users.c.geom).label("geom"))
+        .where(lite_users.c.is_visible)
+        .where(lite_users.c.geom != None)
+        .cte("current")
+    )
+    removed = (
+        delete(points)
+        .where(~sa_select(current.c.user_id).where(current.c.user_id == points.c.user_id).exists())
+        .returning(points.c.geom)
+        .cte("removed")
+    )
+    moved = (
+        update(points)
+        .values(geom=current.c.geom)
+        .where(current.c.user_id == points.c.user_id)
+        .where(old_points.c.user_id == points.c.user_id)
+        .where(current.c.geom.is_distinct_from(points.c.geom))
+        .returning(old_points.c.geom.label("old_geom"), points.c.geom)
+        .cte("moved")
+    )
+    added = (
+        insert(points)
+        .from_select(
+            ["user_id", "geom"],
+            sa_select(current.c.user_id, current.c.geom).where(
+                ~sa_select(points.c.user_id).where(points.c.user_id == current.c.user_id).exists()
+            ),
+        )
+        .returning(points.c.geom)
+        .cte("added")
+    )
+    changed = union_all(
+        sa_select(removed.c.geom),
+        sa_select(moved.c.old_geom),
+        sa_select(moved.c.geom),
+        sa_select(added.c.geom),
+    ).subquery("changed")
+    z = func.generate_series(0, CLUSTERED_USERS_TILES_MAX_ZOOM).column_valued("z")
+    dirty = sa_select(z, _tile_x(changed.c.geom, z), _tile_y(changed.c.geom, z)).distinct()
+    return session.execute(
+        insert(ClusteredUsersDirtyTile).from_select(["z", "x", "y"], dirty).on_conflict_do_nothing()
+    ).rowcount
+
+
+def _build_clustered_users_tiles(tiles):
+    """
+    Statement selecting the (z, x, y, data, etag) of the given tiles, tiles without any users have no clusters to join
+    to and are left out.
+
+    The points in each tile are clustered by snapping them onto a grid aligned with the tile, so that a cluster never
+    straddles two tiles and each tile can be rebuilt on its own (unlike ST_ClusterDBSCAN, which clusters globally).
+    """
+    batch = values(column("z", Integer), column("x", Integer), column("y", Integer), name="batch").data(tiles)
+    envelope = func.ST_TileEnvelope(batch.c.z, batch.c.x, batch.c.y)
+    point = ClusteredUsersPoint.geom
+    clusters = (
+        sa_select(
+            func.ST_AsMVTGeom(func.ST_Centroid(func.ST_Collect(point)), envelope).label("geom"),
+            func.count().label("count"),
+        )
+        .where(point.intersects(envelope))
+        # points on an edge intersect both tiles, but belong to the one below/right of it
+        .where(_tile_x(point, batch.c.z) == batch.c.x)
+        .where(_tile_y(point, batch.c.z) == batch.c.y)
+        .group_by(
+            _tile_x(point, batch.c.z, CLUSTERED_USERS_TILES_GRID_SIZE),
+            _tile_y(point, batch.c.z, CLUSTERED_USERS_TILES_GRID_SIZE),
+        )
+        .lateral("clusters")
+    )
+    tiles = (
+        sa_select(batch.c.z, batch.c.x, batch.c.y, func.ST_AsMVT(clusters.table_valued(), "users").label("data"))
+        .select_from(batch)
+        .join(clusters, true())
+        .group_by(batch.c.z, batch.c.x, batch.c.y)
+        .subquery("tiles")
+    )
+    return sa_select(tiles.c.z, tiles.c.x, tiles.c.y, tiles.c.data, func.md5(tiles.c.data))
+
+
+def update_clustered_users_tiles(payload: empty_pb2.Empty):
+    """
+    Rebuilds the clustered users map tiles whose users have changed since the last run
+    """
+    logger.info("Updating clustered users tiles")
+    with session_scope() as session:
+        queued = _queue_dirty_clustered_users_tiles(session)
+    logger.info(f"Queued {queued} dirty clustered users tiles")
+
+    while True:
+        with session_scope() as session:
+            batch = (
+                sa_select(ClusteredUsersDirtyTile.z, ClusteredUsersDirtyTile.x, ClusteredUsersDirtyTile.y)
+                .limit(CLUSTERED_USERS_TILES_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            )
+            tile_key = tuple_(ClusteredUsersDirtyTile.z, ClusteredUsersDirtyTile.x, ClusteredUsersDirtyTile.y)
+            tiles = [
+                tuple(tile)
+                for tile in session.execute(
+                    delete(ClusteredUsersDirtyTile)
+                    .where(tile_key.in_(batch))
+                    .returning(ClusteredUsersDirtyTile.z, ClusteredUsersDirtyTile.x, ClusteredUsersDirtyTile.y)
+                )
+            ]
+            if not tiles:
+                return
+            session.execute(
+                delete(ClusteredUsersTile).where(
+                    tuple_(ClusteredUsersTile.z, ClusteredUsersTile.x, ClusteredUsersTile.y).in_(tiles)
+                )
+            )
+            session.execute(
+                insert(ClusteredUsersTile).from_select(
+                    ["z", "x", "y", "data", "etag"], _build_clustered_users_tiles(tiles)
+                )
+            )
+        logger.info(f"Rebuilt {len(tiles)} clustered users tiles")
+        if len(tiles) < CLUSTERED_USERS_TILES_BATCH_SIZE:
+            return
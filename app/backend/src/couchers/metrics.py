@@ -15,7 +15,16 @@ from prometheus_client.registry import CollectorRegistry
 from sqlalchemy.sql import func
 
 from couchers.db import session_scope
-from couchers.models import BackgroundJob, EventOccurrenceAttendee, HostingStatus, HostRequest, Message, Reference, User
+from couchers.models import (
+    BackgroundJob,
+    EventOccurrenceAttendee,
+    HostingStatus,
+    HostRequest,
+    LiteUserChange,
+    Message,
+    Reference,
+    User,
+)
 from couchers.sql import couchers_select as select
 
 registry = CollectorRegistry()
@@ -198,6 +207,47 @@ background_jobs_ready_to_execute_gauge = _make_gauge_from_query(
     select(func.count()).select_from(BackgroundJob).where(BackgroundJob.ready_for_retry),
 )
 
+lite_users_pending_changes_gauge = _make_gauge_from_query(
+    "couchers_lite_users_pending_changes",
+    "Number of users whose lite_users row is waiting to be refreshed",
+    select(func.count()).select_from(LiteUserChange),
+)
+
+lite_users_oldest_pending_change_gauge = _make_gauge_from_query(
+    "couchers_lite_users_oldest_pending_change_seconds",
+    "How long the oldest change waiting to be applied to lite_users has been queued",
+    select(func.coalesce(func.extract("epoch", func.now() - func.min(LiteUserChange.changed)), 0)),
+)
+
+lite_users_refresh_lag_histogram = Histogram(
+    "couchers_lite_users_refresh_lag_seconds",
+    "Time between a user changing and their lite_users row being refreshed",
+    buckets=(1, 5, 10, 20, 30, 45, 60, 90, 120, 300, 600, 1800, 3600, _INF),
+)
+
+lite_users_drift_counter = Counter(
+    "couchers_lite_users_drift_total",
+    "Number of lite_users rows found out of date and fixed by the consistency check",
+)
+
+user_response_rates_drift_counter = Counter(
+    "couchers_user_response_rates_drift_total",
+    "Number of user_response_rates rows found out of date and fixed by the consistency check",
+)
+
+materialized_view_refresh_histogram = Histogram(
+    "couchers_materialized_view_refresh_seconds",
+    "Time taken to refresh (or decide to skip refreshing) each materialized view",
+    labelnames=["view", "outcome"],
+)
+
+materialized_view_up_to_date_gauge = Gauge(
+    "couchers_materialized_view_up_to_date_timestamp_seconds",
+    "Unix time each materialized view was last known to be up to date, to measure how stale it is",
+    labelnames=["view"],
+    multiprocess_mode="mostrecent",
+)
+
 background_jobs_serialization_errors_counter = Counter(
     "couchers_background_jobs_serialization_errors_total",
     "Number of times a bg worker has a serialization error",
@@ -208,11 +258,53 @@ background_jobs_no_jobs_counter = Counter(
     "Number of times a bg worker tries to grab a job but there is none",
 )
 
+background_jobs_spurious_wakeups_counter = Counter(
+    "couchers_background_jobs_spurious_wakeups_total",
+    "Number of times an idle bg worker was woken up by a notification but found no job",
+)
+
 background_jobs_got_job_counter = Counter(
     "couchers_background_jobs_got_job_total",
     "Number of times a bg worker grabbed a job",
 )
 
+smtp_connections_counter = Counter(
+    "couchers_smtp_connections_total",
+    "Number of times a pooled SMTP connection was opened, reused or discarded",
+    labelnames=["event"],
+)
+
+
+email_digest_users_counter = Counter(
+    "couchers_email_digest_users_total",
+    "Number of users handle_email_digests has sent a digest to",
+)
+
+email_digest_notifications_counter = Counter(
+    "couchers_email_digest_notifications_total",
+    "Number of notifications handle_email_digests has delivered in digests",
+)
+
+email_digest_users_per_second_gauge = Gauge(
+    "couchers_email_digest_users_per_second",
+    "Users processed per second by the most recent handle_email_digests run",
+    multiprocess_mode="mostrecent",
+)
+
+api_call_logs_dropped_counter = Counter(
+    "couchers_api_call_logs_dropped_total",
+    "Number of api call logs dropped because the queue was full or writing them out failed",
+    labelnames=["method"],
+)
+api_call_logs_sampled_out_counter = Counter(
+    "couchers_api_call_logs_sampled_out_total",
+    "Number of successful api calls not logged due to sampling",
+    labelnames=["method"],
+)
+api_call_logs_written_counter = Counter(
+    "couchers_api_call_logs_written_total",
+    "Number of api call logs written to the database",
+)
 
 signup_initiations_counter = Counter(
     "couchers_signup_initiations_total",
@@ -0,0 +1,85 @@
+"""Keep user response rates up to date incrementally
+
+Revision ID: 0c4e2b9f7a13
+Revises: f1b86d3c7a20
+Create Date: 2025-05-21 09:12:44.160735
+
+The table starts out empty, check_user_response_rates fills it in when the background worker starts.
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0c4e2b9f7a13"
+down_revision = "f1b86d3c7a20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("DROP MATERIALIZED VIEW user_response_rates")
+    op.create_table(
+        "user_response_rates",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("requests", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("responses", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("response_time_sum", sa.Float(), server_default="0", nullable=False),
+        sa.Column("response_time_sketch", sa.ARRAY(sa.Float()), server_default="{}", nullable=False),
+        sa.Column("response_time_sketch_counts", sa.ARRAY(sa.Integer()), server_default="{}", nullable=False),
+        sa.Column("response_rate", sa.Float(), nullable=True),
+        sa.Column("avg_response_time", sa.Interval(), nullable=True),
+        sa.Column("response_time_33p", sa.Interval(), nullable=True),
+        sa.Column("response_time_66p", sa.Interval(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_user_response_rates_user_id_users")),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_user_response_rates")),
+    )
+
+
+def downgrade():
+    op.drop_table("user_response_rates")
+    op.execute(
+        """
+        CREATE MATERIALIZED VIEW user_response_rates AS
+        SELECT anon_1.user_id AS user_id,
+            count(*) AS requests,
+            count(anon_1.response_time) / CAST(count(*) AS NUMERIC) AS response_rate,
+            avg(anon_1.response_time) AS avg_response_time,
+            PERCENTILE_DISC(0.33) WITHIN GROUP (
+                ORDER BY COALESCE(anon_1.response_time, make_interval(secs => (86400000.0)::double precision))
+            ) AS response_time_33p,
+            PERCENTILE_DISC(0.66) WITHIN GROUP (
+                ORDER BY COALESCE(anon_1.response_time, make_interval(secs => (86400000.0)::double precision))
+            ) AS response_time_66p
+        FROM (
+                SELECT host_requests.host_user_id AS user_id,
+                    anon_2.time - anon_3.time AS response_time
+                FROM host_requests
+                    JOIN (
+                        SELECT messages.conversation_id AS conversation_id,
+                            messages.time AS time
+                        FROM messages
+                        WHERE messages.message_type = 'chat_created'
+                    ) AS anon_3 ON anon_3.conversation_id = host_requests.id
+                    LEFT OUTER JOIN (
+                        SELECT messages.conversation_id AS conversation_id,
+                            messages.author_id AS author_id,
+                            min(messages.time) AS time
+                        FROM messages
+                        GROUP BY messages.conversation_id,
+                            messages.author_id
+                    ) AS anon_2 ON anon_2.conversation_id = host_requests.id
+                    AND anon_2.author_id = host_requests.host_user_id
+                UNION ALL
+                SELECT activeness_probes.user_id AS user_id,
+                    CASE
+                        WHEN (activeness_probes.response != 'expired') THEN activeness_probes.responded - activeness_probes.probe_initiated
+                    END AS response_time
+                FROM activeness_probes
+            ) AS anon_1
+        GROUP BY anon_1.user_id;
+
+        CREATE UNIQUE INDEX uq_user_response_rates_id ON user_response_rates(user_id);
+    """
+    )
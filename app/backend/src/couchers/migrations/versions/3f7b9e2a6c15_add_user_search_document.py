@@ -0,0 +1,47 @@
+"""Add trigram indexed search document to users
+
+Revision ID: 3f7b9e2a6c15
+Revises: 8c1e4b7d2f60
+Create Date: 2025-05-08 11:02:47.518336
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f7b9e2a6c15"
+down_revision = "8c1e4b7d2f60"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.add_column(
+        "users",
+        sa.Column(
+            "search_document",
+            sa.String(),
+            sa.Computed(
+                "coalesce(name, '') || ' ' || coalesce(username, '') || ' ' || coalesce(city, '') || ' ' || "
+                "coalesce(hometown, '') || ' ' || coalesce(about_me, '') || ' ' || coalesce(things_i_like, '') || ' ' || "
+                "coalesce(about_place, '') || ' ' || coalesce(additional_information, '')",
+                persisted=True,
+            ),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_users_search_document_trgm",
+        "users",
+        ["search_document"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"search_document": "gin_trgm_ops"},
+    )
+
+
+def downgrade():
+    op.drop_index("ix_users_search_document_trgm", table_name="users", postgresql_using="gin")
+    op.drop_column("users", "search_document")
@@ -0,0 +1,57 @@
+"""Make user_activity lookup index NULLS NOT DISTINCT
+
+Revision ID: 5d2a8f1c9e34
+Revises: a0d344cfb455
+Create Date: 2025-05-02 10:12:41.518203
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5d2a8f1c9e34"
+down_revision = "a0d344cfb455"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # rows with a null ip_address or user_agent could previously be duplicated, merge them before making the index
+    # treat nulls as equal, so that the write-behind activity buffer can upsert on it
+    op.execute(
+        """
+        WITH groups AS (
+            SELECT min(id) AS keep_id, sum(api_calls) AS api_calls, array_agg(id) AS ids
+            FROM user_activity
+            GROUP BY user_id, period, ip_address, user_agent
+            HAVING count(*) > 1
+        ),
+        merged AS (
+            UPDATE user_activity
+            SET api_calls = groups.api_calls
+            FROM groups
+            WHERE user_activity.id = groups.keep_id
+        )
+        DELETE FROM user_activity
+        USING groups
+        WHERE user_activity.id = ANY(groups.ids) AND user_activity.id != groups.keep_id
+        """
+    )
+    op.drop_index("ix_user_activity_user_id_period_ip_address_user_agent", table_name="user_activity")
+    op.create_index(
+        "ix_user_activity_user_id_period_ip_address_user_agent",
+        "user_activity",
+        ["user_id", "period", "ip_address", "user_agent"],
+        unique=True,
+        postgresql_nulls_not_distinct=True,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_user_activity_user_id_period_ip_address_user_agent", table_name="user_activity")
+    op.create_index(
+        "ix_user_activity_user_id_period_ip_address_user_agent",
+        "user_activity",
+        ["user_id", "period", "ip_address", "user_agent"],
+        unique=True,
+    )
@@ -0,0 +1,37 @@
+"""Add indexes for keyset pagination of user and event search
+
+Revision ID: 8c1e4b7d2f60
+Revises: 5d2a8f1c9e34
+Create Date: 2025-05-06 16:41:09.203114
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c1e4b7d2f60"
+down_revision = "5d2a8f1c9e34"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_users_recommendation_score_id_active",
+        "users",
+        ["recommendation_score", "id"],
+        unique=False,
+        postgresql_where=sa.text("NOT is_banned AND NOT is_deleted"),
+    )
+    op.create_index(
+        "ix_event_occurrences_start_time_id",
+        "event_occurrences",
+        [sa.text("lower(during)"), "id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_event_occurrences_start_time_id", table_name="event_occurrences")
+    op.drop_index("ix_users_recommendation_score_id_active", table_name="users")
@@ -0,0 +1,56 @@
+"""Add stored weighted tsvectors for full text search
+
+Revision ID: a4d6c0e83b71
+Revises: 3f7b9e2a6c15
+Create Date: 2025-05-09 14:20:31.774902
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "a4d6c0e83b71"
+down_revision = "3f7b9e2a6c15"
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTORS = {
+    "users": (
+        "setweight(to_tsvector('english', coalesce(username, '') || ' ' || coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(city, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(about_me, '')), 'C') || "
+        "setweight(to_tsvector('english', coalesce(things_i_like, '') || ' ' || coalesce(about_place, '') || ' ' || "
+        "coalesce(additional_information, '')), 'D')"
+    ),
+    "clusters": (
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+    ),
+    "page_versions": (
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(address, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'D')"
+    ),
+    "events": "setweight(to_tsvector('english', coalesce(title, '')), 'A')",
+    "event_occurrences": (
+        "setweight(to_tsvector('english', coalesce(address, '') || ' ' || coalesce(link, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'D')"
+    ),
+}
+
+
+def upgrade():
+    for table, expression in SEARCH_VECTORS.items():
+        op.add_column(
+            table,
+            sa.Column("search_vector", postgresql.TSVECTOR(), sa.Computed(expression, persisted=True), nullable=False),
+        )
+        op.create_index(f"ix_{table}_search_vector", table, ["search_vector"], unique=False, postgresql_using="gin")
+
+
+def downgrade():
+    for table in SEARCH_VECTORS:
+        op.drop_index(f"ix_{table}_search_vector", table_name=table, postgresql_using="gin")
+        op.drop_column(table, "search_vector")
@@ -0,0 +1,39 @@
+"""Add watermarks and geom_last_updated for incremental community memberships
+
+Revision ID: b81f5d3c7a92
+Revises: a4d6c0e83b71
+Create Date: 2025-05-12 10:37:52.061437
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b81f5d3c7a92"
+down_revision = "a4d6c0e83b71"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "watermarks",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("watermark", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("name", name=op.f("pk_watermarks")),
+    )
+    op.add_column(
+        "users",
+        sa.Column("geom_last_updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+    op.add_column(
+        "nodes",
+        sa.Column("geom_last_updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("nodes", "geom_last_updated")
+    op.drop_column("users", "geom_last_updated")
+    op.drop_table("watermarks")
@@ -0,0 +1,44 @@
+"""Add user_nodes, the nodes containing each user's location
+
+Revision ID: c2e8a61f4d07
+Revises: b81f5d3c7a92
+Create Date: 2025-05-13 15:09:26.448120
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c2e8a61f4d07"
+down_revision = "b81f5d3c7a92"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_nodes",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("node_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["node_id"], ["nodes.id"], name=op.f("fk_user_nodes_node_id_nodes"), ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["users.id"], name=op.f("fk_user_nodes_user_id_users"), ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("user_id", "node_id", name=op.f("pk_user_nodes")),
+    )
+    op.create_index("ix_user_nodes_node_id_user_id", "user_nodes", ["node_id", "user_id"], unique=False)
+    op.execute(
+        """
+        INSERT INTO user_nodes (user_id, node_id)
+        SELECT users.id, nodes.id
+        FROM users JOIN nodes ON ST_Contains(nodes.geom, users.geom)
+        """
+    )
+
+
+def downgrade():
+    op.drop_index("ix_user_nodes_node_id_user_id", table_name="user_nodes")
+    op.drop_table("user_nodes")
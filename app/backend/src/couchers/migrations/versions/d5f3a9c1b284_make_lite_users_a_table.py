@@ -0,0 +1,106 @@
+"""Make lite_users an incrementally updated table rather than a materialized view
+
+Revision ID: d5f3a9c1b284
+Revises: c2e8a61f4d07
+Create Date: 2025-05-15 10:41:09.262537
+
+"""
+
+import geoalchemy2
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d5f3a9c1b284"
+down_revision = "c2e8a61f4d07"
+branch_labels = None
+depends_on = None
+
+LITE_USERS_SELECT = """
+    SELECT
+        users.id,
+        users.username,
+        users.name,
+        users.city,
+        date_part('year', age(users.birthdate)) AS age,
+        users.geom,
+        users.geom_radius AS radius,
+        (NOT (users.is_banned OR users.is_deleted)) AS is_visible,
+        uploads.filename AS avatar_filename,
+        ((users.avatar_key IS NOT NULL) AND (character_length(users.about_me) >= 150)) AS has_completed_profile,
+        EXISTS (
+            SELECT strong_verification_attempts.id
+            FROM strong_verification_attempts
+            WHERE
+                strong_verification_attempts.user_id = users.id
+                AND strong_verification_attempts.status = 'succeeded'
+                AND COALESCE(timezone('Etc/UTC', strong_verification_attempts.passport_expiry_date::timestamp without time zone) >= now(), false)
+                AND strong_verification_attempts.passport_date_of_birth = users.birthdate
+                AND (
+                    (users.gender = 'Woman' AND strong_verification_attempts.passport_sex = 'female')
+                    OR (users.gender = 'Man' AND strong_verification_attempts.passport_sex = 'male')
+                    OR strong_verification_attempts.passport_sex = 'unspecified'
+                    OR users.has_passport_sex_gender_exception = true
+                )
+        ) AS has_strong_verification
+    FROM users
+    LEFT OUTER JOIN uploads ON uploads.key = users.avatar_key
+"""
+
+
+def upgrade():
+    op.execute("DROP MATERIALIZED VIEW lite_users")
+    op.create_table(
+        "lite_users",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("username", sa.String(), nullable=True),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("city", sa.String(), nullable=True),
+        sa.Column("age", sa.Float(), nullable=True),
+        sa.Column(
+            "geom",
+            # the spatial index is created explicitly below, so it's there whether or not geoalchemy2 would add it
+            geoalchemy2.types.Geometry(
+                geometry_type="POINT",
+                srid=4326,
+                from_text="ST_GeomFromEWKT",
+                name="geometry",
+                spatial_index=False,
+            ),
+            nullable=True,
+        ),
+        sa.Column("radius", sa.Float(), nullable=True),
+        sa.Column("is_visible", sa.Boolean(), nullable=True),
+        sa.Column("avatar_filename", sa.String(), nullable=True),
+        sa.Column("has_completed_profile", sa.Boolean(), nullable=True),
+        sa.Column("has_strong_verification", sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_lite_users")),
+    )
+    op.execute(f"INSERT INTO lite_users {LITE_USERS_SELECT}")
+    op.create_index("idx_lite_users_geom", "lite_users", ["geom"], unique=False, postgresql_using="gist")
+    op.create_index(
+        "uq_lite_users_id_visible", "lite_users", ["id"], unique=False, postgresql_where=sa.text("is_visible")
+    )
+    op.create_index(
+        "uq_lite_users_username_visible",
+        "lite_users",
+        ["username"],
+        unique=False,
+        postgresql_where=sa.text("is_visible"),
+    )
+    op.create_table(
+        "lite_user_changes",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("changed", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_lite_user_changes")),
+    )
+
+
+def downgrade():
+    op.drop_table("lite_user_changes")
+    op.drop_table("lite_users")
+    op.execute(f"CREATE MATERIALIZED VIEW lite_users AS {LITE_USERS_SELECT}")
+    op.execute("CREATE INDEX idx_lite_users_geom ON lite_users USING gist (geom)")
+    op.execute("CREATE UNIQUE INDEX uq_lite_users_id ON lite_users(id)")
+    op.execute("CREATE INDEX uq_lite_users_id_visible ON lite_users(id) WHERE is_visible")
+    op.execute("CREATE INDEX uq_lite_users_username_visible ON lite_users(username) WHERE is_visible")
@@ -0,0 +1,54 @@
+"""Add incrementally built clustered users map tiles
+
+Revision ID: e7a41c0d9b53
+Revises: d5f3a9c1b284
+Create Date: 2025-05-16 16:27:52.904113
+
+"""
+
+import geoalchemy2
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e7a41c0d9b53"
+down_revision = "d5f3a9c1b284"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # left empty, the first run of the background job finds every user as added and builds all the tiles
+    op.create_table(
+        "clustered_users_points",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "geom",
+            geoalchemy2.types.Geometry(geometry_type="POINT", srid=3857, from_text="ST_GeomFromEWKT", name="geometry"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_clustered_users_points")),
+    )
+    op.create_table(
+        "clustered_users_dirty_tiles",
+        sa.Column("z", sa.Integer(), nullable=False),
+        sa.Column("x", sa.Integer(), nullable=False),
+        sa.Column("y", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("z", "x", "y", name=op.f("pk_clustered_users_dirty_tiles")),
+    )
+    op.create_table(
+        "clustered_users_tiles",
+        sa.Column("z", sa.Integer(), nullable=False),
+        sa.Column("x", sa.Integer(), nullable=False),
+        sa.Column("y", sa.Integer(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.Column("etag", sa.String(), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("z", "x", "y", name=op.f("pk_clustered_users_tiles")),
+    )
+
+
+def downgrade():
+    op.drop_table("clustered_users_tiles")
+    op.drop_table("clustered_users_dirty_tiles")
+    op.drop_table("clustered_users_points")
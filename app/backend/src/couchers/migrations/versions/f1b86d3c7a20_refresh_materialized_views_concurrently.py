@@ -0,0 +1,67 @@
+"""Refresh materialized views concurrently and only when their sources changed
+
+Revision ID: f1b86d3c7a20
+Revises: e7a41c0d9b53
+Create Date: 2025-05-19 10:41:18.336052
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f1b86d3c7a20"
+down_revision = "e7a41c0d9b53"
+branch_labels = None
+depends_on = None
+
+
+def _create_clustered_users(with_id):
+    id_column = ", min(clustered.id) AS id" if with_id else ""
+    isolated_id_column = ", clustered.id AS id" if with_id else ""
+    op.execute(
+        f"""
+        CREATE MATERIALIZED VIEW clustered_users AS
+        WITH clustered AS (
+            SELECT
+                users.id AS id,
+                users.geom AS geom,
+                ST_ClusterDBSCAN(users.geom, 0.15, 5) OVER (ORDER BY users.id) AS cluster_id
+            FROM users
+            WHERE users.geom IS NOT NULL
+        )
+        SELECT
+            ST_Centroid(ST_Collect(clustered.geom)) AS geom,
+            count(*) AS count{id_column}
+        FROM clustered
+        WHERE clustered.cluster_id IS NOT NULL
+        GROUP BY clustered.cluster_id
+        UNION ALL
+        SELECT
+            clustered.geom AS geom,
+            1 AS count{isolated_id_column}
+        FROM clustered
+        WHERE clustered.cluster_id IS NULL;
+        CREATE INDEX idx_clustered_users_geom ON clustered_users USING gist (geom);
+    """
+    )
+
+
+def upgrade():
+    op.execute("DROP MATERIALIZED VIEW clustered_users")
+    _create_clustered_users(with_id=True)
+    op.create_index("uq_clustered_users_id", "clustered_users", ["id"], unique=True)
+    op.create_table(
+        "materialized_view_refreshes",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("source_version", sa.BigInteger(), nullable=True),
+        sa.Column("refreshed", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("checked", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("name", name=op.f("pk_materialized_view_refreshes")),
+    )
+
+
+def downgrade():
+    op.drop_table("materialized_view_refreshes")
+    op.execute("DROP MATERIALIZED VIEW clustered_users")
+    _create_clustered_users(with_id=False)
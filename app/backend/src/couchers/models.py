@@ -8,6 +8,7 @@ from sqlalchemy import (
     Boolean,
     CheckConstraint,
     Column,
+    Computed,
     Date,
     DateTime,
     Enum,
@@ -22,7 +23,7 @@ from sqlalchemy import (
     UniqueConstraint,
 )
 from sqlalchemy import LargeBinary as Binary
-from sqlalchemy.dialects.postgresql import INET, TSTZRANGE, ExcludeConstraint
+from sqlalchemy.dialects.postgresql import INET, TSTZRANGE, TSVECTOR, ExcludeConstraint
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.orm import backref, column_property, declarative_base, deferred, relationship
@@ -56,6 +57,20 @@ meta = MetaData(
 Base = declarative_base(metadata=meta)
 
 
+def _search_vector_sql(A=None, B=None, C=None, D=None):
+    """
+    SQL for a generated tsvector column to run full text search against. Built the same way search used to build them
+    at query time: the columns in each of A, B, C and D (in decreasing order of importance) are joined with spaces,
+    tokenized, and weighted accordingly.
+    """
+    parts = []
+    for weight, columns in zip("ABCD", [A, B, C, D]):
+        if columns:
+            document = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+            parts.append(f"setweight(to_tsvector('english', {document}), '{weight}')")
+    return " || ".join(parts)
+
+
 class HostingStatus(enum.Enum):
     can_host = enum.auto()
     maybe = enum.auto()
@@ -130,6 +145,8 @@ class User(Base):
     geom = Column(Geometry(geometry_type="POINT", srid=4326), nullable=True)
     # their display location (displayed to other users), in meters
     geom_radius = Column(Float, nullable=True)
+    # when geom was last changed, for picking up moved users incrementally
+    geom_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     # the display address (text) shown on their profile
     city = Column(String, nullable=False)
     # "Grew up in" on profile
@@ -177,6 +194,37 @@ class User(Base):
     # "Additional information" under "About Me" tab
     additional_information = Column(String, nullable=True)  # CommonMark without images
 
+    # all the free text fields that user search matches queries against, glued together so that one trigram index can
+    # narrow down substring searches across them
+    search_document = deferred(
+        Column(
+            String,
+            Computed(
+                "coalesce(name, '') || ' ' || coalesce(username, '') || ' ' || coalesce(city, '') || ' ' || "
+                "coalesce(hometown, '') || ' ' || coalesce(about_me, '') || ' ' || coalesce(things_i_like, '') || ' ' || "
+                "coalesce(about_place, '') || ' ' || coalesce(additional_information, '')",
+                persisted=True,
+            ),
+            nullable=False,
+        )
+    )
+    # weighted tsvector for full text search
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                _search_vector_sql(
+                    ["username", "name"],
+                    ["city"],
+                    ["about_me"],
+                    ["things_i_like", "about_place", "additional_information"],
+                ),
+                persisted=True,
+            ),
+            nullable=False,
+        )
+    )
+
     is_banned = Column(Boolean, nullable=False, server_default=text("false"))
     is_deleted = Column(Boolean, nullable=False, server_default=text("false"))
     is_superuser = Column(Boolean, nullable=False, server_default=text("false"))
@@ -310,6 +358,20 @@ class User(Base):
             id,
             postgresql_where=~is_banned & ~is_deleted,
         ),
+        # user search pages through users by recommendation score, then id
+        Index(
+            "ix_users_recommendation_score_id_active",
+            recommendation_score,
+            id,
+            postgresql_where=~is_banned & ~is_deleted,
+        ),
+        Index(
+            "ix_users_search_document_trgm",
+            "search_document",
+            postgresql_using="gin",
+            postgresql_ops={"search_document": "gin_trgm_ops"},
+        ),
+        Index("ix_users_search_vector", "search_vector", postgresql_using="gin"),
         # create index on users(geom, id, username) where not is_banned and not is_deleted and geom is not null;
         Index(
             "ix_users_geom_active",
@@ -1075,7 +1137,7 @@ class UserActivity(Base):
     api_calls = Column(Integer, nullable=False, default=0)
 
     __table_args__ = (
-        # helps look up this tuple quickly
+        # helps look up this tuple quickly, and lets us upsert on it even if ip_address or user_agent is null
         Index(
             "ix_user_activity_user_id_period_ip_address_user_agent",
             user_id,
@@ -1083,6 +1145,7 @@ class UserActivity(Base):
             ip_address,
             user_agent,
             unique=True,
+            postgresql_nulls_not_distinct=True,
         ),
     )
 
@@ -1615,6 +1678,8 @@ class Node(Base):
     # name and description come from official cluster
     parent_node_id = Column(ForeignKey("nodes.id"), nullable=True, index=True)
     geom = deferred(Column(Geometry(geometry_type="MULTIPOLYGON", srid=4326), nullable=False))
+    # when geom was last changed, for picking up moved borders incrementally
+    geom_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
     parent_node = relationship("Node", backref="child_nodes", remote_side="Node.id")
@@ -1629,6 +1694,22 @@ class Node(Base):
     contained_user_ids = association_proxy("contained_users", "id")
 
 
+class UserNode(Base):
+    """
+    Which nodes contain each user's location, i.e. the smallest one and all its ancestors.
+
+    Kept up to date on flush whenever a user's or node's geom changes (see couchers.db), so that looking up the users in
+    a community doesn't need a geometry scan.
+    """
+
+    __tablename__ = "user_nodes"
+
+    user_id = Column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    node_id = Column(ForeignKey("nodes.id", ondelete="CASCADE"), primary_key=True)
+
+    __table_args__ = (Index("ix_user_nodes_node_id_user_id", node_id, user_id),)
+
+
 class Cluster(Base):
     """
     Cluster, administered grouping of content
@@ -1641,6 +1722,10 @@ class Cluster(Base):
     name = Column(String, nullable=False)
     # short description
     description = Column(String, nullable=False)
+    # weighted tsvector for full text search, the main page's version adds the rest
+    search_vector = deferred(
+        Column(TSVECTOR, Computed(_search_vector_sql(["name"], C=["description"]), persisted=True), nullable=False)
+    )
     created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
     is_official_cluster = Column(Boolean, nullable=False, default=False)
@@ -1711,6 +1796,7 @@ class Cluster(Base):
             unique=True,
             postgresql_where=is_official_cluster,
         ),
+        Index("ix_clusters_search_vector", "search_vector", postgresql_using="gin"),
     )
 
 
@@ -1851,6 +1937,15 @@ class PageVersion(Base):
 
     slug = column_property(func.slugify(title))
 
+    # weighted tsvector for full text search
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(_search_vector_sql(["title"], ["address"], D=["content"]), persisted=True),
+            nullable=False,
+        )
+    )
+
     page = relationship("Page", backref="versions", order_by="PageVersion.id")
     editor_user = relationship("User", backref="edited_pages")
     photo = relationship("Upload")
@@ -1861,6 +1956,7 @@ class PageVersion(Base):
             "(geom IS NULL) = (address IS NULL)",
             name="geom_iff_address",
         ),
+        Index("ix_page_versions_search_vector", "search_vector", postgresql_using="gin"),
     )
 
     @property
@@ -1906,6 +2002,8 @@ class Event(Base):
     parent_node_id = Column(ForeignKey("nodes.id"), nullable=False, index=True)
 
     title = Column(String, nullable=False)
+    # weighted tsvector for full text search, occurrences add the rest
+    search_vector = deferred(Column(TSVECTOR, Computed(_search_vector_sql(["title"]), persisted=True), nullable=False))
 
     slug = column_property(func.slugify(title))
 
@@ -1940,6 +2038,7 @@ class Event(Base):
             "(owner_user_id IS NULL) <> (owner_cluster_id IS NULL)",
             name="one_owner",
         ),
+        Index("ix_events_search_vector", "search_vector", postgresql_using="gin"),
     )
 
 
@@ -1964,6 +2063,15 @@ class EventOccurrence(Base):
     # videoconferencing link, etc, must be specified if no geom, otherwise optional
     link = Column(String, nullable=True)
 
+    # weighted tsvector for full text search, on top of the event's
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(_search_vector_sql(B=["address", "link"], D=["content"]), persisted=True),
+            nullable=False,
+        )
+    )
+
     timezone = "Etc/UTC"
 
     # time during which the event takes place; this is a range type (instead of separate start+end times) which
@@ -2000,6 +2108,9 @@ class EventOccurrence(Base):
         ),
         # Can't have overlapping occurrences in the same Event
         ExcludeConstraint(("event_id", "="), ("during", "&&"), name="event_occurrences_event_id_during_excl"),
+        # event search pages through occurrences by start time, then id
+        Index("ix_event_occurrences_start_time_id", func.lower(during), id),
+        Index("ix_event_occurrences_search_vector", "search_vector", postgresql_using="gin"),
     )
 
     @property
@@ -2304,6 +2415,117 @@ class BackgroundJob(Base):
         return f"BackgroundJob(id={self.id}, job_type={self.job_type}, state={self.state}, next_attempt_after={self.next_attempt_after}, try_count={self.try_count}, failure_info={self.failure_info})"
 
 
+class Watermark(Base):
+    """
+    How far an incremental background task has got, so the next run only needs to look at what changed since
+    """
+
+    __tablename__ = "watermarks"
+
+    name = Column(String, primary_key=True)
+    watermark = Column(DateTime(timezone=True), nullable=False)
+
+
+class LiteUserChange(Base):
+    """
+    Users whose lite_users row is out of date, queued on flush (see couchers.db) and applied by a background job.
+
+    Not a foreign key, so that deleted users are queued too.
+    """
+
+    __tablename__ = "lite_user_changes"
+
+    user_id = Column(BigInteger, primary_key=True)
+    # when the oldest pending change was queued, to measure refresh lag
+    changed = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class MaterializedViewRefresh(Base):
+    """
+    When each materialized view was last refreshed and what its source tables looked like then, so refreshes can be
+    skipped while nothing changed (see couchers.materialized_views)
+    """
+
+    __tablename__ = "materialized_view_refreshes"
+
+    name = Column(String, primary_key=True)
+    # sum of the source tables' insert/update/delete counters when last refreshed, null if never refreshed
+    source_version = Column(BigInteger, nullable=True)
+    refreshed = Column(DateTime(timezone=True), nullable=True)
+    # when the view was last found to be up to date, either by refreshing it or by skipping the refresh
+    checked = Column(DateTime(timezone=True), nullable=True)
+
+
+class UserResponseRate(Base):
+    """
+    How often and how quickly each user responds to host requests and activeness probes, kept up to date as requests
+    come in and get responded to (see couchers.response_rates)
+    """
+
+    __tablename__ = "user_response_rates"
+
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+
+    # number of requests received
+    requests = Column(Integer, nullable=False, server_default="0")
+    # number of requests responded to
+    responses = Column(Integer, nullable=False, server_default="0")
+    # total time taken to respond, in seconds
+    response_time_sum = Column(Float, nullable=False, server_default="0")
+    # response times in seconds, sorted, and how many responses each stands for: exact until there are more distinct
+    # response times than fit, after which the closest ones get merged
+    response_time_sketch = Column(ARRAY(Float), nullable=False, server_default="{}")
+    response_time_sketch_counts = Column(ARRAY(Integer), nullable=False, server_default="{}")
+
+    # derived from the above, kept here so they can be read and queried without working them out
+    # fraction of requests responded to
+    response_rate = Column(Float, nullable=True)
+    avg_response_time = Column(Interval, nullable=True)
+    # percentiles of time taken to respond, counting unanswered requests as UNANSWERED_RESPONSE_TIME
+    response_time_33p = Column(Interval, nullable=True)
+    response_time_66p = Column(Interval, nullable=True)
+
+
+class ClusteredUsersPoint(Base):
+    """
+    The visible users' locations (in web mercator) that the clustered users map tiles are currently built from, diffed
+    against lite_users to find which tiles need rebuilding
+    """
+
+    __tablename__ = "clustered_users_points"
+
+    user_id = Column(BigInteger, primary_key=True)
+    geom = Column(Geometry(geometry_type="POINT", srid=3857), nullable=False)
+
+
+class ClusteredUsersDirtyTile(Base):
+    """
+    Clustered users map tiles that need rebuilding
+    """
+
+    __tablename__ = "clustered_users_dirty_tiles"
+
+    z = Column(Integer, primary_key=True)
+    x = Column(Integer, primary_key=True)
+    y = Column(Integer, primary_key=True)
+
+
+class ClusteredUsersTile(Base):
+    """
+    A prebuilt Mapbox Vector Tile of clustered user locations, tiles without any users aren't stored
+    """
+
+    __tablename__ = "clustered_users_tiles"
+
+    z = Column(Integer, primary_key=True)
+    x = Column(Integer, primary_key=True)
+    y = Column(Integer, primary_key=True)
+
+    data = Column(Binary, nullable=False)
+    etag = Column(String, nullable=False)
+    updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
 class NotificationDeliveryType(enum.Enum):
     # send push notification to mobile/web
     push = enum.auto()
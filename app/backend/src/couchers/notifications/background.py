@@ -1,14 +1,21 @@
 import logging
-from pathlib import Path
+from itertools import groupby
+from time import perf_counter
 
 from google.protobuf import empty_pb2
-from jinja2 import Environment, FileSystemLoader
-from sqlalchemy.sql import func
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func, insert, update
 
 from couchers import urls
 from couchers.config import config
+from couchers.constants import EMAIL_DIGEST_CHUNK_SIZE
 from couchers.db import session_scope
 from couchers.email import queue_email
+from couchers.metrics import (
+    email_digest_notifications_counter,
+    email_digest_users_counter,
+    email_digest_users_per_second_gauge,
+)
 from couchers.models import (
     Notification,
     NotificationDelivery,
@@ -17,40 +24,34 @@ from couchers.models import (
     PushNotificationSubscription,
     User,
 )
-from couchers.notifications.push import push_to_user
-from couchers.notifications.push_api import send_push
-from couchers.notifications.render import render_notification
-from couchers.notifications.settings import get_preference
+from couchers.notifications.push import push_to_users
+from couchers.notifications.push_api import send_push, send_pushes
+from couchers.notifications.render import RenderedNotification, render_notification
+from couchers.notifications.settings import get_preferences_many
 from couchers.notifications.unsubscribe import (
     generate_do_not_email,
     generate_unsub_topic_action,
     generate_unsub_topic_key,
 )
 from couchers.sql import couchers_select as select
-from couchers.templates.v2 import add_filters
+from couchers.templates.v2 import render_email
 from couchers.utils import get_tz_as_text, now
 from proto.internal import jobs_pb2
 
 logger = logging.getLogger(__name__)
 
-template_folder = Path(__file__).parent / ".." / ".." / ".." / "templates" / "v2"
-
-loader = FileSystemLoader(template_folder)
-env = Environment(loader=loader, trim_blocks=True)
-
-add_filters(env)
-
 
-def _send_email_notification(session, user: User, notification: Notification):
-    rendered = render_notification(user, notification)
+def _send_email_notification(
+    session, user: User, notification: Notification, rendered: RenderedNotification, year, timezone_display
+):
     template_args = {
         "user": user,
         "time": notification.created,
         **rendered.email_template_args,
     }
 
-    template_args["_year"] = now().year
-    template_args["_timezone_display"] = get_tz_as_text(user.timezone or "Etc/UTC")
+    template_args["_year"] = year
+    template_args["_timezone_display"] = timezone_display
 
     plain_unsub_section = "\n\n---\n\n"
     if rendered.is_critical:
@@ -77,10 +78,7 @@ def _send_email_notification(session, user: User, notification: Notification):
         plain_unsub_section += f"\n\nDo not email me (disables hosting): <{dne_link}>"
         html_unsub_section += f'<br /><a href="{dne_link}">Do not email me (disables hosting)</a>.'
 
-    plain_tmplt = (template_folder / f"{rendered.email_template_name}.txt").read_text()
-    plain = env.from_string(plain_tmplt + plain_unsub_section).render(template_args)
-    html_tmplt = (template_folder / "generated_html" / f"{rendered.email_template_name}.html").read_text()
-    html = env.from_string(html_tmplt.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    plain, html = render_email(rendered.email_template_name, template_args, plain_unsub_section, html_unsub_section)
 
     if user.do_not_email and not rendered.is_critical:
         logger.info(f"Not emailing {user} based on template {rendered.email_template_name} due to emails turned off")
@@ -111,16 +109,16 @@ def _send_email_notification(session, user: User, notification: Notification):
     )
 
 
-def _send_push_notification(session, user: User, notification: Notification):
+def _push_notification_args(user: User, notification: Notification, rendered: RenderedNotification):
+    """
+    The push_to_user arguments for a notification
+    """
     logger.debug(f"Formatting push notification for {user}")
 
-    rendered = render_notification(user, notification)
-
     if not rendered.push_title:
         raise Exception(f"Tried to send push notification to {user} but didn't have push info")
 
-    push_to_user(
-        session,
+    return dict(
         user_id=user.id,
         title=rendered.push_title,
         body=rendered.push_body,
@@ -133,48 +131,139 @@ def _send_push_notification(session, user: User, notification: Notification):
     )
 
 
-def handle_notification(payload: jobs_pb2.HandleNotificationPayload):
-    with session_scope() as session:
-        notification = session.execute(
-            select(Notification).where(Notification.id == payload.notification_id)
-        ).scalar_one()
-
-        # ignore this notification if the user hasn't enabled new notifications
-        user = session.execute(select(User).where(User.id == notification.user_id)).scalar_one()
+def _deliver_notifications(session, notification_ids):
+    """
+    Delivers a batch of notifications according to their users' preferences.
 
-        topic, action = notification.topic_action.unpack()
-        delivery_types = get_preference(session, notification.user.id, notification.topic_action)
-        for delivery_type in delivery_types:
+    Users and their preferences are loaded in bulk, each notification is rendered at most once (for both email and
+    push), the deliveries are recorded with one multi-row INSERT and the pushes are queued in bulk.
+    """
+    notifications = (
+        session.execute(select(Notification).where(Notification.id.in_(notification_ids)).order_by(Notification.id))
+        .scalars()
+        .all()
+    )
+    if len(notifications) != len(set(notification_ids)):
+        raise Exception(f"Notifications not found: {set(notification_ids) - {n.id for n in notifications}}")
+    user_ids = {notification.user_id for notification in notifications}
+    users = {user.id: user for user in session.execute(select(User).where(User.id.in_(user_ids))).scalars().all()}
+    preferences = get_preferences_many(session, user_ids)
+
+    # the same for everyone, or for everyone in the same timezone
+    year = now().year
+    timezone_displays = {}
+
+    deliveries = []
+    pushes = []
+    for notification in notifications:
+        user = users[notification.user_id]
+        rendered = None
+        for delivery_type in preferences[user.id][notification.topic_action]:
             logger.info(f"Should notify by {delivery_type}")
+            deliveries.append(
+                {
+                    "notification_id": notification.id,
+                    # digests are delivered later, by handle_email_digests
+                    "delivered": None if delivery_type == NotificationDeliveryType.digest else func.now(),
+                    "delivery_type": delivery_type,
+                }
+            )
+            if delivery_type == NotificationDeliveryType.digest:
+                continue
+            if not rendered:
+                rendered = render_notification(user, notification)
             if delivery_type == NotificationDeliveryType.email:
-                # for emails we don't deliver straight up, wait until the email background worker gets around to it and handles deduplication
-                session.add(
-                    NotificationDelivery(
-                        notification_id=notification.id,
-                        delivered=func.now(),
-                        delivery_type=NotificationDeliveryType.email,
-                    )
-                )
-                _send_email_notification(session, user, notification)
-            elif delivery_type == NotificationDeliveryType.digest:
-                # for digest notifications, add to digest queue
-                session.add(
-                    NotificationDelivery(
-                        notification_id=notification.id,
-                        delivered=None,
-                        delivery_type=NotificationDeliveryType.digest,
-                    )
-                )
+                timezone = user.timezone or "Etc/UTC"
+                if timezone not in timezone_displays:
+                    timezone_displays[timezone] = get_tz_as_text(timezone)
+                _send_email_notification(session, user, notification, rendered, year, timezone_displays[timezone])
             elif delivery_type == NotificationDeliveryType.push:
                 # for push notifications, we send them straight away
-                session.add(
-                    NotificationDelivery(
-                        notification_id=notification.id,
-                        delivered=func.now(),
-                        delivery_type=NotificationDeliveryType.push,
-                    )
-                )
-                _send_push_notification(session, user, notification)
+                pushes.append(_push_notification_args(user, notification, rendered))
+
+    if deliveries:
+        session.execute(insert(NotificationDelivery).values(deliveries))
+    push_to_users(session, pushes)
+
+
+def handle_notification(payload: jobs_pb2.HandleNotificationPayload):
+    with session_scope() as session:
+        _deliver_notifications(session, [payload.notification_id])
+
+
+def handle_notifications(payloads: list[jobs_pb2.HandleNotificationPayload]):
+    """
+    Delivers the notifications for a batch of handle_notification jobs together, and returns for each either None if
+    it was delivered or the exception if it failed
+    """
+    try:
+        with session_scope() as session:
+            _deliver_notifications(session, [payload.notification_id for payload in payloads])
+        return [None] * len(payloads)
+    except Exception as e:
+        logger.warning("Failed to deliver a batch of notifications, falling back to one at a time", exc_info=e)
+
+    errors = []
+    for payload in payloads:
+        try:
+            handle_notification(payload)
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+
+def _get_push_subscription(session, payload: jobs_pb2.SendRawPushNotificationPayload):
+    """
+    The subscription to send the push to, or None if it's disabled
+    """
+    if len(payload.data) > 3072:
+        raise Exception(f"Data too long for push notification to sub {payload.push_notification_subscription_id}")
+    sub = session.execute(
+        select(PushNotificationSubscription).where(
+            PushNotificationSubscription.id == payload.push_notification_subscription_id
+        )
+    ).scalar_one()
+    if sub.disabled_at < now():
+        logger.error(f"Tried to send push to disabled subscription: {sub.id}. Disabled at {sub.disabled_at}.")
+        return None
+    return sub
+
+
+def _push_args(payload: jobs_pb2.SendRawPushNotificationPayload, sub: PushNotificationSubscription):
+    return dict(
+        data=payload.data,
+        endpoint=sub.endpoint,
+        auth_key=sub.auth_key,
+        receiver_key=sub.p256dh_key,
+        vapid_sub=config["PUSH_NOTIFICATIONS_VAPID_SUBJECT"],
+        vapid_private_key=config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"],
+        ttl=payload.ttl,
+    )
+
+
+def _record_push_attempt(session, sub: PushNotificationSubscription, resp):
+    """
+    Records how sending a push went, disabling the subscription if it's gone and raising if it otherwise failed
+    """
+    success = resp.status_code in [200, 201, 202]
+    session.add(
+        PushNotificationDeliveryAttempt(
+            push_notification_subscription_id=sub.id,
+            success=success,
+            status_code=resp.status_code,
+            response=resp.text,
+        )
+    )
+    session.commit()
+    if success:
+        logger.debug(f"Successfully sent push to sub {sub.id} for user {sub.user}")
+    elif resp.status_code == 410:
+        # gone
+        logger.info(f"Push sub {sub.id} for user {sub.user} is gone! Disabling.")
+        sub.disabled_at = func.now()
+    else:
+        raise Exception(f"Failed to deliver push to {sub.id}, code: {resp.status_code}. Response: {resp.text}")
 
 
 def send_raw_push_notification(payload: jobs_pb2.SendRawPushNotificationPayload):
@@ -182,44 +271,107 @@ def send_raw_push_notification(payload: jobs_pb2.SendRawPushNotificationPayload)
         logger.info("Not sending push notification due to push notifications disabled")
 
     with session_scope() as session:
-        if len(payload.data) > 3072:
-            raise Exception(f"Data too long for push notification to sub {payload.push_notification_subscription_id}")
-        sub = session.execute(
-            select(PushNotificationSubscription).where(
-                PushNotificationSubscription.id == payload.push_notification_subscription_id
-            )
-        ).scalar_one()
-        if sub.disabled_at < now():
-            logger.error(f"Tried to send push to disabled subscription: {sub.id}. Disabled at {sub.disabled_at}.")
+        sub = _get_push_subscription(session, payload)
+        if not sub:
             return
         # this of requests.response
-        resp = send_push(
-            payload.data,
-            sub.endpoint,
-            sub.auth_key,
-            sub.p256dh_key,
-            config["PUSH_NOTIFICATIONS_VAPID_SUBJECT"],
-            config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"],
-            ttl=payload.ttl,
+        resp = send_push(**_push_args(payload, sub))
+        _record_push_attempt(session, sub, resp)
+
+
+def send_raw_push_notifications(payloads: list[jobs_pb2.SendRawPushNotificationPayload]):
+    """
+    Sends the pushes for a batch of send_raw_push_notification jobs concurrently, and returns for each either None if it
+    was sent or the exception if it failed
+    """
+    if not config["PUSH_NOTIFICATIONS_ENABLED"]:
+        logger.info("Not sending push notifications due to push notifications disabled")
+
+    errors = [None] * len(payloads)
+    with session_scope() as session:
+        to_send = []
+        for i, payload in enumerate(payloads):
+            try:
+                sub = _get_push_subscription(session, payload)
+            except Exception as e:
+                errors[i] = e
+                continue
+            if sub:
+                to_send.append((i, payload, sub))
+
+        results = send_pushes([_push_args(payload, sub) for _, payload, sub in to_send])
+
+        for (i, _, sub), resp in zip(to_send, results):
+            if isinstance(resp, Exception):
+                errors[i] = resp
+                continue
+            try:
+                _record_push_attempt(session, sub, resp)
+            except Exception as e:
+                errors[i] = e
+    return errors
+
+
+def _pending_digests():
+    """
+    Every undelivered digest notification delivery of users due a digest, ordered by user and then by time, as
+    (user_id, notification_delivery_id) rows
+
+    A user is due a digest if their digest frequency has passed since the last one and they have at least one digest
+    notification that hasn't had an individual email sent about it already.
+    """
+    new_notification = aliased(Notification)
+    new_delivery = aliased(NotificationDelivery)
+    email_delivery = aliased(NotificationDelivery)
+    users_with_new_notifications = (
+        select(new_notification.user_id)
+        .join(new_delivery, new_delivery.notification_id == new_notification.id)
+        .where(new_delivery.delivery_type == NotificationDeliveryType.digest)
+        .where(new_delivery.delivered == None)
+        .where(
+            ~select(email_delivery.id)
+            .where(email_delivery.notification_id == new_notification.id)
+            .where(email_delivery.delivery_type == NotificationDeliveryType.email)
+            .where(email_delivery.delivered != None)
+            .exists()
         )
-        success = resp.status_code in [200, 201, 202]
-        session.add(
-            PushNotificationDeliveryAttempt(
-                push_notification_subscription_id=sub.id,
-                success=success,
-                status_code=resp.status_code,
-                response=resp.text,
-            )
+    )
+    return (
+        select(Notification.user_id, NotificationDelivery.id.label("notification_delivery_id"))
+        .join(NotificationDelivery, NotificationDelivery.notification_id == Notification.id)
+        .join(User, User.id == Notification.user_id)
+        .where(User.digest_frequency != None)
+        # todo: tz
+        .where(User.last_digest_sent < func.now() - User.digest_frequency)
+        .where(NotificationDelivery.delivery_type == NotificationDeliveryType.digest)
+        .where(NotificationDelivery.delivered == None)
+        .where(Notification.user_id.in_(users_with_new_notifications))
+        .order_by(Notification.user_id, Notification.created, NotificationDelivery.id)
+    )
+
+
+def _mark_digests_sent(digests):
+    """
+    Marks a chunk of digests as sent, given as a list of (user_id, notification delivery ids), with one UPDATE for the
+    deliveries and one for the users
+    """
+    delivery_ids = [delivery_id for _, user_delivery_ids in digests for delivery_id in user_delivery_ids]
+    with session_scope() as session:
+        session.execute(
+            update(NotificationDelivery)
+            .where(NotificationDelivery.id.in_(delivery_ids))
+            .where(NotificationDelivery.delivered == None)
+            .values(delivered=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(
+            update(User)
+            .where(User.id.in_([user_id for user_id, _ in digests]))
+            .values(last_digest_sent=func.now())
+            .execution_options(synchronize_session=False)
         )
-        session.commit()
-        if success:
-            logger.debug(f"Successfully sent push to sub {sub.id} for user {sub.user}")
-        elif resp.status_code == 410:
-            # gone
-            logger.info(f"Push sub {sub.id} for user {sub.user} is gone! Disabling.")
-            sub.disabled_at = func.now()
-        else:
-            raise Exception(f"Failed to deliver push to {sub.id}, code: {resp.status_code}. Response: {resp.text}")
+    email_digest_users_counter.inc(len(digests))
+    email_digest_notifications_counter.inc(len(delivery_ids))
 
 
 def handle_email_digests(payload: empty_pb2.Empty):
@@ -231,64 +383,29 @@ def handle_email_digests(payload: empty_pb2.Empty):
     If a digest is sent, then we send out every notification that has type digest, regardless of if they already got another type of notification about it.
 
     That is, we don't send out an email unless there's something new, but if we do send one out, we send new and old stuff.
+
+    The pending digests are streamed from one query through a server-side cursor, a user at a time, and marked sent
+    EMAIL_DIGEST_CHUNK_SIZE users at a time in their own transactions, so memory use doesn't grow with the backlog.
     """
     logger.info("Sending out email digests")
 
+    start = perf_counter()
+    users = 0
+    chunk = []
     with session_scope() as session:
-        # already sent email notifications
-        delivered_email_notifications = (
-            select(
-                Notification.id.label("notification_id"),
-                # min is superfluous but needed for group_by
-                func.min(NotificationDelivery.id).label("notification_delivery_id"),
-            )
-            .join(NotificationDelivery, NotificationDelivery.notification_id == Notification.id)
-            .where(NotificationDelivery.delivery_type == NotificationDeliveryType.email)
-            .where(NotificationDelivery.delivered != None)
-            .group_by(Notification)
-            .subquery()
-        )
-
-        # users who have unsent "digest" type notifications but not sent email notifications
-        users_to_send_digests_to = (
-            session.execute(
-                select(User)
-                .where(User.digest_frequency != None)
-                .where(User.last_digest_sent < func.now() - User.digest_frequency)
-                # todo: tz
-                .join(Notification, Notification.user_id == User.id)
-                .join(NotificationDelivery, NotificationDelivery.notification_id == Notification.id)
-                .where(NotificationDelivery.delivery_type == NotificationDeliveryType.digest)
-                .where(NotificationDelivery.delivered == None)
-                .outerjoin(
-                    delivered_email_notifications,
-                    delivered_email_notifications.c.notification_id == Notification.id,
-                )
-                .where(delivered_email_notifications.c.notification_delivery_id == None)
-                .group_by(User)
-            )
-            .scalars()
-            .all()
-        )
-
-        logger.info(f"{users_to_send_digests_to=}")
-
-        for user in users_to_send_digests_to:
-            # digest notifications that haven't been delivered yet
-            notifications_and_deliveries = session.execute(
-                select(Notification, NotificationDelivery)
-                .join(NotificationDelivery, NotificationDelivery.notification_id == Notification.id)
-                .where(NotificationDelivery.delivery_type == NotificationDeliveryType.digest)
-                .where(NotificationDelivery.delivered == None)
-                .where(Notification.user_id == user.id)
-                .order_by(Notification.created)
-            ).all()
-
-            if notifications_and_deliveries:
-                notifications, deliveries = zip(*notifications_and_deliveries)
-                logger.info(f"Sending {user.id=} a digest with {len(notifications)} notifications")
-                logger.info("TODO: supposed to send digest email")
-                for delivery in deliveries:
-                    delivery.delivered = func.now()
-                user.last_digest_sent = func.now()
-            session.commit()
+        rows = session.execute(_pending_digests().execution_options(yield_per=EMAIL_DIGEST_CHUNK_SIZE))
+        for user_id, user_rows in groupby(rows, key=lambda row: row.user_id):
+            delivery_ids = [row.notification_delivery_id for row in user_rows]
+            logger.info(f"Sending {user_id=} a digest with {len(delivery_ids)} notifications")
+            logger.info("TODO: supposed to send digest email")
+            chunk.append((user_id, delivery_ids))
+            users += 1
+            if len(chunk) >= EMAIL_DIGEST_CHUNK_SIZE:
+                _mark_digests_sent(chunk)
+                chunk = []
+    if chunk:
+        _mark_digests_sent(chunk)
+
+    duration_s = perf_counter() - start
+    email_digest_users_per_second_gauge.set(users / duration_s)
+    logger.info(f"Sent {users} email digests in {duration_s:.1f}s")
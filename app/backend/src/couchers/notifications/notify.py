@@ -1,8 +1,9 @@
 import logging
 
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import insert
 
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import BULK_INSERT_CHUNK_SIZE, queue_job, queue_jobs_bulk
 from couchers.models import Notification
 from couchers.notifications.utils import enum_from_topic_action
 from proto.internal import jobs_pb2
@@ -51,3 +52,51 @@ def notify(
             notification_id=notification.id,
         ),
     )
+
+
+def notify_many(
+    session,
+    *,
+    recipients,
+    topic_action,
+    key="",
+):
+    """
+    Like notify, but for fanning out one kind of notification to many users at once.
+
+    `recipients` is a list of (user_id, data) tuples. The notifications and their handle_notification jobs are
+    inserted with multi-row INSERTs rather than one round trip each.
+    """
+    if not recipients:
+        return
+
+    logger.info(f"Generating {len(recipients)} notifications of type {topic_action}")
+    topic, action = topic_action.split(":")
+
+    rows = [
+        {
+            "user_id": user_id,
+            "topic_action": enum_from_topic_action[topic, action],
+            "key": key,
+            "data": (data or empty_pb2.Empty()).SerializeToString(),
+        }
+        for user_id, data in recipients
+    ]
+
+    notification_ids = []
+    for i in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        notification_ids += (
+            session.execute(
+                insert(Notification).values(rows[i : i + BULK_INSERT_CHUNK_SIZE]).returning(Notification.id)
+            )
+            .scalars()
+            .all()
+        )
+
+    queue_jobs_bulk(
+        session,
+        job_type="handle_notification",
+        payloads=[
+            jobs_pb2.HandleNotificationPayload(notification_id=notification_id) for notification_id in notification_ids
+        ],
+    )
@@ -5,7 +5,7 @@ from sqlalchemy.sql import func
 
 from couchers import urls
 from couchers.config import config
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import queue_job, queue_jobs_bulk
 from couchers.models import PushNotificationSubscription
 from couchers.notifications.push_api import get_vapid_public_key_from_private_key
 from couchers.sql import couchers_select as select
@@ -17,6 +17,35 @@ def get_vapid_public_key():
     return get_vapid_public_key_from_private_key(config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"])
 
 
+def _push_payload(
+    *,
+    push_notification_subscription_id: int,
+    user_id: int,
+    topic_action: str,
+    key: str = None,
+    title: str,
+    body: str,
+    icon: str = None,
+    url: str = None,
+    ttl: int = 0,
+):
+    return jobs_pb2.SendRawPushNotificationPayload(
+        data=json.dumps(
+            {
+                "title": config["NOTIFICATION_PREFIX"] + title[:500],
+                "body": body[:2000],
+                "icon": icon or urls.icon_url(),
+                "url": url,
+                "user_id": user_id,
+                "topic_action": topic_action,
+                "key": key or "",
+            }
+        ).encode("utf8"),
+        push_notification_subscription_id=push_notification_subscription_id,
+        ttl=ttl,
+    )
+
+
 def push_to_subscription(
     session,
     *,
@@ -33,19 +62,15 @@ def push_to_subscription(
     queue_job(
         session,
         job_type="send_raw_push_notification",
-        payload=jobs_pb2.SendRawPushNotificationPayload(
-            data=json.dumps(
-                {
-                    "title": config["NOTIFICATION_PREFIX"] + title[:500],
-                    "body": body[:2000],
-                    "icon": icon or urls.icon_url(),
-                    "url": url,
-                    "user_id": user_id,
-                    "topic_action": topic_action,
-                    "key": key or "",
-                }
-            ).encode("utf8"),
+        payload=_push_payload(
             push_notification_subscription_id=push_notification_subscription_id,
+            user_id=user_id,
+            topic_action=topic_action,
+            key=key,
+            title=title,
+            body=body,
+            icon=icon,
+            url=url,
             ttl=ttl,
         ),
         priority=7,
@@ -106,3 +131,37 @@ def push_to_user(
         url=url,
         ttl=ttl,
     )
+
+
+def _push_to_users(session, pushes):
+    """
+    Same as above but for a list of pushes to different users, with one query for everyone's subscriptions
+    """
+    if not pushes:
+        return
+    sub_ids_by_user = {}
+    for sub_id, user_id in session.execute(
+        select(PushNotificationSubscription.id, PushNotificationSubscription.user_id)
+        .where(PushNotificationSubscription.user_id.in_({push["user_id"] for push in pushes}))
+        .where(PushNotificationSubscription.disabled_at > func.now())
+    ).all():
+        sub_ids_by_user.setdefault(user_id, []).append(sub_id)
+    queue_jobs_bulk(
+        session,
+        job_type="send_raw_push_notification",
+        payloads=[
+            _push_payload(push_notification_subscription_id=sub_id, **push)
+            for push in pushes
+            for sub_id in sub_ids_by_user.get(push["user_id"], [])
+        ],
+        priority=7,
+    )
+
+
+def push_to_users(session, pushes):
+    """
+    Like push_to_user, but for a list of dicts of its keyword arguments, queued in bulk.
+
+    This indirection is so that this can be easily mocked too.
+    """
+    _push_to_users(session, pushes)
@@ -1,4 +1,8 @@
+import functools
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from time import time
 from urllib.parse import urlparse
 
@@ -7,11 +11,22 @@ import requests
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from py_vapid import Vapid
+from requests.adapters import HTTPAdapter
 
+from couchers.constants import PUSH_BATCH_CONCURRENCY, PUSH_VAPID_EXPIRY, PUSH_VAPID_REFRESH_MARGIN
 from couchers.crypto import b64decode_unpadded, b64encode_unpadded
 
 logger = logging.getLogger(__name__)
 
+# (push service origin, vapid sub, vapid private key) -> (authorization header, expiry unix time)
+_vapid_authorization_cache = {}
+_vapid_authorization_lock = Lock()
+
+# push service origin -> requests.Session, so connections to each push service are kept alive and reused
+_sessions = {}
+_sessions_lock = Lock()
+_sessions_pid = os.getpid()
+
 
 def gen_vapid_keys():
     prv_key = ec.generate_private_key(ec.SECP256R1())
@@ -28,14 +43,58 @@ def get_vapid_public_key_from_private_key(private):
     )
 
 
-def generate_vapid_authorization(endpoint, vapid_sub, vapid_private_key):
+@functools.cache
+def _get_vapid(vapid_private_key):
+    return Vapid.from_string(private_key=vapid_private_key)
+
+
+def _origin(endpoint):
     url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def generate_vapid_authorization(endpoint, vapid_sub, vapid_private_key):
+    """
+    The signed VAPID authorization header for sending to the given push endpoint.
+
+    Headers are only scoped to the push service, not the subscription, so they're cached per push service origin and
+    reused until shortly before they expire.
+    """
+    origin = _origin(endpoint)
+    cache_key = (origin, vapid_sub, vapid_private_key)
+    with _vapid_authorization_lock:
+        cached = _vapid_authorization_cache.get(cache_key)
+    if cached and cached[1] - time() > PUSH_VAPID_REFRESH_MARGIN.total_seconds():
+        return cached[0]
+
+    exp = int(time() + PUSH_VAPID_EXPIRY.total_seconds())
     vapid_claim = {
         "sub": vapid_sub,
-        "aud": f"{url.scheme}://{url.netloc}",
-        "exp": int(time()) + (12 * 60 * 60),
+        "aud": origin,
+        "exp": exp,
     }
-    return Vapid.from_string(private_key=vapid_private_key).sign(vapid_claim)["Authorization"]
+    authorization = _get_vapid(vapid_private_key).sign(vapid_claim)["Authorization"]
+    with _vapid_authorization_lock:
+        _vapid_authorization_cache[cache_key] = (authorization, exp)
+    return authorization
+
+
+def _get_session(origin):
+    """
+    The keep-alive HTTP session for sending to the given push service
+    """
+    global _sessions_pid
+    with _sessions_lock:
+        if os.getpid() != _sessions_pid:
+            # we've been forked, the connections belong to the parent
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if origin not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=PUSH_BATCH_CONCURRENCY)
+            session.mount(origin, adapter)
+            _sessions[origin] = session
+        return _sessions[origin]
 
 
 def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_key, ttl=0):
@@ -46,6 +105,7 @@ def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_k
         "ttl": str(ttl),
     }
 
+    # the ephemeral key is part of the message encryption and has to be fresh for each message
     encrypted = http_ece.encrypt(
         data,
         private_key=ec.generate_private_key(ec.SECP256R1()),
@@ -53,7 +113,7 @@ def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_k
         dh=receiver_key,
     )
 
-    return requests.post(
+    return _get_session(_origin(endpoint)).post(
         endpoint,
         timeout=20,
         data=encrypted,
@@ -61,6 +121,28 @@ def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_k
     )
 
 
+def send_pushes(pushes):
+    """
+    Sends several pushes at the same time, over the kept alive connections to each push service. Takes a list of dicts
+    of arguments to send_push.
+
+    Returns a list with, for each push, either the requests.Response or the exception if it couldn't be sent.
+    """
+
+    def send(push_args):
+        try:
+            return send_push(**push_args)
+        except Exception as e:
+            logger.warning(f"Failed to send push to {push_args['endpoint'][:20]}...", exc_info=e)
+            return e
+
+    if len(pushes) <= 1:
+        return [send(push_args) for push_args in pushes]
+
+    with ThreadPoolExecutor(min(len(pushes), PUSH_BATCH_CONCURRENCY), thread_name_prefix="push") as executor:
+        return list(executor.map(send, pushes))
+
+
 def decode_key(value):
     return b64decode_unpadded(value.encode())
 
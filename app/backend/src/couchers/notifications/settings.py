@@ -1,8 +1,8 @@
 import logging
 
-from couchers.db import session_scope
+from couchers.cache import TTLCache, invalidate_on_commit, pending_invalidations
+from couchers.constants import NOTIFICATION_PREFERENCE_CACHE_SIZE, NOTIFICATION_PREFERENCE_CACHE_TTL
 from couchers.models import (
-    NotificationDelivery,
     NotificationDeliveryType,
     NotificationPreference,
     NotificationTopicAction,
@@ -14,6 +14,81 @@ from proto import notifications_pb2
 logger = logging.getLogger(__name__)
 
 
+def _resolve_preferences(overrides):
+    """
+    Resolves a dict of (topic_action, delivery_type) -> deliver overrides against the defaults, into a dict of
+    topic_action -> list of delivery types
+    """
+    return {
+        topic_action: [
+            dt for dt in NotificationDeliveryType if overrides.get((topic_action, dt), dt in topic_action.defaults)
+        ]
+        for topic_action in NotificationTopicAction
+    }
+
+
+# shared by everyone who hasn't changed any of their settings
+_default_preferences = _resolve_preferences({})
+
+
+def _load_preferences_many(session, user_ids):
+    overrides = {user_id: {} for user_id in user_ids}
+    for res in (
+        session.execute(select(NotificationPreference).where(NotificationPreference.user_id.in_(user_ids)))
+        .scalars()
+        .all()
+    ):
+        overrides[res.user_id][res.topic_action, res.delivery_type] = res.deliver
+    return {
+        user_id: _resolve_preferences(user_overrides) if user_overrides else _default_preferences
+        for user_id, user_overrides in overrides.items()
+    }
+
+
+# user_id -> resolved preferences. Dropped for a user as soon as a transaction in this process that changed their
+# preferences commits. Changes made in other processes (e.g. a user turning something off through the API while a
+# background worker is delivering their notifications) are only picked up once the TTL runs out, which we accept so that
+# delivering a notification doesn't need a query for the recipient's preferences
+notification_preference_cache = TTLCache(NOTIFICATION_PREFERENCE_CACHE_TTL, NOTIFICATION_PREFERENCE_CACHE_SIZE)
+
+
+def get_preferences(session, user_id: int) -> dict[NotificationTopicAction, list[NotificationDeliveryType]]:
+    """
+    Gets all of the user's preferences, their overrides from the DB resolved against the defaults
+
+    Must be done in session scope
+
+    Returns a dict of topic action -> list of delivery types, which must not be modified
+    """
+    return get_preferences_many(session, [user_id])[user_id]
+
+
+def get_preferences_many(session, user_ids) -> dict[int, dict[NotificationTopicAction, list[NotificationDeliveryType]]]:
+    """
+    Like get_preferences, but for several users at once, with one query for those that aren't cached
+
+    Returns a dict of user id -> topic action -> list of delivery types
+    """
+    # users whose preferences changed in this transaction, which the cache doesn't know about yet
+    changed = pending_invalidations(session, notification_preference_cache)
+    out = {}
+    to_load = []
+    for user_id in set(user_ids):
+        preferences = None if user_id in changed else notification_preference_cache.get(user_id)
+        if preferences is None:
+            to_load.append(user_id)
+        else:
+            out[user_id] = preferences
+    if to_load:
+        generation = notification_preference_cache.generation
+        loaded = _load_preferences_many(session, to_load)
+        notification_preference_cache.put_many(
+            {user_id: preferences for user_id, preferences in loaded.items() if user_id not in changed}, generation
+        )
+        out.update(loaded)
+    return out
+
+
 def get_preference(session, user_id: int, topic_action: NotificationTopicAction) -> list[NotificationDeliveryType]:
     """
     Gets the user's preference from the DB or otherwise falls back to defaults
@@ -22,17 +97,11 @@ def get_preference(session, user_id: int, topic_action: NotificationTopicAction)
 
     Returns list of delivery types
     """
-    overrides = {
-        res.delivery_type: res.deliver
-        for res in session.execute(
-            select(NotificationPreference)
-            .where(NotificationPreference.user_id == user_id)
-            .where(NotificationPreference.topic_action == topic_action)
-        )
-        .scalars()
-        .all()
-    }
-    return [dt for dt in NotificationDeliveryType if overrides.get(dt, dt in topic_action.defaults)]
+    return get_preferences(session, user_id)[topic_action]
+
+
+def _preferences_changed(session, user_id):
+    invalidate_on_commit(session, notification_preference_cache, [user_id])
 
 
 def reset_preference(session, user_id, topic_action, delivery_type):
@@ -40,11 +109,12 @@ def reset_preference(session, user_id, topic_action, delivery_type):
         select(NotificationPreference)
         .where(NotificationPreference.user_id == user_id)
         .where(NotificationPreference.topic_action == topic_action)
-        .where(NotificationDelivery.delivery_type == delivery_type)
+        .where(NotificationPreference.delivery_type == delivery_type)
     ).scalar_one_or_none()
     if current_pref:
         session.delete(current_pref)
         session.flush()
+        _preferences_changed(session, user_id)
 
 
 class PreferenceNotUserEditableError(Exception):
@@ -72,6 +142,7 @@ def set_preference(session, user_id, topic_action: NotificationTopicAction, deli
             )
         )
     session.flush()
+    _preferences_changed(session, user_id)
 
 
 settings_layout = [
@@ -296,37 +367,37 @@ def check_settings():
 check_settings()
 
 
-def get_user_setting_groups(user_id) -> list[notifications_pb2.NotificationGroup]:
-    with session_scope() as session:
-        groups = []
-        for heading, group in settings_layout:
-            topics = []
-            for topic, name, items in group:
-                actions = []
-                for action, description in items:
-                    topic_action = enum_from_topic_action[topic, action]
-                    delivery_types = get_preference(session, user_id, topic_action)
-                    actions.append(
-                        notifications_pb2.NotificationItem(
-                            action=action,
-                            description=description,
-                            user_editable=topic_action.user_editable,
-                            push=NotificationDeliveryType.push in delivery_types,
-                            email=NotificationDeliveryType.email in delivery_types,
-                            digest=NotificationDeliveryType.digest in delivery_types,
-                        )
-                    )
-                topics.append(
-                    notifications_pb2.NotificationTopic(
-                        topic=topic,
-                        name=name,
-                        items=actions,
+def get_user_setting_groups(session, user_id) -> list[notifications_pb2.NotificationGroup]:
+    preferences = get_preferences(session, user_id)
+    groups = []
+    for heading, group in settings_layout:
+        topics = []
+        for topic, name, items in group:
+            actions = []
+            for action, description in items:
+                topic_action = enum_from_topic_action[topic, action]
+                delivery_types = preferences[topic_action]
+                actions.append(
+                    notifications_pb2.NotificationItem(
+                        action=action,
+                        description=description,
+                        user_editable=topic_action.user_editable,
+                        push=NotificationDeliveryType.push in delivery_types,
+                        email=NotificationDeliveryType.email in delivery_types,
+                        digest=NotificationDeliveryType.digest in delivery_types,
                     )
                 )
-            groups.append(
-                notifications_pb2.NotificationGroup(
-                    heading=heading,
-                    topics=topics,
+            topics.append(
+                notifications_pb2.NotificationTopic(
+                    topic=topic,
+                    name=name,
+                    items=actions,
                 )
             )
-        return groups
+        groups.append(
+            notifications_pb2.NotificationGroup(
+                heading=heading,
+                topics=topics,
+            )
+        )
+    return groups
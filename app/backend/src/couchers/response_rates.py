@@ -0,0 +1,233 @@
+"""
+Per-user response rates and response times, kept up to date as host requests and activeness probes come in and get
+responded to, rather than recomputed from every message.
+
+The percentiles come from a small per-user sketch of response times: a sorted list of response times and how many
+responses each stands for. While a user has no more than USER_RESPONSE_TIMES_SKETCH_SIZE distinct response times it
+holds them all and the percentiles are exact, past that the two closest are merged into their weighted mean.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from datetime import timedelta
+from math import ceil
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import case, delete, extract, func, union_all, update
+from sqlalchemy.sql import select as sa_select
+
+from couchers.constants import UNANSWERED_RESPONSE_TIME, USER_RESPONSE_TIMES_SKETCH_SIZE
+from couchers.models import ActivenessProbe, ActivenessProbeStatus, HostRequest, Message, MessageType, UserResponseRate
+
+# this subquery gets the time that the request was sent
+t = sa_select(Message.conversation_id, Message.time).where(Message.message_type == MessageType.chat_created).subquery()
+# the time that the host first responded to the request, looked up per request so that recomputing a few users' response
+# rates doesn't have to go through every message
+first_response_time = (
+    sa_select(func.min(Message.time))
+    .where(Message.conversation_id == HostRequest.conversation_id)
+    .where(Message.author_id == HostRequest.host_user_id)
+    .scalar_subquery()
+)
+# every request each user has received, and how long they took to respond (null if they haven't), computed from scratch
+all_responses = union_all(
+    # host request responses
+    sa_select(
+        HostRequest.host_user_id.label("user_id"),
+        (first_response_time - t.c.time).label("response_time"),
+    ).join(t, t.c.conversation_id == HostRequest.conversation_id),
+    # activeness probes
+    sa_select(
+        ActivenessProbe.user_id,
+        (
+            # expired probes have a responded time for when they were marked responded
+            case(
+                (
+                    ActivenessProbe.response != ActivenessProbeStatus.expired,
+                    ActivenessProbe.responded - ActivenessProbe.probe_initiated,
+                ),
+                else_=None,
+            )
+        ).label("response_time"),
+    ),
+).subquery()
+
+
+def add_to_sketch(sketch, counts, response_time, count=1):
+    """
+    Adds a response time (in seconds) to a sketch, merging the closest two response times if it gets too big
+    """
+    sketch, counts = list(sketch), list(counts)
+    i = bisect_left(sketch, response_time)
+    if i < len(sketch) and sketch[i] == response_time:
+        counts[i] += count
+        return sketch, counts
+    sketch.insert(i, response_time)
+    counts.insert(i, count)
+    if len(sketch) > USER_RESPONSE_TIMES_SKETCH_SIZE:
+        i = min(range(len(sketch) - 1), key=lambda j: sketch[j + 1] - sketch[j])
+        merged_count = counts[i] + counts[i + 1]
+        sketch[i : i + 2] = [(sketch[i] * counts[i] + sketch[i + 1] * counts[i + 1]) / merged_count]
+        counts[i : i + 2] = [merged_count]
+    return sketch, counts
+
+
+def sketch_percentile(sketch, counts, requests, percentile):
+    """
+    The given percentile of the time taken to respond to requests, where requests not in the sketch are unanswered.
+
+    Picks an actual value like percentile_disc, so matches it exactly while the sketch holds every response time.
+    """
+    rank = max(ceil(percentile * requests), 1)
+    seen = 0
+    for response_time, count in zip(sketch, counts):
+        seen += count
+        if seen >= rank:
+            return timedelta(seconds=response_time)
+    return UNANSWERED_RESPONSE_TIME
+
+
+def _summarise(requests, responses, response_time_sum, sketch, counts):
+    """
+    The full set of column values for a user's response rate row
+    """
+    return {
+        "requests": requests,
+        "responses": responses,
+        "response_time_sum": response_time_sum,
+        "response_time_sketch": sketch,
+        "response_time_sketch_counts": counts,
+        "response_rate": responses / requests if requests else None,
+        "avg_response_time": timedelta(seconds=response_time_sum / responses) if responses else None,
+        "response_time_33p": sketch_percentile(sketch, counts, requests, 0.33) if requests else None,
+        "response_time_66p": sketch_percentile(sketch, counts, requests, 0.66) if requests else None,
+    }
+
+
+def _lock_user_response_rates(conn, user_ids):
+    """
+    Locks the given users' response rate rows, creating them if needed, and returns them by user id
+    """
+    user_ids = sorted(user_ids)
+    conn.execute(
+        insert(UserResponseRate).values([{"user_id": user_id} for user_id in user_ids]).on_conflict_do_nothing()
+    )
+    rows = conn.execute(
+        sa_select(UserResponseRate.__table__)
+        .where(UserResponseRate.user_id.in_(user_ids))
+        .order_by(UserResponseRate.user_id)
+        .with_for_update()
+    ).all()
+    return {row.user_id: row for row in rows}
+
+
+def _host_request_responses(conn, message_ids):
+    """
+    The (user id, response time in seconds) of the host requests that the given messages are the host's first response to
+    """
+    message = aliased(Message)
+    chat_created = aliased(Message)
+    earlier = aliased(Message)
+    return conn.execute(
+        sa_select(HostRequest.host_user_id, extract("epoch", message.time - chat_created.time))
+        .join(message, message.conversation_id == HostRequest.conversation_id)
+        .join(chat_created, chat_created.conversation_id == HostRequest.conversation_id)
+        .where(message.id.in_(message_ids))
+        .where(message.author_id == HostRequest.host_user_id)
+        .where(chat_created.message_type == MessageType.chat_created)
+        .where(
+            ~sa_select(earlier.id)
+            .where(earlier.conversation_id == message.conversation_id)
+            .where(earlier.author_id == message.author_id)
+            .where(earlier.id < message.id)
+            .exists()
+        )
+    ).all()
+
+
+def _activeness_probe_responses(conn, probe_ids):
+    """
+    The (user id, response time in seconds) of the given activeness probes, if they were actually responded to
+    """
+    return conn.execute(
+        sa_select(
+            ActivenessProbe.user_id, extract("epoch", ActivenessProbe.responded - ActivenessProbe.probe_initiated)
+        )
+        .where(ActivenessProbe.id.in_(probe_ids))
+        .where(ActivenessProbe.responded != None)
+        .where(ActivenessProbe.response != ActivenessProbeStatus.expired)
+    ).all()
+
+
+def update_user_response_rates(conn, request_user_ids, message_ids, responded_probe_ids):
+    """
+    Adds new requests and responses to the users' response rates.
+
+    request_user_ids has a user id for each new host request or activeness probe they received, message_ids are new
+    messages (only first responses to host requests count), and responded_probe_ids are newly responded to activeness
+    probes.
+    """
+    requests = Counter(request_user_ids)
+    responses = []
+    if message_ids:
+        responses += _host_request_responses(conn, message_ids)
+    if responded_probe_ids:
+        responses += _activeness_probe_responses(conn, responded_probe_ids)
+    if not requests and not responses:
+        return
+
+    rows = _lock_user_response_rates(conn, set(requests) | {user_id for user_id, _ in responses})
+    stats = {
+        user_id: [
+            row.requests + requests[user_id],
+            row.responses,
+            row.response_time_sum,
+            row.response_time_sketch,
+            row.response_time_sketch_counts,
+        ]
+        for user_id, row in rows.items()
+    }
+    for user_id, response_time in responses:
+        response_time = float(response_time)
+        user_stats = stats[user_id]
+        user_stats[1] += 1
+        user_stats[2] += response_time
+        user_stats[3], user_stats[4] = add_to_sketch(user_stats[3], user_stats[4], response_time)
+    for user_id, user_stats in stats.items():
+        conn.execute(
+            update(UserResponseRate).where(UserResponseRate.user_id == user_id).values(**_summarise(*user_stats))
+        )
+
+
+def recompute_user_response_rates(conn, user_ids):
+    """
+    Recomputes the given users' response rates from scratch, removing them for users that have received no requests
+    """
+    # lock first, so that the recomputation sees everything committed by transactions that were updating these rows
+    _lock_user_response_rates(conn, user_ids)
+    response_time = extract("epoch", all_responses.c.response_time)
+    computed = conn.execute(
+        sa_select(
+            all_responses.c.user_id,
+            func.count(),
+            func.array_agg(response_time).filter(all_responses.c.response_time != None),
+        )
+        .where(all_responses.c.user_id.in_(user_ids))
+        .group_by(all_responses.c.user_id)
+    ).all()
+    for user_id, requests, response_times in computed:
+        response_times = [float(response_time) for response_time in response_times or []]
+        sketch, counts = [], []
+        for response_time in response_times:
+            sketch, counts = add_to_sketch(sketch, counts, response_time)
+        conn.execute(
+            update(UserResponseRate)
+            .where(UserResponseRate.user_id == user_id)
+            .values(**_summarise(requests, len(response_times), sum(response_times), sketch, counts))
+        )
+    conn.execute(
+        delete(UserResponseRate)
+        .where(UserResponseRate.user_id.in_(user_ids))
+        .where(UserResponseRate.user_id.not_in([user_id for user_id, *_ in computed]))
+    )
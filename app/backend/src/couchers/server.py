@@ -2,6 +2,8 @@ from concurrent import futures
 
 import grpc
 
+from couchers.activity import activity_buffer
+from couchers.api_call_log import api_call_log
 from couchers.config import config
 from couchers.constants import SERVER_THREADS
 from couchers.interceptors import (
@@ -102,6 +104,11 @@ def create_main_server(port):
     search_pb2_grpc.add_SearchServicer_to_server(Search(), server)
     stripe_pb2_grpc.add_StripeServicer_to_server(Stripe(), server)
     threads_pb2_grpc.add_ThreadsServicer_to_server(Threads(), server)
+
+    # AuthValidatorInterceptor buffers session bookkeeping, this writes it out
+    activity_buffer.start()
+    # TracingInterceptor queues api call logs, this writes them out
+    api_call_log.start()
     return server
 
 
@@ -116,4 +123,5 @@ def create_media_server(port, threads=8):
     )
     media_server.add_insecure_port(f"[::]:{port}")
     media_pb2_grpc.add_MediaServicer_to_server(Media(), media_server)
+    api_call_log.start()
     return media_server
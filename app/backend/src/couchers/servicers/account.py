@@ -10,6 +10,7 @@ from sqlalchemy.sql import func, update
 from user_agents import parse as user_agents_parse
 
 from couchers import errors, urls
+from couchers.activity import activity_buffer
 from couchers.config import config
 from couchers.constants import PHONE_REVERIFICATION_INTERVAL, SMS_CODE_ATTEMPTS, SMS_CODE_LIFETIME
 from couchers.crypto import (
@@ -106,18 +107,32 @@ def mod_note_to_pb(note: ModNote):
 
 
 def get_strong_verification_fields(session, db_user):
+    return get_strong_verification_fields_many(session, [db_user])[db_user.id]
+
+
+def get_strong_verification_fields_many(session, db_users):
+    """
+    Like get_strong_verification_fields, for a list of users at once. Returns a dict of user_id -> fields
+    """
+    attempts = {
+        attempt.user_id: attempt
+        for attempt in session.execute(
+            select(StrongVerificationAttempt)
+            .where(StrongVerificationAttempt.user_id.in_({db_user.id for db_user in db_users}))
+            .where(StrongVerificationAttempt.is_valid)
+            .order_by(StrongVerificationAttempt.user_id, StrongVerificationAttempt.passport_expiry_datetime.desc())
+            .distinct(StrongVerificationAttempt.user_id)
+        ).scalars()
+    }
+    return {db_user.id: _strong_verification_fields(db_user, attempts.get(db_user.id)) for db_user in db_users}
+
+
+def _strong_verification_fields(db_user, attempt):
     out = dict(
         birthdate_verification_status=api_pb2.BIRTHDATE_VERIFICATION_STATUS_UNVERIFIED,
         gender_verification_status=api_pb2.GENDER_VERIFICATION_STATUS_UNVERIFIED,
         has_strong_verification=False,
     )
-    attempt = session.execute(
-        select(StrongVerificationAttempt)
-        .where(StrongVerificationAttempt.user_id == db_user.id)
-        .where(StrongVerificationAttempt.is_valid)
-        .order_by(StrongVerificationAttempt.passport_expiry_datetime.desc())
-        .limit(1)
-    ).scalar_one_or_none()
     if attempt:
         assert attempt.is_valid
         if attempt.matches_birthdate(db_user):
@@ -548,6 +563,9 @@ class Account(account_pb2_grpc.AccountServicer):
         page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
         page_token = dt_from_page_token(request.page_token) if request.page_token else now()
 
+        # last seen times are written out in the background, make sure they're current since we order by them
+        activity_buffer.flush()
+
         user_sessions = (
             session.execute(
                 select(UserSession)
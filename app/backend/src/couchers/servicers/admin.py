@@ -37,7 +37,8 @@ from couchers.models import (
 )
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict
-from couchers.servicers.api import get_strong_verification_fields, user_model_to_pb
+from couchers.servicers.account import get_strong_verification_fields
+from couchers.servicers.api import user_model_to_pb
 from couchers.servicers.auth import create_session
 from couchers.servicers.communities import community_to_pb
 from couchers.servicers.events import get_users_to_notify_for_new_event
@@ -322,6 +323,7 @@ class Admin(admin_pb2_grpc.AdminServicer):
             geom = load_community_geom(request.geojson, context)
 
             node.geom = from_shape(geom)
+            node.geom_last_updated = now()
 
         if request.parent_node_id != 0:
             node.parent_node_id = request.parent_node_id
@@ -1,15 +1,18 @@
+import hashlib
+from collections import defaultdict
 from datetime import timedelta
 from urllib.parse import urlencode
 
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.orm import aliased
-from sqlalchemy.sql import and_, delete, func, intersect, or_, union
+from sqlalchemy.sql import and_, delete, func, intersect, or_, tuple_, union
 
 from couchers import errors, urls
+from couchers.activity import user_profile_cache
+from couchers.cache import invalidate_on_commit
 from couchers.config import config
 from couchers.crypto import b64encode, generate_hash_signature, random_hex
-from couchers.materialized_views import lite_users, user_response_rates
+from couchers.materialized_views import lite_users
 from couchers.models import (
     FriendRelationship,
     FriendStatus,
@@ -24,16 +27,19 @@ from couchers.models import (
     Notification,
     ParkingDetails,
     Reference,
+    Region,
     RegionLived,
     RegionVisited,
     SleepingArrangement,
     SmokingLocation,
+    Upload,
     User,
     UserBadge,
+    UserResponseRate,
 )
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict, language_is_allowed, region_is_allowed
-from couchers.servicers.account import get_strong_verification_fields
+from couchers.servicers.account import get_strong_verification_fields_many
 from couchers.sql import couchers_select as select
 from couchers.sql import is_valid_user_id, is_valid_username
 from couchers.utils import (
@@ -138,68 +144,79 @@ fluency2api = {
 }
 
 
+def _unseen_host_request_count(context, own_user_column, other_user_column, last_seen_column):
+    """
+    Scalar subquery counting the user's host requests (on the side given by own_user_column) that have messages they
+    haven't seen yet
+    """
+    return (
+        select(func.count())
+        .select_from(HostRequest)
+        .where(own_user_column == context.user_id)
+        .where_users_column_visible(context, other_user_column)
+        .where(
+            select(Message.id)
+            .where(Message.conversation_id == HostRequest.conversation_id)
+            .where(Message.id > last_seen_column)
+            .exists()
+        )
+        .scalar_subquery()
+    )
+
+
 class API(api_pb2_grpc.APIServicer):
     def Ping(self, request, context, session):
         # auth ought to make sure the user exists
         user = session.execute(select(User).where(User.id == context.user_id)).scalar_one()
 
-        # gets only the max message by self-joining messages which have a greater id
-        # if it doesn't have a greater id, it's the biggest
-        message_2 = aliased(Message)
-        unseen_sent_host_request_count = session.execute(
-            select(func.count())
-            .select_from(Message)
-            .join(HostRequest, Message.conversation_id == HostRequest.conversation_id)
-            .outerjoin(message_2, and_(Message.conversation_id == message_2.conversation_id, Message.id < message_2.id))
-            .where(HostRequest.surfer_user_id == context.user_id)
-            .where_users_column_visible(context, HostRequest.host_user_id)
-            .where(message_2.id == None)
-            .where(HostRequest.surfer_last_seen_message_id < Message.id)
-        ).scalar_one()
-
-        unseen_received_host_request_count = session.execute(
-            select(func.count())
-            .select_from(Message)
-            .join(HostRequest, Message.conversation_id == HostRequest.conversation_id)
-            .outerjoin(message_2, and_(Message.conversation_id == message_2.conversation_id, Message.id < message_2.id))
-            .where_users_column_visible(context, HostRequest.surfer_user_id)
-            .where(HostRequest.host_user_id == context.user_id)
-            .where(message_2.id == None)
-            .where(HostRequest.host_last_seen_message_id < Message.id)
-        ).scalar_one()
-
-        unseen_message_count = session.execute(
-            select(func.count())
-            .select_from(Message)
-            .outerjoin(GroupChatSubscription, GroupChatSubscription.group_chat_id == Message.conversation_id)
-            .where(GroupChatSubscription.user_id == context.user_id)
-            .where(Message.time >= GroupChatSubscription.joined)
-            .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
-            .where(Message.id > GroupChatSubscription.last_seen_message_id)
-        ).scalar_one()
-
-        pending_friend_request_count = session.execute(
-            select(func.count())
-            .select_from(FriendRelationship)
-            .where(FriendRelationship.to_user_id == context.user_id)
-            .where_users_column_visible(context, FriendRelationship.from_user_id)
-            .where(FriendRelationship.status == FriendStatus.pending)
-        ).scalar_one()
-
-        unseen_notification_count = session.execute(
-            select(func.count(Notification.id))
-            .where(Notification.user_id == context.user_id)
-            .where(Notification.is_seen == False)
-        ).scalar_one()
+        # all the counts in one round trip
+        counts = session.execute(
+            select(
+                _unseen_host_request_count(
+                    context,
+                    HostRequest.surfer_user_id,
+                    HostRequest.host_user_id,
+                    HostRequest.surfer_last_seen_message_id,
+                ).label("unseen_sent_host_request_count"),
+                _unseen_host_request_count(
+                    context, HostRequest.host_user_id, HostRequest.surfer_user_id, HostRequest.host_last_seen_message_id
+                ).label("unseen_received_host_request_count"),
+                select(func.count())
+                .select_from(Message)
+                .join(GroupChatSubscription, GroupChatSubscription.group_chat_id == Message.conversation_id)
+                .where(GroupChatSubscription.user_id == context.user_id)
+                .where(Message.time >= GroupChatSubscription.joined)
+                .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
+                .where(Message.id > GroupChatSubscription.last_seen_message_id)
+                .scalar_subquery()
+                .label("unseen_message_count"),
+                select(func.count())
+                .select_from(FriendRelationship)
+                .where(FriendRelationship.to_user_id == context.user_id)
+                .where_users_column_visible(context, FriendRelationship.from_user_id)
+                .where(FriendRelationship.status == FriendStatus.pending)
+                .scalar_subquery()
+                .label("pending_friend_request_count"),
+                select(func.count(Notification.id))
+                .where(Notification.user_id == context.user_id)
+                .where(Notification.is_seen == False)
+                .scalar_subquery()
+                .label("unseen_notification_count"),
+            )
+        ).one()
 
-        return api_pb2.PingRes(
+        res = api_pb2.PingRes(
             user=user_model_to_pb(user, session, context),
-            unseen_message_count=unseen_message_count,
-            unseen_sent_host_request_count=unseen_sent_host_request_count,
-            unseen_received_host_request_count=unseen_received_host_request_count,
-            pending_friend_request_count=pending_friend_request_count,
-            unseen_notification_count=unseen_notification_count,
+            unseen_message_count=counts.unseen_message_count,
+            unseen_sent_host_request_count=counts.unseen_sent_host_request_count,
+            unseen_received_host_request_count=counts.unseen_received_host_request_count,
+            pending_friend_request_count=counts.pending_friend_request_count,
+            unseen_notification_count=counts.unseen_notification_count,
         )
+        res.etag = hashlib.blake2b(res.SerializeToString(deterministic=True), digest_size=16).hexdigest()
+        if request.etag == res.etag:
+            return api_pb2.PingRes(etag=res.etag, not_modified=True)
+        return res
 
     def GetUser(self, request, context, session):
         user = session.execute(
@@ -279,6 +296,7 @@ class API(api_pb2_grpc.APIServicer):
             if request.lat.value == 0 and request.lng.value == 0:
                 context.abort(grpc.StatusCode.INVALID_ARGUMENT, errors.INVALID_COORDINATE)
             user.geom = create_coordinate(request.lat.value, request.lng.value)
+            user.geom_last_updated = now()
 
         if request.HasField("radius"):
             user.geom_radius = request.radius.value
@@ -358,6 +376,7 @@ class API(api_pb2_grpc.APIServicer):
 
         if request.HasField("regions_visited"):
             session.execute(delete(RegionVisited).where(RegionVisited.user_id == context.user_id))
+            invalidate_on_commit(session, user_profile_cache, [context.user_id])
 
             for region in request.regions_visited.value:
                 if not region_is_allowed(region):
@@ -371,6 +390,7 @@ class API(api_pb2_grpc.APIServicer):
 
         if request.HasField("regions_lived"):
             session.execute(delete(RegionLived).where(RegionLived.user_id == context.user_id))
+            invalidate_on_commit(session, user_profile_cache, [context.user_id])
 
             for region in request.regions_lived.value:
                 if not region_is_allowed(region):
@@ -801,15 +821,14 @@ class API(api_pb2_grpc.APIServicer):
         )
 
 
-def response_rate_to_pb(response_rates):
-    if not response_rates:
+def response_rate_to_pb(response_rate_stats):
+    # if there are none, the user is new or they have no requests
+    if not response_rate_stats or response_rate_stats.requests < 3:
         return {"insufficient_data": requests_pb2.ResponseRateInsufficientData()}
 
-    _, n, response_rate, _, response_time_p33, response_time_p66 = response_rates
-
-    # if n is None, the user is new or they have no requests
-    if not n or n < 3:
-        return {"insufficient_data": requests_pb2.ResponseRateInsufficientData()}
+    response_rate = response_rate_stats.response_rate
+    response_time_p33 = response_rate_stats.response_time_33p
+    response_time_p66 = response_rate_stats.response_time_66p
 
     if response_rate <= 0.33:
         return {"low": requests_pb2.ResponseRateLow()}
@@ -840,37 +859,68 @@ def response_rate_to_pb(response_rates):
 
 
 def user_model_to_pb(db_user, session, context):
+    return users_to_pb(session, [db_user], context)[0]
+
+
+def users_to_pb(session, db_users, context):
+    """
+    Renders a list of users as api_pb2.User as seen by the user in context, in a constant number of queries
+    """
     # note that this function should work also for banned/deleted users as it's called from Admin.GetUser
-    num_references = session.execute(
-        select(func.count())
-        .select_from(Reference)
-        .join(User, User.id == Reference.from_user_id)
-        .where(User.is_visible)
-        .where(Reference.to_user_id == db_user.id)
-        .where(Reference.is_deleted == False)
-    ).scalar_one()
+    return _users_to_pb_for_viewers(session, [(context.user_id, db_user) for db_user in db_users])
 
-    # returns (lat, lng)
-    # we put people without coords on null island
-    # https://en.wikipedia.org/wiki/Null_Island
-    lat, lng = db_user.coordinates or (0, 0)
 
-    pending_friend_request = None
-    if db_user.id == context.user_id:
-        friends_status = api_pb2.User.FriendshipStatus.NA
-    else:
-        friend_relationship = session.execute(
+def user_to_pb_for_viewers(session, db_user, viewer_user_ids):
+    """
+    Renders a single user as seen by each of the given users, for fanning out notifications. Returns a dict of viewer
+    user_id -> api_pb2.User
+    """
+    viewer_user_ids = list(viewer_user_ids)
+    users = _users_to_pb_for_viewers(session, [(viewer_user_id, db_user) for viewer_user_id in viewer_user_ids])
+    return dict(zip(viewer_user_ids, users))
+
+
+def _users_to_pb_for_viewers(session, viewers_and_users):
+    db_users = list({db_user.id: db_user for _, db_user in viewers_and_users}.values())
+    base_users = _viewer_independent_users_to_pb(session, db_users)
+    friendships = _get_friendship_statuses(
+        session,
+        {(viewer_user_id, db_user.id) for viewer_user_id, db_user in viewers_and_users if viewer_user_id != db_user.id},
+    )
+
+    out = []
+    for viewer_user_id, db_user in viewers_and_users:
+        user = api_pb2.User()
+        user.CopyFrom(base_users[db_user.id])
+        if viewer_user_id == db_user.id:
+            user.friends = api_pb2.User.FriendshipStatus.NA
+        else:
+            friends_status, pending_friend_request = friendships.get(
+                (viewer_user_id, db_user.id), (api_pb2.User.FriendshipStatus.NOT_FRIENDS, None)
+            )
+            user.friends = friends_status
+            if pending_friend_request:
+                user.pending_friend_request.CopyFrom(pending_friend_request)
+        out.append(user)
+    return out
+
+
+def _get_friendship_statuses(session, viewers_and_user_ids):
+    """
+    Given a set of (viewer user_id, user_id) pairs, returns a dict of pair -> (friendship status, pending friend
+    request) for the pairs that are friends or have a pending friend request between them
+    """
+    if not viewers_and_user_ids:
+        return {}
+
+    pairs = list(viewers_and_user_ids)
+    friend_relationships = (
+        session.execute(
             select(FriendRelationship)
             .where(
                 or_(
-                    and_(
-                        FriendRelationship.from_user_id == context.user_id,
-                        FriendRelationship.to_user_id == db_user.id,
-                    ),
-                    and_(
-                        FriendRelationship.from_user_id == db_user.id,
-                        FriendRelationship.to_user_id == context.user_id,
-                    ),
+                    tuple_(FriendRelationship.from_user_id, FriendRelationship.to_user_id).in_(pairs),
+                    tuple_(FriendRelationship.to_user_id, FriendRelationship.from_user_id).in_(pairs),
                 )
             )
             .where(
@@ -879,35 +929,144 @@ def user_model_to_pb(db_user, session, context):
                     FriendRelationship.status == FriendStatus.pending,
                 )
             )
-        ).scalar_one_or_none()
+        )
+        .scalars()
+        .all()
+    )
 
-        if friend_relationship:
+    out = {}
+    for friend_relationship in friend_relationships:
+        for viewer_user_id, user_id, sent in [
+            (friend_relationship.from_user_id, friend_relationship.to_user_id, True),
+            (friend_relationship.to_user_id, friend_relationship.from_user_id, False),
+        ]:
+            if (viewer_user_id, user_id) not in viewers_and_user_ids:
+                continue
             if friend_relationship.status == FriendStatus.accepted:
-                friends_status = api_pb2.User.FriendshipStatus.FRIENDS
+                out[(viewer_user_id, user_id)] = (api_pb2.User.FriendshipStatus.FRIENDS, None)
             else:
-                friends_status = api_pb2.User.FriendshipStatus.PENDING
-                if friend_relationship.from_user_id == context.user_id:
-                    # we sent it
-                    pending_friend_request = api_pb2.FriendRequest(
+                out[(viewer_user_id, user_id)] = (
+                    api_pb2.User.FriendshipStatus.PENDING,
+                    api_pb2.FriendRequest(
                         friend_request_id=friend_relationship.id,
                         state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
-                        user_id=friend_relationship.to_user.id,
-                        sent=True,
-                    )
-                else:
-                    # we received it
-                    pending_friend_request = api_pb2.FriendRequest(
-                        friend_request_id=friend_relationship.id,
-                        state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
-                        user_id=friend_relationship.from_user.id,
-                        sent=False,
-                    )
-        else:
-            friends_status = api_pb2.User.FriendshipStatus.NOT_FRIENDS
+                        user_id=user_id,
+                        sent=sent,
+                    ),
+                )
+    return out
+
+
+def _viewer_independent_users_to_pb(session, db_users):
+    """
+    Returns a dict of user_id -> api_pb2.User with everything filled in except the friendship fields. The profile
+    itself comes from the user profile cache where possible, the rest is always looked up fresh.
+    """
+    user_ids = [db_user.id for db_user in db_users]
+
+    generation = user_profile_cache.generation
+    profiles = user_profile_cache.get_many(session, user_ids)
+    missing = [db_user for db_user in db_users if db_user.id not in profiles]
+    if missing:
+        new_profiles = _user_profiles_to_pb(session, missing)
+        user_profile_cache.put_many(session, new_profiles, generation)
+        profiles.update(new_profiles)
+
+    num_references = dict(
+        session.execute(
+            select(Reference.to_user_id, func.count())
+            .join(User, User.id == Reference.from_user_id)
+            .where(User.is_visible)
+            .where(Reference.to_user_id.in_(user_ids))
+            .where(Reference.is_deleted == False)
+            .group_by(Reference.to_user_id)
+        ).all()
+    )
+
+    response_rates = {
+        response_rate.user_id: response_rate
+        for response_rate in session.execute(
+            select(UserResponseRate).where(UserResponseRate.user_id.in_(user_ids))
+        ).scalars()
+    }
+
+    strong_verification_fields = get_strong_verification_fields_many(session, db_users)
+
+    out = {}
+    for db_user in db_users:
+        user = api_pb2.User(
+            num_references=num_references.get(db_user.id, 0),
+            **strong_verification_fields[db_user.id],
+            **response_rate_to_pb(response_rates.get(db_user.id)),
+        )
+        user.MergeFrom(profiles[db_user.id])
+        out[db_user.id] = user
+    return out
+
+
+def _user_profiles_to_pb(session, db_users):
+    """
+    Renders the parts of api_pb2.User that only depend on the user's own profile, as a dict of user_id -> api_pb2.User
+    """
+    user_ids = [db_user.id for db_user in db_users]
+
+    language_abilities = defaultdict(list)
+    for ability in session.execute(
+        select(LanguageAbility).where(LanguageAbility.user_id.in_(user_ids)).order_by(LanguageAbility.id)
+    ).scalars():
+        language_abilities[ability.user_id].append(
+            api_pb2.LanguageAbility(code=ability.language_code, fluency=fluency2api[ability.fluency])
+        )
+
+    regions_visited = defaultdict(list)
+    for user_id, region_code in session.execute(
+        select(RegionVisited.user_id, RegionVisited.region_code)
+        .join(Region, Region.code == RegionVisited.region_code)
+        .where(RegionVisited.user_id.in_(user_ids))
+        .order_by(Region.name)
+    ).all():
+        regions_visited[user_id].append(region_code)
+
+    regions_lived = defaultdict(list)
+    for user_id, region_code in session.execute(
+        select(RegionLived.user_id, RegionLived.region_code)
+        .join(Region, Region.code == RegionLived.region_code)
+        .where(RegionLived.user_id.in_(user_ids))
+        .order_by(Region.name)
+    ).all():
+        regions_lived[user_id].append(region_code)
+
+    badges = defaultdict(list)
+    for user_id, badge_id in session.execute(
+        select(UserBadge.user_id, UserBadge.badge_id).where(UserBadge.user_id.in_(user_ids)).order_by(UserBadge.id)
+    ).all():
+        badges[user_id].append(badge_id)
+
+    avatar_keys = {db_user.avatar_key for db_user in db_users if db_user.avatar_key}
+    avatars = (
+        {upload.key: upload for upload in session.execute(select(Upload).where(Upload.key.in_(avatar_keys))).scalars()}
+        if avatar_keys
+        else {}
+    )
 
-    response_rates = session.execute(
-        select(user_response_rates).where(user_response_rates.c.user_id == db_user.id)
-    ).one_or_none()
+    return {
+        db_user.id: _user_profile_to_pb(
+            db_user,
+            avatar=avatars.get(db_user.avatar_key),
+            language_abilities=language_abilities[db_user.id],
+            regions_visited=regions_visited[db_user.id],
+            regions_lived=regions_lived[db_user.id],
+            badges=badges[db_user.id],
+        )
+        for db_user in db_users
+    }
+
+
+def _user_profile_to_pb(db_user, avatar, language_abilities, regions_visited, regions_lived, badges):
+    # returns (lat, lng)
+    # we put people without coords on null island
+    # https://en.wikipedia.org/wiki/Null_Island
+    lat, lng = db_user.coordinates or (0, 0)
 
     verification_score = 0.0
     if db_user.phone_verification_verified:
@@ -925,7 +1084,6 @@ def user_model_to_pb(db_user, session, context):
         radius=db_user.geom_radius,
         verification=verification_score,
         community_standing=db_user.community_standing,
-        num_references=num_references,
         gender=db_user.gender,
         pronouns=db_user.pronouns,
         age=int(db_user.age),
@@ -938,23 +1096,16 @@ def user_model_to_pb(db_user, session, context):
         about_me=db_user.about_me,
         things_i_like=db_user.things_i_like,
         about_place=db_user.about_place,
-        language_abilities=[
-            api_pb2.LanguageAbility(code=ability.language_code, fluency=fluency2api[ability.fluency])
-            for ability in db_user.language_abilities
-        ],
-        regions_visited=[region.code for region in db_user.regions_visited],
-        regions_lived=[region.code for region in db_user.regions_lived],
+        language_abilities=language_abilities,
+        regions_visited=regions_visited,
+        regions_lived=regions_lived,
         additional_information=db_user.additional_information,
-        friends=friends_status,
-        pending_friend_request=pending_friend_request,
         smoking_allowed=smokinglocation2api[db_user.smoking_allowed],
         sleeping_arrangement=sleepingarrangement2api[db_user.sleeping_arrangement],
         parking_details=parkingdetails2api[db_user.parking_details],
-        avatar_url=db_user.avatar.full_url if db_user.avatar else None,
-        avatar_thumbnail_url=db_user.avatar.thumbnail_url if db_user.avatar else None,
-        badges=[badge.badge_id for badge in db_user.badges],
-        **get_strong_verification_fields(session, db_user),
-        **response_rate_to_pb(response_rates),
+        avatar_url=avatar.full_url if avatar else None,
+        avatar_thumbnail_url=avatar.thumbnail_url if avatar else None,
+        badges=badges,
     )
 
     if db_user.max_guests is not None:
@@ -1,6 +1,6 @@
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.sql import union
+from sqlalchemy.sql import or_, union
 
 from couchers import errors
 from couchers.models import User, UserBlock
@@ -22,6 +22,34 @@ def are_blocked(session, user1_id, user2_id):
     return session.execute(select(union(blocked_users, blocking_users).subquery())).first() is not None
 
 
+def get_blocked_user_ids_many(session, user_ids):
+    """
+    Returns a dict of user_id -> set of user_ids that the user has blocked or has been blocked by, in one query, for
+    filtering and rendering for many users at once
+    """
+    user_ids = list(user_ids)
+    blocked = {user_id: set() for user_id in user_ids}
+    if not user_ids:
+        return blocked
+    for blocking_user_id, blocked_user_id in session.execute(
+        select(UserBlock.blocking_user_id, UserBlock.blocked_user_id).where(
+            or_(UserBlock.blocking_user_id.in_(user_ids), UserBlock.blocked_user_id.in_(user_ids))
+        )
+    ).all():
+        if blocking_user_id in blocked:
+            blocked[blocking_user_id].add(blocked_user_id)
+        if blocked_user_id in blocked:
+            blocked[blocked_user_id].add(blocking_user_id)
+    return blocked
+
+
+def get_blocked_user_ids(session, user_id):
+    """
+    Returns the set of user_ids that the given user has blocked or has been blocked by
+    """
+    return get_blocked_user_ids_many(session, [user_id])[user_id]
+
+
 class Blocking(blocking_pb2_grpc.BlockingServicer):
     def BlockUser(self, request, context, session):
         blockee = session.execute(
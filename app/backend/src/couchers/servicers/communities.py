@@ -1,13 +1,14 @@
 import logging
 from datetime import timedelta
+from types import SimpleNamespace
 
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.sql import delete, func, or_
+from sqlalchemy.sql import delete, or_
 
 from couchers import errors
 from couchers.crypto import decrypt_page_token, encrypt_page_token
-from couchers.db import can_moderate_node, get_node_parents_recursively
+from couchers.db import can_moderate_node, get_node_parents_recursively, users_who_can_moderate_node
 from couchers.materialized_views import cluster_admin_counts, cluster_subscription_counts
 from couchers.models import (
     Cluster,
@@ -20,11 +21,12 @@ from couchers.models import (
     Page,
     PageType,
     User,
+    UserNode,
 )
 from couchers.servicers.discussions import discussion_to_pb
 from couchers.servicers.events import event_to_pb
 from couchers.servicers.groups import group_to_pb
-from couchers.servicers.pages import page_to_pb
+from couchers.servicers.pages import page_to_pb, page_to_pb_for_viewers
 from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime, dt_from_millis, millis_from_dt, now
 from proto import communities_pb2, communities_pb2_grpc, groups_pb2
@@ -101,6 +103,38 @@ def community_to_pb(session, node: Node, context):
     )
 
 
+def community_to_pb_for_viewers(session, node: Node, viewer_user_ids):
+    """
+    Renders a community as seen by each of the given users, for fanning out notifications. Returns a dict of viewer
+    user_id -> communities_pb2.Community
+    """
+    viewer_user_ids = list(viewer_user_ids)
+    if not viewer_user_ids:
+        return {}
+    base = community_to_pb(session, node, SimpleNamespace(user_id=viewer_user_ids[0]))
+
+    roles = dict(
+        session.execute(
+            select(ClusterSubscription.user_id, ClusterSubscription.role)
+            .where(ClusterSubscription.cluster_id == node.official_cluster.id)
+            .where(ClusterSubscription.user_id.in_(viewer_user_ids))
+        ).all()
+    )
+    moderators = users_who_can_moderate_node(session, viewer_user_ids, node.id)
+    main_pages = page_to_pb_for_viewers(session, node.official_cluster.main_page, viewer_user_ids)
+
+    out = {}
+    for viewer_user_id in viewer_user_ids:
+        community_pb = communities_pb2.Community()
+        community_pb.CopyFrom(base)
+        community_pb.member = viewer_user_id in roles
+        community_pb.admin = roles.get(viewer_user_id) == ClusterRole.admin
+        community_pb.can_moderate = viewer_user_id in moderators
+        community_pb.main_page.CopyFrom(main_pages[viewer_user_id])
+        out[viewer_user_id] = community_pb
+    return out
+
+
 class Communities(communities_pb2_grpc.CommunitiesServicer):
     def GetCommunity(self, request, context, session):
         node = session.execute(select(Node).where(Node.id == request.community_id)).scalar_one_or_none()
@@ -263,8 +297,9 @@ class Communities(communities_pb2_grpc.CommunitiesServicer):
         nearbys = (
             session.execute(
                 select(User)
+                .join(UserNode, UserNode.user_id == User.id)
                 .where_users_visible(context)
-                .where(func.ST_Contains(node.geom, User.geom))
+                .where(UserNode.node_id == node.id)
                 .where(User.id >= next_nearby_id)
                 .order_by(User.id)
                 .limit(page_size + 1)
@@ -391,7 +426,10 @@ class Communities(communities_pb2_grpc.CommunitiesServicer):
         if not current_membership:
             context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.NOT_IN_COMMUNITY)
 
-        if context.user_id in node.contained_user_ids:
+        contains_user = session.execute(
+            select(UserNode).where(UserNode.node_id == node.id).where(UserNode.user_id == context.user_id)
+        ).scalar_one_or_none()
+        if contains_user:
             context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.CANNOT_LEAVE_CONTAINING_COMMUNITY)
 
         session.execute(
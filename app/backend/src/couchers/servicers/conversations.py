@@ -1,6 +1,5 @@
 import logging
 from datetime import timedelta
-from types import SimpleNamespace
 
 import grpc
 from google.protobuf import empty_pb2
@@ -12,9 +11,9 @@ from couchers.db import session_scope
 from couchers.jobs.enqueue import queue_job
 from couchers.metrics import sent_messages_counter
 from couchers.models import Conversation, GroupChat, GroupChatRole, GroupChatSubscription, Message, MessageType, User
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.notify import notify_many
+from couchers.servicers.api import user_to_pb_for_viewers
+from couchers.servicers.blocking import get_blocked_user_ids
 from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime, now
 from proto import conversations_pb2, conversations_pb2_grpc, notification_data_pb2
@@ -157,25 +156,26 @@ def generate_message_notifications(payload: jobs_pb2.GenerateMessageNotification
         else:
             msg = f"{message.author.name} sent a message in {group_chat.title}"
 
-        for subscription in subscriptions:
-            if are_blocked(session, subscription.user_id, message.author.id):
-                continue
-            notify(
-                session,
-                user_id=subscription.user_id,
-                topic_action="chat:message",
-                key=message.conversation_id,
-                data=notification_data_pb2.ChatMessage(
-                    author=user_model_to_pb(
-                        message.author,
-                        session,
-                        SimpleNamespace(user_id=subscription.user_id),
-                    ),
+        blocked_user_ids = get_blocked_user_ids(session, message.author.id)
+        user_ids = [
+            subscription.user_id for subscription in subscriptions if subscription.user_id not in blocked_user_ids
+        ]
+        author_pbs = user_to_pb_for_viewers(session, message.author, user_ids)
+
+        recipients = [
+            (
+                user_id,
+                notification_data_pb2.ChatMessage(
+                    author=author_pbs[user_id],
                     message=msg,
                     text=message.text,
                     group_chat_id=message.conversation_id,
                 ),
             )
+            for user_id in user_ids
+        ]
+
+        notify_many(session, recipients=recipients, topic_action="chat:message", key=message.conversation_id)
 
 
 def _add_message_to_subscription(session, subscription, **kwargs):
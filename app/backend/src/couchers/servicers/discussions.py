@@ -4,12 +4,12 @@ from types import SimpleNamespace
 import grpc
 
 from couchers import errors
-from couchers.db import can_moderate_node, session_scope
+from couchers.db import can_moderate_node, session_scope, users_who_can_moderate_node
 from couchers.jobs.enqueue import queue_job
 from couchers.models import Cluster, Discussion, Thread, User
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.notify import notify_many
+from couchers.servicers.api import user_to_pb_for_viewers
+from couchers.servicers.blocking import get_blocked_user_ids
 from couchers.servicers.threads import thread_to_pb
 from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime
@@ -44,6 +44,26 @@ def discussion_to_pb(session, discussion: Discussion, context):
     )
 
 
+def discussion_to_pb_for_viewers(session, discussion: Discussion, viewer_user_ids):
+    """
+    Renders a discussion as seen by each of the given users, for fanning out notifications. Returns a dict of viewer
+    user_id -> discussions_pb2.Discussion
+    """
+    viewer_user_ids = list(viewer_user_ids)
+    if not viewer_user_ids:
+        return {}
+    base = discussion_to_pb(session, discussion, SimpleNamespace(user_id=viewer_user_ids[0]))
+    moderators = users_who_can_moderate_node(session, viewer_user_ids, discussion.owner_cluster.parent_node_id)
+
+    out = {}
+    for viewer_user_id in viewer_user_ids:
+        discussion_pb = discussions_pb2.Discussion()
+        discussion_pb.CopyFrom(base)
+        discussion_pb.can_moderate = viewer_user_id in moderators
+        out[viewer_user_id] = discussion_pb
+    return out
+
+
 def generate_create_discussion_notifications(payload: jobs_pb2.GenerateCreateDiscussionNotificationsPayload):
     with session_scope() as session:
         discussion = session.execute(select(Discussion).where(Discussion.id == payload.discussion_id)).scalar_one()
@@ -53,20 +73,23 @@ def generate_create_discussion_notifications(payload: jobs_pb2.GenerateCreateDis
         if not cluster.is_official_cluster:
             raise NotImplementedError("Shouldn't have discussions under groups, only communities")
 
-        for user in list(cluster.members.where(User.is_visible)):
-            if are_blocked(session, user.id, discussion.creator_user_id):
-                continue
-            context = SimpleNamespace(user_id=user.id)
-            notify(
-                session,
-                user_id=user.id,
-                topic_action="discussion:create",
-                key=payload.discussion_id,
-                data=notification_data_pb2.DiscussionCreate(
-                    author=user_model_to_pb(discussion.creator_user, session, context),
-                    discussion=discussion_to_pb(session, discussion, context),
+        blocked_user_ids = get_blocked_user_ids(session, discussion.creator_user_id)
+        user_ids = [user.id for user in cluster.members.where(User.is_visible) if user.id not in blocked_user_ids]
+        author_pbs = user_to_pb_for_viewers(session, discussion.creator_user, user_ids)
+        discussion_pbs = discussion_to_pb_for_viewers(session, discussion, user_ids)
+
+        recipients = [
+            (
+                user_id,
+                notification_data_pb2.DiscussionCreate(
+                    author=author_pbs[user_id],
+                    discussion=discussion_pbs[user_id],
                 ),
             )
+            for user_id in user_ids
+        ]
+
+        notify_many(session, recipients=recipients, topic_action="discussion:create", key=payload.discussion_id)
 
 
 class Discussions(discussions_pb2_grpc.DiscussionsServicer):
@@ -8,7 +8,13 @@ from psycopg2.extras import DateTimeTZRange
 from sqlalchemy.sql import and_, func, or_, select, update
 
 from couchers import errors
-from couchers.db import can_moderate_node, get_parent_node_at_location, session_scope
+from couchers.db import (
+    can_moderate_node,
+    get_parent_node_at_location,
+    session_scope,
+    users_who_are_cluster_admins,
+    users_who_can_moderate_node,
+)
 from couchers.jobs.enqueue import queue_job
 from couchers.models import (
     AttendeeStatus,
@@ -25,9 +31,9 @@ from couchers.models import (
     Upload,
     User,
 )
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.notify import notify, notify_many
+from couchers.servicers.api import user_model_to_pb, user_to_pb_for_viewers
+from couchers.servicers.blocking import get_blocked_user_ids, get_blocked_user_ids_many
 from couchers.servicers.threads import thread_to_pb
 from couchers.sql import couchers_select as select
 from couchers.tasks import send_event_community_invite_request_email
@@ -180,6 +186,73 @@ def event_to_pb(session, occurrence: EventOccurrence, context):
     )
 
 
+def event_to_pb_for_viewers(session, occurrence: EventOccurrence, viewer_user_ids):
+    """
+    Renders an event as seen by each of the given users, for fanning out notifications. Returns a dict of viewer
+    user_id -> events_pb2.Event
+
+    Renders it once, then fills in the fields that depend on the viewer from a fixed number of queries, however many
+    viewers there are.
+    """
+    viewer_user_ids = list(viewer_user_ids)
+    if not viewer_user_ids:
+        return {}
+    event = occurrence.event
+    base = event_to_pb(session, occurrence, SimpleNamespace(user_id=viewer_user_ids[0]))
+
+    attendees = session.execute(
+        select(EventOccurrenceAttendee.user_id, EventOccurrenceAttendee.attendee_status, User.is_visible)
+        .join(User, User.id == EventOccurrenceAttendee.user_id)
+        .where(EventOccurrenceAttendee.occurrence_id == occurrence.id)
+    ).all()
+    organizers = session.execute(
+        select(EventOrganizer.user_id, User.is_visible)
+        .join(User, User.id == EventOrganizer.user_id)
+        .where(EventOrganizer.event_id == event.id)
+    ).all()
+    subscribers = session.execute(
+        select(EventSubscription.user_id, User.is_visible)
+        .join(User, User.id == EventSubscription.user_id)
+        .where(EventSubscription.event_id == event.id)
+    ).all()
+    attendance_states = {user_id: attendee_status for user_id, attendee_status, _ in attendees}
+    going_user_ids = {user_id for user_id, status, visible in attendees if visible and status == AttendeeStatus.going}
+    maybe_user_ids = {user_id for user_id, status, visible in attendees if visible and status == AttendeeStatus.maybe}
+    organizer_user_ids = {user_id for user_id, _ in organizers}
+    visible_organizer_user_ids = {user_id for user_id, visible in organizers if visible}
+    subscriber_user_ids = {user_id for user_id, _ in subscribers}
+    visible_subscriber_user_ids = {user_id for user_id, visible in subscribers if visible}
+
+    blocked = get_blocked_user_ids_many(session, viewer_user_ids)
+    moderators = users_who_can_moderate_node(session, viewer_user_ids, event.parent_node_id)
+    if event.owner_cluster is not None:
+        moderators |= users_who_can_moderate_node(session, viewer_user_ids, event.owner_cluster.parent_node_id)
+    if event.owner_user:
+        owners = {event.owner_user_id}
+    else:
+        owners = users_who_are_cluster_admins(session, viewer_user_ids, [event.owner_cluster_id])
+
+    def visible_count(user_ids, hidden_user_ids):
+        return len(user_ids) - len(user_ids & hidden_user_ids)
+
+    out = {}
+    for viewer_user_id in viewer_user_ids:
+        hidden_user_ids = blocked[viewer_user_id]
+        event_pb = events_pb2.Event()
+        event_pb.CopyFrom(base)
+        event_pb.attendance_state = attendancestate2api[attendance_states.get(viewer_user_id)]
+        event_pb.organizer = viewer_user_id in organizer_user_ids
+        event_pb.subscriber = viewer_user_id in subscriber_user_ids
+        event_pb.going_count = visible_count(going_user_ids, hidden_user_ids)
+        event_pb.maybe_count = visible_count(maybe_user_ids, hidden_user_ids)
+        event_pb.organizer_count = visible_count(visible_organizer_user_ids, hidden_user_ids)
+        event_pb.subscriber_count = visible_count(visible_subscriber_user_ids, hidden_user_ids)
+        event_pb.can_moderate = viewer_user_id in moderators
+        event_pb.can_edit = viewer_user_id in owners or event_pb.can_moderate
+        out[viewer_user_id] = event_pb
+    return out
+
+
 def _get_event_and_occurrence_query(occurrence_id, include_deleted: bool):
     query = (
         select(Event, EventOccurrence)
@@ -246,7 +319,7 @@ def generate_event_create_notifications(payload: jobs_pb2.GenerateEventCreateNot
     """
     Background job to generated/fan out event notifications
     """
-    from couchers.servicers.communities import community_to_pb
+    from couchers.servicers.communities import community_to_pb_for_viewers
 
     logger.info(f"Fanning out notifications for event occurrence id = {payload.occurrence_id}")
 
@@ -262,22 +335,31 @@ def generate_event_create_notifications(payload: jobs_pb2.GenerateEventCreateNot
             logger.error(f"Inviting user {payload.inviting_user_id} is gone while trying to send event notification?")
             return
 
-        for user in users:
-            if are_blocked(session, user.id, creator.id):
-                continue
-            context = SimpleNamespace(user_id=user.id)
-            notify(
-                session,
-                user_id=user.id,
-                topic_action="event:create_approved" if payload.approved else "event:create_any",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventCreate(
-                    event=event_to_pb(session, occurrence, context),
-                    inviting_user=user_model_to_pb(inviting_user, session, context),
+        blocked_user_ids = get_blocked_user_ids(session, creator.id)
+        user_ids = [user.id for user in users if user.id not in blocked_user_ids]
+        inviting_user_pbs = user_to_pb_for_viewers(session, inviting_user, user_ids)
+        event_pbs = event_to_pb_for_viewers(session, occurrence, user_ids)
+        community_pbs = community_to_pb_for_viewers(session, event.parent_node, user_ids) if node_id is not None else {}
+
+        recipients = [
+            (
+                user_id,
+                notification_data_pb2.EventCreate(
+                    event=event_pbs[user_id],
+                    inviting_user=inviting_user_pbs[user_id],
                     nearby=True if node_id is None else None,
-                    in_community=community_to_pb(session, event.parent_node, context) if node_id is not None else None,
+                    in_community=community_pbs.get(user_id),
                 ),
             )
+            for user_id in user_ids
+        ]
+
+        notify_many(
+            session,
+            recipients=recipients,
+            topic_action="event:create_approved" if payload.approved else "event:create_any",
+            key=payload.occurrence_id,
+        )
 
 
 def generate_event_update_notifications(payload: jobs_pb2.GenerateEventUpdateNotificationsPayload):
@@ -289,21 +371,26 @@ def generate_event_update_notifications(payload: jobs_pb2.GenerateEventUpdateNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            if are_blocked(session, user_id, updating_user.id):
-                continue
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:update",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventUpdate(
-                    event=event_to_pb(session, occurrence, context),
-                    updating_user=user_model_to_pb(updating_user, session, context),
+        blocked_user_ids = get_blocked_user_ids(session, updating_user.id)
+        user_ids = [
+            user_id for user_id in set(subscribed_user_ids + attending_user_ids) if user_id not in blocked_user_ids
+        ]
+        updating_user_pbs = user_to_pb_for_viewers(session, updating_user, user_ids)
+        event_pbs = event_to_pb_for_viewers(session, occurrence, user_ids)
+
+        recipients = [
+            (
+                user_id,
+                notification_data_pb2.EventUpdate(
+                    event=event_pbs[user_id],
+                    updating_user=updating_user_pbs[user_id],
                     updated_items=payload.updated_items,
                 ),
             )
+            for user_id in user_ids
+        ]
+
+        notify_many(session, recipients=recipients, topic_action="event:update", key=payload.occurrence_id)
 
 
 def generate_event_cancel_notifications(payload: jobs_pb2.GenerateEventCancelNotificationsPayload):
@@ -317,20 +404,25 @@ def generate_event_cancel_notifications(payload: jobs_pb2.GenerateEventCancelNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            if are_blocked(session, user_id, cancelling_user.id):
-                continue
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:cancel",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventCancel(
-                    event=event_to_pb(session, occurrence, context),
-                    cancelling_user=user_model_to_pb(cancelling_user, session, context),
+        blocked_user_ids = get_blocked_user_ids(session, cancelling_user.id)
+        user_ids = [
+            user_id for user_id in set(subscribed_user_ids + attending_user_ids) if user_id not in blocked_user_ids
+        ]
+        cancelling_user_pbs = user_to_pb_for_viewers(session, cancelling_user, user_ids)
+        event_pbs = event_to_pb_for_viewers(session, occurrence, user_ids)
+
+        recipients = [
+            (
+                user_id,
+                notification_data_pb2.EventCancel(
+                    event=event_pbs[user_id],
+                    cancelling_user=cancelling_user_pbs[user_id],
                 ),
             )
+            for user_id in user_ids
+        ]
+
+        notify_many(session, recipients=recipients, topic_action="event:cancel", key=payload.occurrence_id)
 
 
 def generate_event_delete_notifications(payload: jobs_pb2.GenerateEventDeleteNotificationsPayload):
@@ -342,17 +434,13 @@ def generate_event_delete_notifications(payload: jobs_pb2.GenerateEventDeleteNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:delete",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventDelete(
-                    event=event_to_pb(session, occurrence, context),
-                ),
-            )
+        event_pbs = event_to_pb_for_viewers(session, occurrence, set(subscribed_user_ids + attending_user_ids))
+
+        recipients = [
+            (user_id, notification_data_pb2.EventDelete(event=event_pb)) for user_id, event_pb in event_pbs.items()
+        ]
+
+        notify_many(session, recipients=recipients, topic_action="event:delete", key=payload.occurrence_id)
 
 
 class Events(events_pb2_grpc.EventsServicer):
@@ -1,54 +1,186 @@
-import json
+import hashlib
 import logging
+import threading
 
+import grpc
+from sqlalchemy import Text
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.sql import func
 
-from couchers.materialized_views import clustered_users, lite_users
-from couchers.models import Node, Page, PageType, PageVersion
+from couchers import errors
+from couchers.constants import CLUSTERED_USERS_TILES_MAX_ZOOM
+from couchers.db import get_watermark
+from couchers.materialized_views import (
+    CLUSTERED_USERS_WATERMARK,
+    LITE_USERS_WATERMARK,
+    clustered_users,
+    lite_users,
+)
+from couchers.models import ClusteredUsersTile, Node, Page, PageType, PageVersion
 from couchers.sql import couchers_select as select
+from couchers.sql import hidden_user_ids
 from proto import gis_pb2_grpc
 from proto.google.api import httpbody_pb2
 
 logger = logging.getLogger(__name__)
 
+# envoy's grpc-json transcoder always answers with a 200, the proxy replaces the status with the value of this header
+# when it's set (see app/proxy/envoy.yaml)
+HTTP_STATUS_HEADER = "x-couchers-http-status"
 
-def _build_geojson_select(statement):
+
+def _geojson_feature(subquery):
     """
-    See usages below.
+    A row of the subquery as a GeoJSON Feature, with the geom column as the geometry and the others as properties
     """
     # this is basically a translation of the postgis ST_AsGeoJSON example into sqlalchemy/geoalchemy2
-    return func.json_build_object(
+    return func.ST_AsGeoJSON(subquery.table_valued(), "geom", 5)
+
+
+def _render_geojson(session, statement):
+    """
+    Renders the statement as a GeoJSON FeatureCollection, passing the text from postgres straight through
+    """
+    collection = func.json_build_object(
         "type",
         "FeatureCollection",
         "features",
-        func.json_agg(func.ST_AsGeoJSON(statement.subquery(), maxdecimaldigits=5).cast(JSON)),
+        func.coalesce(func.json_agg(_geojson_feature(statement.subquery()).cast(JSON)), func.json_build_array()),
     )
+    return session.execute(select(collection.cast(Text))).scalar_one().encode()
+
+
+def _feature_collection(features):
+    return b'{"type": "FeatureCollection", "features": [' + b", ".join(features) + b"]}"
+
+
+def _etag(*parts):
+    return hashlib.blake2b(b"".join(parts), digest_size=16).hexdigest()
+
+
+def _conditional_response(context, content_type, etag, render, cache_control, weak=False):
+    """
+    Answers with the body from render(), or with a 304 Not Modified without calling it if the client already has the
+    version with this etag.
+
+    Responses that the proxy compresses need a weak etag, it drops strong ones since the body changes.
+    """
+    etag = f'W/"{etag}"' if weak else f'"{etag}"'
+    metadata = [("etag", etag), ("cache-control", cache_control)]
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    if_none_match = dict(context.invocation_metadata()).get("if-none-match", "")
+    if etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        context.send_initial_metadata(metadata + [(HTTP_STATUS_HEADER, "304")])
+        return httpbody_pb2.HttpBody(content_type=content_type)
+    context.send_initial_metadata(metadata)
+    return httpbody_pb2.HttpBody(content_type=content_type, data=render())
+
+
+def _geojson_response(context, data):
+    return _conditional_response(context, "application/json", _etag(data), lambda: data, "private, no-cache", weak=True)
+
+
+class GeoJSONCache:
+    """
+    Keeps the latest rendered version of each cached GeoJSON document.
+
+    The version is something that changes whenever the data does, like when the view it comes from was last refreshed,
+    so it's one cheap lookup per request and the document is only rendered again after a refresh.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (version, rendered)
+        self._entries = {}
+
+    def get(self, name, version, render):
+        if version is None:
+            return render()
+        entry = self._entries.get(name)
+        if entry and entry[0] == version:
+            return entry[1]
+        rendered = render()
+        with self._lock:
+            self._entries[name] = (version, rendered)
+        return rendered
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+geojson_cache = GeoJSONCache()
 
 
-def _statement_to_geojson_response(session, statement):
-    json_dict = session.execute(select(_build_geojson_select(statement))).scalar_one_or_none()
-    return httpbody_pb2.HttpBody(
-        content_type="application/json",
-        # json.dumps escapes non-ascii characters
-        data=json.dumps(json_dict).encode("ascii"),
+def _render_users(session):
+    """
+    Returns (features, etag), where features is a dict of user id to their GeoJSON Feature, of all visible users
+    regardless of who's looking
+    """
+    statement = (
+        select(lite_users.c.id, lite_users.c.geom, lite_users.c.has_completed_profile)
+        .where(lite_users.c.is_visible)
+        .where(lite_users.c.geom != None)
+        .order_by(lite_users.c.id)
+        .subquery()
     )
+    features = {
+        user_id: feature.encode()
+        for user_id, feature in session.execute(select(statement.c.id, _geojson_feature(statement)))
+    }
+    return features, _etag(*features.values())
+
+
+# tiles without any users aren't stored
+_EMPTY_TILE_ETAG = hashlib.md5(b"").hexdigest()
 
 
 class GIS(gis_pb2_grpc.GISServicer):
     def GetUsers(self, request, context, session):
-        statement = (
-            select(lite_users.c.id, lite_users.c.geom, lite_users.c.has_completed_profile)
-            .where_users_visible(context, table=lite_users.c)
-            .where(lite_users.c.geom != None)
+        features, etag = geojson_cache.get(
+            "users", get_watermark(session, LITE_USERS_WATERMARK), lambda: _render_users(session)
+        )
+        # the cached features are everyone visible, blocks are applied on top
+        hidden = hidden_user_ids(session, context.user_id) & features.keys()
+        if hidden:
+            etag = _etag(etag.encode(), *(str(user_id).encode() for user_id in sorted(hidden)))
+        return _conditional_response(
+            context,
+            "application/json",
+            etag,
+            lambda: _feature_collection(feature for user_id, feature in features.items() if user_id not in hidden),
+            "private, no-cache",
+            weak=True,
         )
-        return _statement_to_geojson_response(session, statement)
 
     def GetClusteredUsers(self, request, context, session):
-        return _statement_to_geojson_response(session, select(clustered_users.c.geom, clustered_users.c.count))
+        data = geojson_cache.get(
+            "clustered_users",
+            get_watermark(session, CLUSTERED_USERS_WATERMARK),
+            lambda: _render_geojson(session, select(clustered_users.c.geom, clustered_users.c.count)),
+        )
+        return _geojson_response(context, data)
+
+    def GetClusteredUsersTile(self, request, context, session):
+        if request.z > CLUSTERED_USERS_TILES_MAX_ZOOM or request.x >= 2**request.z or request.y >= 2**request.z:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, errors.INVALID_TILE)
+
+        tile = session.execute(
+            select(ClusteredUsersTile.data, ClusteredUsersTile.etag)
+            .where(ClusteredUsersTile.z == request.z)
+            .where(ClusteredUsersTile.x == request.x)
+            .where(ClusteredUsersTile.y == request.y)
+        ).one_or_none()
+        data, etag = tile or (b"", _EMPTY_TILE_ETAG)
+
+        # tiles are rebuilt in the background every minute, the etag is a hash of the tile so stays the same until the
+        # users in it change
+        return _conditional_response(
+            context, "application/vnd.mapbox-vector-tile", etag, lambda: data, "private, max-age=60"
+        )
 
     def GetCommunities(self, request, context, session):
-        return _statement_to_geojson_response(session, select(Node).where(Node.geom != None))
+        return _geojson_response(context, _render_geojson(session, select(Node).where(Node.geom != None)))
 
     def GetPlaces(self, request, context, session):
         # need to do a subquery here so we get pages without a geom, not just versions without geom
@@ -66,7 +198,7 @@ class GIS(gis_pb2_grpc.GISServicer):
             .where(PageVersion.geom != None)
         )
 
-        return _statement_to_geojson_response(session, statement)
+        return _geojson_response(context, _render_geojson(session, statement))
 
     def GetGuides(self, request, context, session):
         latest_pages = (
@@ -83,4 +215,4 @@ class GIS(gis_pb2_grpc.GISServicer):
             .where(PageVersion.geom != None)
         )
 
-        return _statement_to_geojson_response(session, statement)
+        return _geojson_response(context, _render_geojson(session, statement))
@@ -67,6 +67,7 @@ class Jail(jail_pb2_grpc.JailServicer):
 
         user.city = request.city
         user.geom = create_coordinate(request.lat, request.lng)
+        user.geom_last_updated = now()
         user.geom_radius = request.radius
 
         session.commit()
@@ -49,7 +49,7 @@ class Notifications(notifications_pb2_grpc.NotificationsServicer):
         user = session.execute(select(User).where(User.id == context.user_id)).scalar_one()
         return notifications_pb2.GetNotificationSettingsRes(
             do_not_email_enabled=user.do_not_email,
-            groups=get_user_setting_groups(user.id),
+            groups=get_user_setting_groups(session, user.id),
         )
 
     def SetNotificationSettings(self, request, context, session):
@@ -72,7 +72,7 @@ class Notifications(notifications_pb2_grpc.NotificationsServicer):
                 context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.CANNOT_EDIT_THAT_NOTIFICATION_PREFERENCE)
         return notifications_pb2.GetNotificationSettingsRes(
             do_not_email_enabled=user.do_not_email,
-            groups=get_user_setting_groups(user.id),
+            groups=get_user_setting_groups(session, user.id),
         )
 
     def ListNotifications(self, request, context, session):
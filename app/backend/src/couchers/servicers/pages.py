@@ -1,7 +1,16 @@
+from types import SimpleNamespace
+
 import grpc
 
 from couchers import errors
-from couchers.db import can_moderate_at, can_moderate_node, get_parent_node_at_location
+from couchers.db import (
+    can_moderate_at,
+    can_moderate_node,
+    get_parent_node_at_location,
+    users_who_are_cluster_admins,
+    users_who_can_moderate_at,
+    users_who_can_moderate_node,
+)
 from couchers.models import Cluster, Node, Page, PageType, PageVersion, Thread, Upload, User
 from couchers.servicers.threads import thread_to_pb
 from couchers.sql import couchers_select as select
@@ -96,6 +105,37 @@ def page_to_pb(session, page: Page, context):
     )
 
 
+def page_to_pb_for_viewers(session, page: Page, viewer_user_ids):
+    """
+    Renders a page as seen by each of the given users, for fanning out notifications. Returns a dict of viewer user_id ->
+    pages_pb2.Page
+    """
+    viewer_user_ids = list(viewer_user_ids)
+    if not viewer_user_ids:
+        return {}
+    base = page_to_pb(session, page, SimpleNamespace(user_id=viewer_user_ids[0]))
+
+    latest_version = page.versions[-1]
+    moderators = users_who_can_moderate_node(session, viewer_user_ids, page.parent_node_id)
+    if latest_version.geom is not None:
+        moderators |= users_who_can_moderate_at(session, viewer_user_ids, latest_version.geom)
+    if page.owner_cluster is not None:
+        moderators |= users_who_can_moderate_node(session, viewer_user_ids, page.owner_cluster.parent_node_id)
+    if page.owner_user:
+        owners = {page.owner_user_id}
+    else:
+        owners = users_who_are_cluster_admins(session, viewer_user_ids, [page.owner_cluster_id])
+
+    out = {}
+    for viewer_user_id in viewer_user_ids:
+        page_pb = pages_pb2.Page()
+        page_pb.CopyFrom(base)
+        page_pb.can_moderate = viewer_user_id in moderators
+        page_pb.can_edit = viewer_user_id in owners or page_pb.can_moderate
+        out[viewer_user_id] = page_pb
+    return out
+
+
 class Pages(pages_pb2_grpc.PagesServicer):
     def CreatePlace(self, request, context, session):
         if not request.title:
@@ -7,7 +7,6 @@ from sqlalchemy.orm import aliased
 from sqlalchemy.sql import and_, func, or_
 
 from couchers import errors
-from couchers.materialized_views import user_response_rates
 from couchers.metrics import (
     account_age_on_host_request_create_histogram,
     host_request_first_response_histogram,
@@ -15,7 +14,15 @@ from couchers.metrics import (
     host_requests_sent_counter,
     sent_messages_counter,
 )
-from couchers.models import Conversation, HostRequest, HostRequestStatus, Message, MessageType, User
+from couchers.models import (
+    Conversation,
+    HostRequest,
+    HostRequestStatus,
+    Message,
+    MessageType,
+    User,
+    UserResponseRate,
+)
 from couchers.notifications.notify import notify
 from couchers.servicers.api import response_rate_to_pb, user_model_to_pb
 from couchers.sql import couchers_select as select
@@ -638,8 +645,8 @@ class Requests(requests_pb2_grpc.RequestsServicer):
 
     def GetResponseRate(self, request, context, session):
         user_res = session.execute(
-            select(User.id, user_response_rates)
-            .outerjoin(user_response_rates, user_response_rates.c.user_id == User.id)
+            select(User.id, UserResponseRate)
+            .outerjoin(UserResponseRate, UserResponseRate.user_id == User.id)
             .where_users_visible(context)
             .where(User.id == request.user_id)
         ).one_or_none()
@@ -648,5 +655,5 @@ class Requests(requests_pb2_grpc.RequestsServicer):
         if not user_res:
             context.abort(grpc.StatusCode.NOT_FOUND, errors.USER_NOT_FOUND)
 
-        user, *response_rates = user_res
-        return requests_pb2.GetResponseRateRes(**response_rate_to_pb(response_rates))
+        _, response_rate = user_res
+        return requests_pb2.GetResponseRateRes(**response_rate_to_pb(response_rate))
@@ -2,10 +2,10 @@
 See //docs/search.md for overview.
 """
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 import grpc
-from sqlalchemy.sql import and_, func, or_
+from sqlalchemy.sql import and_, func, or_, tuple_
 
 from couchers import errors
 from couchers.crypto import decrypt_page_token, encrypt_page_token
@@ -25,6 +25,7 @@ from couchers.models import (
     Reference,
     StrongVerificationAttempt,
     User,
+    UserNode,
 )
 from couchers.servicers.account import has_strong_verification
 from couchers.servicers.api import (
@@ -34,19 +35,17 @@ from couchers.servicers.api import (
     parkingdetails2sql,
     sleepingarrangement2sql,
     smokinglocation2sql,
-    user_model_to_pb,
+    users_to_pb,
 )
 from couchers.servicers.communities import community_to_pb
 from couchers.servicers.events import event_to_pb
 from couchers.servicers.groups import group_to_pb
 from couchers.servicers.pages import page_to_pb
+from couchers.sql import approximate_count
 from couchers.sql import couchers_select as select
 from couchers.utils import (
     create_coordinate,
-    dt_from_millis,
     last_active_coarsen,
-    millis_from_dt,
-    now,
     to_aware_datetime,
 )
 from proto import search_pb2, search_pb2_grpc
@@ -69,29 +68,6 @@ def _join_with_space(coalesces):
     return out
 
 
-def _build_tsv(A, B=None, C=None, D=None):
-    """
-    Given lists for A, B, C, and D, builds a tsvector from them.
-    """
-    B = B or []
-    C = C or []
-    D = D or []
-    tsv = func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in A])), "A")
-    if B:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in B])), "B")
-        )
-    if C:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in C])), "C")
-        )
-    if D:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in D])), "D")
-        )
-    return tsv
-
-
 def _build_doc(A, B=None, C=None, D=None):
     """
     Builds the raw document (without to_tsvector and weighting), used for extracting snippet
@@ -113,7 +89,7 @@ def _similarity(statement, text):
     return func.word_similarity(func.unaccent(statement), func.unaccent(text))
 
 
-def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None, C=None, D=None):
+def _gen_search_elements(statement, title_only, next_rank, page_size, tsv, A, B=None, C=None, D=None):
     """
     Given an sql statement and four sets of fields, (A, B, C, D), generates a bunch of postgres expressions for full text search.
 
@@ -121,6 +97,9 @@ def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None,
 
     A should be the "title", the others can be anything.
 
+    tsv is the stored, weighted tsvector over these fields (the search_vector columns), so that rows don't need to be
+    tokenized again on every search.
+
     If title_only=True, we only perform a trigram search against A only
     """
     B = B or []
@@ -130,9 +109,6 @@ def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None,
         # a postgres tsquery object that can be used to match against a tsvector
         tsq = func.websearch_to_tsquery(REGCONFIG, statement)
 
-        # the tsvector object that we want to search against with our tsquery
-        tsv = _build_tsv(A, B, C, D)
-
         # document to generate snippet from
         doc = _build_doc(A, B, C, D)
 
@@ -196,6 +172,7 @@ def _search_users(session, search_statement, title_only, next_rank, page_size, c
         title_only,
         next_rank,
         page_size,
+        User.search_vector,
         [User.username, User.name],
         [User.city],
         [User.about_me],
@@ -203,14 +180,15 @@ def _search_users(session, search_statement, title_only, next_rank, page_size, c
     )
 
     users = execute_search_statement(session, select(User, rank, snippet).where_users_visible(context))
+    user_pbs = users_to_pb(session, [user for user, _, _ in users], context)
 
     return [
         search_pb2.Result(
             rank=rank,
-            user=user_model_to_pb(page, session, context),
+            user=user_pb,
             snippet=snippet,
         )
-        for page, rank, snippet in users
+        for (_, rank, snippet), user_pb in zip(users, user_pbs)
     ]
 
 
@@ -220,6 +198,7 @@ def _search_pages(session, search_statement, title_only, next_rank, page_size, c
         title_only,
         next_rank,
         page_size,
+        PageVersion.search_vector,
         [PageVersion.title],
         [PageVersion.address],
         [],
@@ -265,6 +244,7 @@ def _search_events(session, search_statement, title_only, next_rank, page_size,
         title_only,
         next_rank,
         page_size,
+        Event.search_vector.concat(EventOccurrence.search_vector),
         [Event.title],
         [EventOccurrence.address, EventOccurrence.link],
         [],
@@ -299,6 +279,8 @@ def _search_clusters(
         title_only,
         next_rank,
         page_size,
+        # the main page's stored vector weighs its title like a title (A) rather than with the address (B)
+        Cluster.search_vector.concat(PageVersion.search_vector),
         [Cluster.name],
         [PageVersion.address, PageVersion.title],
         [Cluster.description],
@@ -338,6 +320,20 @@ def _search_clusters(
     ]
 
 
+def _decode_page_token(context, page_token, *parsers):
+    """
+    Decrypts a keyset page token of comma separated values and parses them with the given functions, aborting with
+    INVALID_ARGUMENT if it's not a valid one (e.g. it's from before the current format)
+    """
+    try:
+        values = decrypt_page_token(page_token).split(",")
+        if len(values) != len(parsers):
+            raise ValueError(f"Expected {len(parsers)} values in page token, got {len(values)}")
+        return [parse(value) for parse, value in zip(parsers, values)]
+    except Exception:
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, errors.INVALID_PAGE_TOKEN)
+
+
 class Search(search_pb2_grpc.SearchServicer):
     def Search(self, request, context, session):
         page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
@@ -402,23 +398,23 @@ class Search(search_pb2_grpc.SearchServicer):
         else:
             # Apply all the normal filters
             if request.HasField("query"):
+                pattern = f"%{request.query.value}%"
+                # the trigram index on the search document narrows it down to users where one of the fields might
+                # match, the individual fields are then rechecked so matches can't straddle two of them
+                statement = statement.where(User.search_document.ilike(pattern))
                 if request.query_name_only:
-                    statement = statement.where(
-                        or_(
-                            User.name.ilike(f"%{request.query.value}%"), User.username.ilike(f"%{request.query.value}%")
-                        )
-                    )
+                    statement = statement.where(or_(User.name.ilike(pattern), User.username.ilike(pattern)))
                 else:
                     statement = statement.where(
                         or_(
-                            User.name.ilike(f"%{request.query.value}%"),
-                            User.username.ilike(f"%{request.query.value}%"),
-                            User.city.ilike(f"%{request.query.value}%"),
-                            User.hometown.ilike(f"%{request.query.value}%"),
-                            User.about_me.ilike(f"%{request.query.value}%"),
-                            User.things_i_like.ilike(f"%{request.query.value}%"),
-                            User.about_place.ilike(f"%{request.query.value}%"),
-                            User.additional_information.ilike(f"%{request.query.value}%"),
+                            User.name.ilike(pattern),
+                            User.username.ilike(pattern),
+                            User.city.ilike(pattern),
+                            User.hometown.ilike(pattern),
+                            User.about_me.ilike(pattern),
+                            User.things_i_like.ilike(pattern),
+                            User.about_place.ilike(pattern),
+                            User.additional_information.ilike(pattern),
                         )
                     )
 
@@ -545,7 +541,7 @@ class Search(search_pb2_grpc.SearchServicer):
                 ).scalar_one_or_none()
                 if not node:
                     context.abort(grpc.StatusCode.NOT_FOUND, errors.COMMUNITY_NOT_FOUND)
-                statement = statement.where(func.ST_Contains(node.geom, User.geom))
+                statement = statement.where(User.id.in_(select(UserNode.user_id).where(UserNode.node_id == node.id)))
 
             if request.only_with_references:
                 references = (
@@ -568,26 +564,30 @@ class Search(search_pb2_grpc.SearchServicer):
             # bool friends_only = 13;
 
         page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
-        next_recommendation_score = float(decrypt_page_token(request.page_token)) if request.page_token else 1e10
-        total_items = session.execute(select(func.count()).select_from(statement.subquery())).scalar()
+        total_items = approximate_count(session, statement)
 
-        statement = (
-            statement.where(User.recommendation_score <= next_recommendation_score)
-            .order_by(User.recommendation_score.desc())
-            .limit(page_size + 1)
-        )
+        # the page token is the (recommendation_score, id) of the first user on the next page
+        if request.page_token:
+            next_recommendation_score, next_user_id = _decode_page_token(context, request.page_token, float, int)
+            statement = statement.where(
+                tuple_(User.recommendation_score, User.id) <= tuple_(next_recommendation_score, next_user_id)
+            )
+
+        statement = statement.order_by(User.recommendation_score.desc(), User.id.desc()).limit(page_size + 1)
         users = session.execute(statement).scalars().all()
 
         return search_pb2.UserSearchRes(
             results=[
                 search_pb2.Result(
                     rank=1,
-                    user=user_model_to_pb(user, session, context),
+                    user=user_pb,
                 )
-                for user in users[:page_size]
+                for user_pb in users_to_pb(session, users[:page_size], context)
             ],
             next_page_token=(
-                encrypt_page_token(str(users[-1].recommendation_score)) if len(users) > page_size else None
+                encrypt_page_token(f"{users[-1].recommendation_score!r},{users[-1].id}")
+                if len(users) > page_size
+                else None
             ),
             total_items=total_items,
         )
@@ -700,30 +700,46 @@ class Search(search_pb2_grpc.SearchServicer):
             statement = statement.where(EventOccurrence.end_time < to_aware_datetime(request.before))
 
         page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
-        # the page token is a unix timestamp of where we left off
-        page_token = (
-            dt_from_millis(int(request.page_token)) if request.page_token and not request.page_number else now()
-        )
-        page_number = request.page_number or 1
-        # Calculate the offset for pagination
-        offset = (page_number - 1) * page_size
 
+        # in SQL rather than bound from python, so that the statement (and its approximate_count cache key) is the same
+        # from one request to the next
         if not request.past:
-            statement = statement.where(EventOccurrence.end_time > page_token - timedelta(seconds=1)).order_by(
-                EventOccurrence.start_time.asc()
-            )
+            statement = statement.where(EventOccurrence.end_time > func.now() - timedelta(seconds=1))
         else:
-            statement = statement.where(EventOccurrence.end_time < page_token + timedelta(seconds=1)).order_by(
-                EventOccurrence.start_time.desc()
+            statement = statement.where(EventOccurrence.end_time < func.now() + timedelta(seconds=1))
+
+        total_items = approximate_count(session, statement)
+
+        # the page token is the (start time, occurrence id) of the first event on the next page, it's ignored when asking
+        # for a numbered page
+        if request.page_token and not request.page_number:
+            next_start_time, next_occurrence_id = _decode_page_token(
+                context, request.page_token, datetime.fromisoformat, int
             )
+            next_key = tuple_(next_start_time, next_occurrence_id)
+            if not request.past:
+                statement = statement.where(tuple_(EventOccurrence.start_time, EventOccurrence.id) >= next_key)
+            else:
+                statement = statement.where(tuple_(EventOccurrence.start_time, EventOccurrence.id) <= next_key)
+
+        if not request.past:
+            statement = statement.order_by(EventOccurrence.start_time.asc(), EventOccurrence.id.asc())
+        else:
+            statement = statement.order_by(EventOccurrence.start_time.desc(), EventOccurrence.id.desc())
 
-        total_items = session.execute(select(func.count()).select_from(statement.subquery())).scalar()
-        # Apply pagination by page number
-        statement = statement.offset(offset).limit(page_size) if request.page_number else statement.limit(page_size + 1)
+        if request.page_number:
+            # numbered pages can't be seeked to, so these still need an offset
+            statement = statement.offset((request.page_number - 1) * page_size).limit(page_size)
+        else:
+            statement = statement.limit(page_size + 1)
         occurrences = session.execute(statement).scalars().all()
 
         return search_pb2.EventSearchRes(
             events=[event_to_pb(session, occurrence, context) for occurrence in occurrences[:page_size]],
-            next_page_token=(str(millis_from_dt(occurrences[-1].end_time)) if len(occurrences) > page_size else None),
+            next_page_token=(
+                encrypt_page_token(f"{occurrences[-1].start_time.isoformat()},{occurrences[-1].id}")
+                if len(occurrences) > page_size
+                else None
+            ),
             total_items=total_items,
         )
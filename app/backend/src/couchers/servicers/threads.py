@@ -9,9 +9,9 @@ from couchers import errors
 from couchers.db import session_scope
 from couchers.jobs.enqueue import queue_job
 from couchers.models import Comment, Discussion, Event, EventOccurrence, Reply, Thread, User
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.notify import notify, notify_many
+from couchers.servicers.api import user_model_to_pb, user_to_pb_for_viewers
+from couchers.servicers.blocking import are_blocked, get_blocked_user_ids
 from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime
 from proto import notification_data_pb2, threads_pb2, threads_pb2_grpc
@@ -57,7 +57,7 @@ def thread_to_pb(session, database_id):
 
 def generate_reply_notifications(payload: jobs_pb2.GenerateReplyNotificationsPayload):
     from couchers.servicers.discussions import discussion_to_pb
-    from couchers.servicers.events import event_to_pb
+    from couchers.servicers.events import event_to_pb, event_to_pb_for_viewers
 
     with session_scope() as session:
         database_id, depth = unpack_thread_id(payload.thread_id)
@@ -85,23 +85,28 @@ def generate_reply_notifications(payload: jobs_pb2.GenerateReplyNotificationsPay
                 subscribed_user_ids = [user.id for user in event.subscribers]
                 attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-                for user_id in set(subscribed_user_ids + attending_user_ids):
-                    if are_blocked(session, user_id, comment.author_user_id):
-                        continue
-                    if user_id == comment.author_user_id:
-                        continue
-                    context = SimpleNamespace(user_id=user_id)
-                    notify(
-                        session,
-                        user_id=user_id,
-                        topic_action="event:comment",
-                        key=occurrence.id,
-                        data=notification_data_pb2.EventComment(
+                blocked_user_ids = get_blocked_user_ids(session, comment.author_user_id)
+                user_ids = [
+                    user_id
+                    for user_id in set(subscribed_user_ids + attending_user_ids)
+                    if user_id not in blocked_user_ids and user_id != comment.author_user_id
+                ]
+                event_pbs = event_to_pb_for_viewers(session, occurrence, user_ids)
+                author_pbs = user_to_pb_for_viewers(session, author_user, user_ids)
+
+                recipients = [
+                    (
+                        user_id,
+                        notification_data_pb2.EventComment(
                             reply=reply,
-                            event=event_to_pb(session, occurrence, context),
-                            author=user_model_to_pb(author_user, session, context),
+                            event=event_pbs[user_id],
+                            author=author_pbs[user_id],
                         ),
                     )
+                    for user_id in user_ids
+                ]
+
+                notify_many(session, recipients=recipients, topic_action="event:comment", key=occurrence.id)
             elif discussion:
                 # community discussion thread
                 cluster = discussion.owner_cluster
@@ -1,6 +1,12 @@
+import threading
+from time import monotonic
+
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import aliased
-from sqlalchemy.sql import Select, union
+from sqlalchemy.sql import Select, func, union
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
+from couchers.constants import APPROXIMATE_COUNT_CACHE_TTL, APPROXIMATE_COUNT_EXACT_LIMIT
 from couchers.models import User, UserBlock
 from couchers.utils import is_valid_email, is_valid_user_id, is_valid_username
 
@@ -16,6 +22,14 @@ def _relevant_user_blocks(user_id):
     return couchers_select(union(blocked_users, blocking_users).subquery())
 
 
+def hidden_user_ids(session, user_id):
+    """
+    Set of ids of users that this user has blocked or been blocked by, for hiding them from results fetched some way
+    other than a query that can use where_users_visible
+    """
+    return set(session.execute(_relevant_user_blocks(user_id)).scalars().all())
+
+
 """
 This method construct provided directly by the developers
 They intend to implement a better option in the near future
@@ -77,3 +91,57 @@ class CouchersSelect(Select):
             .where(aliased_user.is_visible)
             .where(~aliased_user.id.in_(hidden_users))
         )
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) for a statement, returns one row with the plan
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+# (sql, params) -> (expires_at, count)
+_approximate_counts = {}
+_approximate_counts_lock = threading.Lock()
+# drop everything rather than track recency if we somehow pile up this many different statements
+_APPROXIMATE_COUNTS_MAX_ENTRIES = 10_000
+
+
+def approximate_count(session, statement):
+    """
+    Counts the rows a statement returns, for showing total numbers of results next to paginated lists.
+
+    Counts up to APPROXIMATE_COUNT_EXACT_LIMIT are exact and only cost scanning that many rows. Beyond that the query
+    planner's estimate is returned instead (but never less than the limit), and cached for
+    APPROXIMATE_COUNT_CACHE_TTL so that paging through a big result set doesn't redo this on every page.
+    """
+    compiled = statement.compile(dialect=session.get_bind().dialect, compile_kwargs={"render_postcompile": True})
+    key = (compiled.string, repr(sorted(compiled.params.items())))
+
+    cached = _approximate_counts.get(key)
+    if cached and cached[0] > monotonic():
+        return cached[1]
+
+    count = session.execute(
+        couchers_select(func.count()).select_from(statement.limit(APPROXIMATE_COUNT_EXACT_LIMIT + 1).subquery())
+    ).scalar_one()
+    if count <= APPROXIMATE_COUNT_EXACT_LIMIT:
+        return count
+
+    (plan,) = session.execute(Explain(statement)).scalar_one()
+    count = max(int(plan["Plan"]["Plan Rows"]), APPROXIMATE_COUNT_EXACT_LIMIT)
+
+    with _approximate_counts_lock:
+        if len(_approximate_counts) >= _APPROXIMATE_COUNTS_MAX_ENTRIES:
+            _approximate_counts.clear()
+        _approximate_counts[key] = (monotonic() + APPROXIMATE_COUNT_CACHE_TTL.total_seconds(), count)
+    return count
@@ -1,12 +1,13 @@
 import logging
 
-from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import and_, cast, literal, or_
 
 from couchers import email, urls
 from couchers.config import config
-from couchers.constants import SIGNUP_EMAIL_TOKEN_VALIDITY
+from couchers.constants import SIGNUP_EMAIL_TOKEN_VALIDITY, WATERMARK_OVERLAP
 from couchers.crypto import urlsafe_secure_token
-from couchers.db import session_scope
+from couchers.db import get_watermark, session_scope, set_watermark
 from couchers.models import (
     Cluster,
     ClusterRole,
@@ -14,6 +15,7 @@ from couchers.models import (
     EventCommunityInviteRequest,
     Node,
     User,
+    UserNode,
 )
 from couchers.sql import couchers_select as select
 from couchers.templates.v2 import send_simple_pretty_email
@@ -141,33 +143,36 @@ def send_account_deletion_report_email(session, reason):
     )
 
 
-def enforce_community_memberships():
+def enforce_community_memberships(incremental=False):
     """
-    Go through all communities and make sure every user in the polygon is also a member
+    Makes sure every visible user is a member of the official cluster of every node whose polygon contains them.
+
+    Incrementally, only users and nodes whose geom changed since the last run are looked at. Anything else that makes a
+    user eligible (e.g. being unbanned) is left for the next full run.
     """
     with session_scope() as session:
-        for node in session.execute(select(Node)).scalars().all():
-            existing_users = select(ClusterSubscription.user_id).where(
-                ClusterSubscription.cluster == node.official_cluster
-            )
-            users_needing_adding = (
-                session.execute(
-                    select(User)
-                    .where(User.is_visible)
-                    .where(func.ST_Contains(node.geom, User.geom))
-                    .where(~User.id.in_(existing_users))
-                )
-                .scalars()
-                .all()
+        started = now()
+        statement = (
+            select(User.id, Cluster.id, cast(literal(ClusterRole.member.name), ClusterSubscription.role.type))
+            .join(UserNode, UserNode.user_id == User.id)
+            .join(Node, Node.id == UserNode.node_id)
+            .join(Cluster, and_(Cluster.parent_node_id == Node.id, Cluster.is_official_cluster))
+            .where(User.is_visible)
+        )
+        if incremental:
+            watermark = get_watermark(session, "enforce_community_memberships")
+            if watermark:
+                since = watermark - WATERMARK_OVERLAP
+                statement = statement.where(or_(User.geom_last_updated > since, Node.geom_last_updated > since))
+        result = session.execute(
+            insert(ClusterSubscription)
+            .from_select(
+                [ClusterSubscription.user_id, ClusterSubscription.cluster_id, ClusterSubscription.role], statement
             )
-            for user in users_needing_adding:
-                node.official_cluster.cluster_subscriptions.append(
-                    ClusterSubscription(
-                        user=user,
-                        role=ClusterRole.member,
-                    )
-                )
-            session.commit()
+            .on_conflict_do_nothing(index_elements=[ClusterSubscription.user_id, ClusterSubscription.cluster_id])
+        )
+        set_watermark(session, "enforce_community_memberships", started)
+        logger.info(f"Added {result.rowcount} community memberships ({incremental=})")
 
 
 def enforce_community_memberships_for_user(session, user):
@@ -177,9 +182,9 @@ def enforce_community_memberships_for_user(session, user):
     cluster_ids = (
         session.execute(
             select(Cluster.id)
-            .join(Node, Node.id == Cluster.parent_node_id)
+            .join(UserNode, UserNode.node_id == Cluster.parent_node_id)
             .where(Cluster.is_official_cluster)
-            .where(func.ST_Contains(Node.geom, user.geom))
+            .where(UserNode.user_id == user.id)
         )
         .scalars()
         .all()
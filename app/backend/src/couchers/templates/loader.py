@@ -0,0 +1,48 @@
+"""
+Jinja loaders for email templates, so they're compiled once and then rendered from the environment's template cache
+"""
+
+from jinja2 import FileSystemLoader
+
+from couchers.config import config
+
+# where the unsubscribe section goes in v2 email templates, it's passed in at render time as it has per-user links
+UNSUB_SECTION_SLOT = "{{ _unsub_section }}"
+
+
+class EmailTemplateLoader(FileSystemLoader):
+    """
+    Like FileSystemLoader, but templates are only checked for changes on disk in dev (so edits there are picked up
+    straight away), in prod they are compiled the first time they're used and then kept
+    """
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return source, filename, lambda: not config["DEV"] or uptodate()
+
+
+class V2EmailTemplateLoader(EmailTemplateLoader):
+    """
+    Loads v2 email templates with a slot for the unsubscribe section: at the end of the plain text ones, and in place of
+    the ___UNSUB_SECTION___ marker in the generated html ones
+    """
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        if template.endswith(".txt"):
+            source += UNSUB_SECTION_SLOT
+        else:
+            source = source.replace("___UNSUB_SECTION___", UNSUB_SECTION_SLOT)
+        return source, filename, uptodate
+
+
+class SystemEmailTemplateLoader(EmailTemplateLoader):
+    """
+    Loads system email templates as two separate templates, "<name>.md:frontmatter" and "<name>.md:body"
+    """
+
+    def get_source(self, environment, template):
+        name, _, part = template.rpartition(":")
+        source, filename, uptodate = super().get_source(environment, name)
+        _, frontmatter_source, text_source = source.split("---", 2)
+        return frontmatter_source if part == "frontmatter" else text_source.strip(), filename, uptodate
@@ -9,18 +9,19 @@ from pathlib import Path
 from zoneinfo import ZoneInfo
 
 import phonenumbers
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment
 
 from couchers import urls
 from couchers.config import config
 from couchers.email import queue_email
+from couchers.templates.loader import V2EmailTemplateLoader
 from couchers.utils import get_tz_as_text, now, to_aware_datetime
 
 logger = logging.getLogger(__name__)
 
 template_folder = Path(__file__).parent / ".." / ".." / ".." / "templates" / "v2"
 
-loader = FileSystemLoader(template_folder)
+loader = V2EmailTemplateLoader(template_folder)
 env = Environment(loader=loader, trim_blocks=True)
 
 
@@ -90,6 +91,17 @@ def add_filters(env):
 add_filters(env)
 
 
+def render_email(template_name, template_args, plain_unsub_section, html_unsub_section):
+    """
+    Renders the plain text and html versions of an email, the templates are compiled once and then cached by env
+    """
+    plain = env.get_template(f"{template_name}.txt").render(template_args, _unsub_section=plain_unsub_section)
+    html = env.get_template(f"generated_html/{template_name}.html").render(
+        template_args, _unsub_section=html_unsub_section
+    )
+    return plain, html
+
+
 def send_simple_pretty_email(session, recipient, subject, template_name, template_args):
     """
     This is a simplified version of couchers.notifications.background._send_email_notification
@@ -102,10 +114,7 @@ def send_simple_pretty_email(session, recipient, subject, template_name, templat
     plain_unsub_section = "\n\n---\n\nThis is a security email, you cannot unsubscribe from it."
     html_unsub_section = "This is a security email, you cannot unsubscribe from it."
 
-    plain_tmplt = (template_folder / f"{template_name}.txt").read_text()
-    plain = env.from_string(plain_tmplt + plain_unsub_section).render(template_args)
-    html_tmplt = (template_folder / "generated_html" / f"{template_name}.html").read_text()
-    html = env.from_string(html_tmplt.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    plain, html = render_email(template_name, template_args, plain_unsub_section, html_unsub_section)
 
     queue_email(
         session,
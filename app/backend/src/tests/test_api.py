@@ -1,15 +1,19 @@
 from datetime import timedelta
+from types import SimpleNamespace
 
 import grpc
 import pytest
 from google.protobuf import empty_pb2, wrappers_pb2
+from sqlalchemy.sql import func, update
 
 from couchers import errors
+from couchers.activity import user_profile_cache
 from couchers.db import session_scope
 from couchers.jobs.handlers import update_badges
-from couchers.materialized_views import refresh_materialized_views_rapid
-from couchers.models import FriendRelationship, FriendStatus
+from couchers.materialized_views import check_lite_users, refresh_materialized_views_rapid
+from couchers.models import FriendRelationship, FriendStatus, LiteUserChange, User
 from couchers.resources import get_badge_dict
+from couchers.servicers.api import user_model_to_pb, user_to_pb_for_viewers, users_to_pb
 from couchers.sql import couchers_select as select
 from couchers.utils import create_coordinate, to_aware_datetime
 from proto import api_pb2, jail_pb2, notifications_pb2
@@ -79,6 +83,37 @@ def test_ping(db):
     assert not res.user.HasField("pending_friend_request")
 
 
+def test_ping_etag(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+
+    with api_session(token1) as api:
+        res = api.Ping(api_pb2.PingReq())
+        assert res.etag
+        assert not res.not_modified
+
+        # nothing changed
+        res2 = api.Ping(api_pb2.PingReq(etag=res.etag))
+        assert res2.not_modified
+        assert res2.etag == res.etag
+        assert not res2.HasField("user")
+
+        # a stale etag gets the full response
+        res3 = api.Ping(api_pb2.PingReq(etag="stale"))
+        assert not res3.not_modified
+        assert res3.user.user_id == user1.id
+        assert res3.etag == res.etag
+
+    with api_session(token2) as api:
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user1.id))
+
+    with api_session(token1) as api:
+        res4 = api.Ping(api_pb2.PingReq(etag=res.etag))
+        assert not res4.not_modified
+        assert res4.pending_friend_request_count == 1
+        assert res4.etag != res.etag
+
+
 def test_coords(db):
     # make them have not added a location
     user1, token1 = generate_user(geom=None, geom_radius=None)
@@ -166,6 +201,110 @@ def test_get_user(db):
         assert res.name == user2.name
 
 
+def test_users_to_pb(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+    user4, token4 = generate_user()
+    user5, token5 = generate_user()
+
+    make_friends(user1, user2)
+
+    with api_session(token1) as api:
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user3.id))
+
+    with api_session(token4) as api:
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user1.id))
+
+    with session_scope() as session:
+        db_users = [
+            session.execute(select(User).where(User.id == user.id)).scalar_one()
+            for user in [user1, user2, user3, user4, user5]
+        ]
+        res = users_to_pb(session, db_users, SimpleNamespace(user_id=user1.id))
+
+        assert [user.user_id for user in res] == [user1.id, user2.id, user3.id, user4.id, user5.id]
+        assert [user.friends for user in res] == [
+            api_pb2.User.FriendshipStatus.NA,
+            api_pb2.User.FriendshipStatus.FRIENDS,
+            api_pb2.User.FriendshipStatus.PENDING,
+            api_pb2.User.FriendshipStatus.PENDING,
+            api_pb2.User.FriendshipStatus.NOT_FRIENDS,
+        ]
+        assert res[2].pending_friend_request.sent
+        assert res[2].pending_friend_request.user_id == user3.id
+        assert not res[3].pending_friend_request.sent
+        assert res[3].pending_friend_request.user_id == user4.id
+        assert not res[4].HasField("pending_friend_request")
+
+        # the same thing rendered one at a time
+        for db_user, user in zip(db_users, res):
+            assert user_model_to_pb(db_user, session, SimpleNamespace(user_id=user1.id)) == user
+
+        # and user1 as seen by everyone
+        res = user_to_pb_for_viewers(session, db_users[0], [user1.id, user2.id, user3.id, user4.id, user5.id])
+        assert res[user1.id].friends == api_pb2.User.FriendshipStatus.NA
+        assert res[user2.id].friends == api_pb2.User.FriendshipStatus.FRIENDS
+        assert res[user3.id].friends == api_pb2.User.FriendshipStatus.PENDING
+        assert not res[user3.id].pending_friend_request.sent
+        assert res[user4.id].friends == api_pb2.User.FriendshipStatus.PENDING
+        assert res[user4.id].pending_friend_request.sent
+        assert res[user5.id].friends == api_pb2.User.FriendshipStatus.NOT_FRIENDS
+        assert all(user.name == user1.name for user in res.values())
+
+
+def test_user_profile_cache_invalidation(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+
+    with api_session(token2) as api:
+        api.UpdateProfile(
+            api_pb2.UpdateProfileReq(
+                name=wrappers_pb2.StringValue(value="Before"),
+                regions_visited=api_pb2.RepeatedStringValue(value=["FIN", "REU"]),
+            )
+        )
+
+    with api_session(token1) as api:
+        res = api.GetUser(api_pb2.GetUserReq(user=user2.username))
+        assert res.name == "Before"
+        assert res.regions_visited == ["FIN", "REU"]
+
+    with api_session(token2) as api:
+        api.GetUser(api_pb2.GetUserReq(user=user1.username))
+
+    # regions are removed with a bulk delete, which only drops that user's profile
+    with api_session(token2) as api:
+        api.UpdateProfile(
+            api_pb2.UpdateProfileReq(
+                regions_visited=api_pb2.RepeatedStringValue(value=[]),
+            )
+        )
+
+    with session_scope() as session:
+        assert user_profile_cache.get_many(session, [user1.id, user2.id]).keys() == {user1.id}
+
+    with api_session(token1) as api:
+        res = api.GetUser(api_pb2.GetUserReq(user=user2.username))
+        assert res.regions_visited == []
+
+    with api_session(token2) as api:
+        api.UpdateProfile(api_pb2.UpdateProfileReq(name=wrappers_pb2.StringValue(value="After")))
+
+    with api_session(token1) as api:
+        assert api.GetUser(api_pb2.GetUserReq(user=user2.username)).name == "After"
+
+    # changes within the same transaction are seen before they're committed
+    with session_scope() as session:
+        db_user = session.execute(select(User).where(User.id == user2.id)).scalar_one()
+        db_user.name = "Uncommitted"
+        assert user_model_to_pb(db_user, session, SimpleNamespace(user_id=user1.id)).name == "Uncommitted"
+        session.rollback()
+
+    with api_session(token1) as api:
+        assert api.GetUser(api_pb2.GetUserReq(user=user2.username)).name == "After"
+
+
 def test_lite_coords(db):
     # make them have not added a location
     user1, token1 = generate_user(geom=None, geom_radius=None)
@@ -261,6 +400,41 @@ def test_lite_get_user(db):
         assert res.name == user2.name
 
 
+def test_lite_users_incremental(db):
+    user1, token1 = generate_user()
+    user2, _ = generate_user(name="Before")
+
+    refresh_materialized_views_rapid(None)
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(LiteUserChange)).scalar_one() == 0
+        session.execute(select(User).where(User.id == user2.id)).scalar_one().name = "After"
+
+    # queued, but not applied until the refresh runs
+    with api_session(token1) as api:
+        assert api.GetLiteUser(api_pb2.GetLiteUserReq(user=user2.username)).name == "Before"
+
+    refresh_materialized_views_rapid(None)
+
+    with api_session(token1) as api:
+        assert api.GetLiteUser(api_pb2.GetLiteUserReq(user=user2.username)).name == "After"
+
+    # bulk updates bypass the change log, the consistency check fixes them
+    with session_scope() as session:
+        session.execute(update(User).where(User.id == user2.id).values(name="Bulk"))
+
+    refresh_materialized_views_rapid(None)
+
+    with api_session(token1) as api:
+        assert api.GetLiteUser(api_pb2.GetLiteUserReq(user=user2.username)).name == "After"
+
+    check_lite_users(empty_pb2.Empty())
+
+    with api_session(token1) as api:
+        assert api.GetLiteUser(api_pb2.GetLiteUserReq(user=user2.username)).name == "Bulk"
+        assert api.GetLiteUser(api_pb2.GetLiteUserReq(user=user1.username)).name == user1.name
+
+
 def test_GetLiteUsers(db):
     user1, token1 = generate_user()
     user2, _ = generate_user()
@@ -6,15 +6,18 @@ import requests
 from google.protobuf import empty_pb2
 from sqlalchemy.sql import delete, func
 
+import couchers.jobs.handlers
 import couchers.jobs.worker
+import couchers.materialized_views
 from couchers.config import config
 from couchers.crypto import urlsafe_secure_token
-from couchers.db import session_scope
+from couchers.db import listen_scope, session_scope
 from couchers.email import queue_email
 from couchers.email.dev import print_dev_email
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import JOB_QUEUE_CHANNEL, queue_job, queue_jobs_bulk
 from couchers.jobs.handlers import (
     add_users_to_email_list,
+    send_emails,
     send_message_notifications,
     send_onboarding_emails,
     send_reference_reminders,
@@ -22,7 +25,17 @@ from couchers.jobs.handlers import (
     update_badges,
     update_recommendation_scores,
 )
-from couchers.jobs.worker import _run_job_and_schedule, process_job, run_scheduler, service_jobs
+from couchers.jobs.worker import (
+    JobQueueListener,
+    _run_job_and_schedule,
+    claim_jobs,
+    process_claimed_job,
+    process_claimed_jobs,
+    process_job,
+    run_scheduler,
+    service_jobs,
+)
+from couchers.materialized_views import MATERIALIZED_VIEW_SOURCES, refresh_materialized_views
 from couchers.metrics import create_prometheus_server
 from couchers.models import (
     AccountDeletionToken,
@@ -30,12 +43,14 @@ from couchers.models import (
     BackgroundJobState,
     Email,
     LoginToken,
+    MaterializedViewRefresh,
     PasswordResetToken,
     UserBadge,
 )
 from couchers.sql import couchers_select as select
 from couchers.utils import now, today
 from proto import conversations_pb2, requests_pb2
+from proto.internal import jobs_pb2
 from tests.test_fixtures import (  # noqa
     auth_api_session,
     conversations_session,
@@ -105,6 +120,77 @@ def test_email_job(db):
         )
 
 
+def test_email_jobs_batched(db, monkeypatch):
+    with session_scope() as session:
+        for i in range(3):
+            queue_email(
+                session, "sender_name", "sender@couchers.org.invalid", f"recipient{i}", "subject", "plain", None
+            )
+
+    new_config = config.copy()
+    new_config["ENABLE_EMAIL"] = True
+    monkeypatch.setattr(couchers.jobs.handlers, "config", new_config)
+
+    with patch("couchers.email.smtp.smtplib.SMTP") as mock_smtp:
+        # all three go in one job run, over one connection
+        assert process_job()
+        assert not process_job()
+
+    assert mock_smtp.call_count == 1
+    assert [c.args[1] for c in mock_smtp.return_value.sendmail.call_args_list] == [
+        "recipient0",
+        "recipient1",
+        "recipient2",
+    ]
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 3
+        )
+        assert sorted(session.execute(select(Email.recipient)).scalars().all()) == [
+            "recipient0",
+            "recipient1",
+            "recipient2",
+        ]
+
+
+def test_send_emails_records_each_email(db, monkeypatch):
+    payloads = [
+        jobs_pb2.SendEmailPayload(
+            sender_name="sender_name",
+            sender_email="sender@couchers.org.invalid",
+            recipient=f"recipient{i}",
+            subject="subject",
+            plain="plain",
+            html="html",
+        )
+        for i in range(3)
+    ]
+    emails = [print_dev_email(**couchers.jobs.handlers._send_email_args(payload)) for payload in payloads]
+    # recording the second one fails, after it was sent
+    emails[1].id = emails[0].id
+
+    new_config = config.copy()
+    new_config["ENABLE_EMAIL"] = True
+    monkeypatch.setattr(couchers.jobs.handlers, "config", new_config)
+
+    with patch("couchers.jobs.handlers.send_smtp_emails", return_value=emails):
+        errors = send_emails(payloads)
+
+    # only the one that failed gets retried
+    assert errors[0] is None
+    assert errors[1] is not None
+    assert errors[2] is None
+
+    with session_scope() as session:
+        assert sorted(session.execute(select(Email.recipient)).scalars().all()) == ["recipient0", "recipient2"]
+
+
 def test_purge_login_tokens(db):
     user, api_token = generate_user()
 
@@ -266,21 +352,66 @@ def test_refresh_materialized_views(db):
         )
 
 
+def test_refresh_materialized_views_skips_unchanged(db):
+    def get_refreshes():
+        with session_scope() as session:
+            return {
+                refresh.name: (refresh.source_version, refresh.refreshed, refresh.checked)
+                for refresh in session.execute(select(MaterializedViewRefresh)).scalars().all()
+            }
+
+    def refresh(source_versions):
+        with patch(
+            "couchers.materialized_views._source_version",
+            side_effect=lambda session, tables: sum(source_versions.get(table, 0) for table in tables),
+        ):
+            with patch(
+                "couchers.materialized_views.refresh_materialized_view",
+                wraps=couchers.materialized_views.refresh_materialized_view,
+            ) as mock:
+                refresh_materialized_views(empty_pb2.Empty())
+        return {call.args[1] for call in mock.call_args_list}
+
+    # everything is refreshed the first time round
+    assert refresh({"lite_users": 1, "cluster_subscriptions": 1}) == set(MATERIALIZED_VIEW_SOURCES)
+    first = get_refreshes()
+    assert set(first) == set(MATERIALIZED_VIEW_SOURCES)
+    for source_version, refreshed, checked in first.values():
+        assert refreshed == checked
+
+    # nothing changed, so nothing is refreshed but the views are still known to be up to date
+    assert refresh({"lite_users": 1, "cluster_subscriptions": 1}) == set()
+    second = get_refreshes()
+    for name, (source_version, refreshed, checked) in second.items():
+        assert source_version == first[name][0]
+        assert refreshed == first[name][1]
+        assert checked > first[name][2]
+
+    # only the views reading cluster_subscriptions are refreshed
+    assert refresh({"lite_users": 1, "cluster_subscriptions": 2}) == {
+        "cluster_subscription_counts",
+        "cluster_admin_counts",
+    }
+    third = get_refreshes()
+    assert third["cluster_admin_counts"][1] > second["cluster_admin_counts"][1]
+    assert third["clustered_users"][1] == second["clustered_users"][1]
+
+
 def test_service_jobs(db):
     with session_scope() as session:
         queue_email(session, "sender_name", "sender_email", "recipient", "subject", "plain", "html")
 
-    # we create this HitSleep exception here, and mock out the normal sleep(1) in the infinite loop to instead raise
-    # this. that allows us to conveniently get out of the infinite loop and know we had no more jobs left
+    # we create this HitSleep exception here, and mock out waiting for a job notification in the infinite loop to
+    # instead raise this. that allows us to conveniently get out of the infinite loop and know we had no more jobs left
     class HitSleep(Exception):
         pass
 
-    # the mock `sleep` function that instead raises the aforementioned exception
-    def raising_sleep(seconds):
+    # the mock `wait` function that instead raises the aforementioned exception
+    def raising_wait(self, timeout):
         raise HitSleep()
 
     with pytest.raises(HitSleep):
-        with patch("couchers.jobs.worker.sleep", raising_sleep):
+        with patch("couchers.jobs.worker.JobQueueListener.wait", raising_wait):
             service_jobs()
 
     with session_scope() as session:
@@ -455,6 +586,249 @@ def test_no_jobs_no_problem(db):
         assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 0
 
 
+def test_claim_jobs(db):
+    with session_scope() as session:
+        for _ in range(3):
+            queue_job(session, "mock_job", empty_pb2.Empty())
+
+    called_count = 0
+
+    def mock_job(payload):
+        nonlocal called_count
+        called_count += 1
+
+    MOCK_JOBS = {
+        "mock_job": (empty_pb2.Empty, mock_job),
+    }
+
+    with patch("couchers.jobs.worker.JOBS", MOCK_JOBS):
+        first = claim_jobs(2)
+        assert len(first) == 2
+        assert all(job_type == "mock_job" for _, job_type in first)
+
+        # leased jobs are not handed out again
+        second = claim_jobs(2)
+        assert len(second) == 1
+        assert not {job_id for job_id, _ in first} & {job_id for job_id, _ in second}
+        assert claim_jobs(2) == []
+        assert not process_job()
+
+        for job_id, _ in first + second:
+            process_claimed_job(job_id)
+
+        # finished jobs aren't run again, e.g. if another worker ran one after our lease on it ran out
+        process_claimed_job(first[0][0])
+
+    assert called_count == 3
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 3
+        )
+
+
+def test_process_claimed_jobs(db):
+    with session_scope() as session:
+        for _ in range(3):
+            queue_job(session, "mock_job", empty_pb2.Empty())
+
+    batches = []
+
+    def mock_jobs(payloads):
+        batches.append(len(payloads))
+        return [None] * len(payloads)
+
+    MOCK_JOBS = {
+        "mock_job": (empty_pb2.Empty, None),
+    }
+
+    with (
+        patch("couchers.jobs.worker.JOBS", MOCK_JOBS),
+        patch("couchers.jobs.worker.BATCHES", {"mock_job": (mock_jobs, 10)}),
+    ):
+        job_ids = [job_id for job_id, _ in claim_jobs(10)]
+        process_claimed_jobs(job_ids)
+        # finished jobs aren't run again, e.g. if another worker ran them after our lease ran out
+        process_claimed_jobs(job_ids)
+
+    assert batches == [3]
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 3
+        )
+
+
+def test_process_claimed_jobs_wrong_result_count(db):
+    with session_scope() as session:
+        for _ in range(3):
+            queue_job(session, "mock_job", empty_pb2.Empty())
+
+    def mock_jobs(payloads):
+        # one result short
+        return [None] * (len(payloads) - 1)
+
+    MOCK_JOBS = {
+        "mock_job": (empty_pb2.Empty, None),
+    }
+
+    # if IN_TEST is true, then the bg worker will raise on exceptions
+    new_config = config.copy()
+    new_config["IN_TEST"] = False
+
+    with (
+        patch("couchers.jobs.worker.config", new_config),
+        patch("couchers.jobs.worker.JOBS", MOCK_JOBS),
+        patch("couchers.jobs.worker.BATCHES", {"mock_job": (mock_jobs, 10)}),
+    ):
+        process_claimed_jobs([job_id for job_id, _ in claim_jobs(10)])
+
+    # none of them are silently dropped
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count()).select_from(BackgroundJob).where(BackgroundJob.state == BackgroundJobState.error)
+            ).scalar_one()
+            == 3
+        )
+
+
+def test_claim_jobs_concurrency_limit(db):
+    with session_scope() as session:
+        for _ in range(3):
+            queue_job(session, "limited_job", empty_pb2.Empty())
+        queue_job(session, "other_job", empty_pb2.Empty())
+
+    with patch("couchers.jobs.worker.CONCURRENCY", {"limited_job": 1}):
+        claimed = claim_jobs(10)
+        assert sorted(job_type for _, job_type in claimed) == ["limited_job", "other_job"]
+
+        # the one limited_job we're running fills its only slot
+        assert claim_jobs(10, {"limited_job": 1}) == []
+        assert len(claim_jobs(10, {"limited_job": 0})) == 1
+
+
+def test_service_jobs_batched(db):
+    with session_scope() as session:
+        for _ in range(5):
+            queue_job(session, "mock_job", empty_pb2.Empty())
+
+    called_count = 0
+
+    def mock_job(payload):
+        nonlocal called_count
+        called_count += 1
+
+    MOCK_JOBS = {
+        "mock_job": (empty_pb2.Empty, mock_job),
+    }
+
+    class HitSleep(Exception):
+        pass
+
+    def raising_wait(self, timeout):
+        raise HitSleep()
+
+    new_config = config.copy()
+    new_config["BACKGROUND_WORKER_BATCH_SIZE"] = 2
+    new_config["BACKGROUND_WORKER_THREADS"] = 3
+
+    with pytest.raises(HitSleep):
+        with (
+            patch("couchers.jobs.worker.JobQueueListener.wait", raising_wait),
+            patch("couchers.jobs.worker.JOBS", MOCK_JOBS),
+            patch("couchers.jobs.worker.config", new_config),
+        ):
+            service_jobs()
+
+    assert called_count == 5
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state != BackgroundJobState.completed)
+            ).scalar_one()
+            == 0
+        )
+
+
+def test_queue_jobs_bulk(db):
+    with session_scope() as session:
+        job_ids = queue_jobs_bulk(session, "mock_job", [empty_pb2.Empty() for _ in range(3)], priority=5)
+        assert len(job_ids) == 3
+        assert queue_jobs_bulk(session, "mock_job", []) == []
+
+    with session_scope() as session:
+        jobs = session.execute(select(BackgroundJob).order_by(BackgroundJob.id)).scalars().all()
+        assert [job.id for job in jobs] == sorted(job_ids)
+        assert all(job.job_type == "mock_job" for job in jobs)
+        assert all(job.priority == 5 for job in jobs)
+        assert all(job.max_tries == 5 for job in jobs)
+        assert all(job.state == BackgroundJobState.pending for job in jobs)
+
+
+def test_job_queue_listener(db):
+    with listen_scope(JOB_QUEUE_CHANNEL) as conn:
+        listener = JobQueueListener(conn)
+        assert not listener.wait(0.1)
+
+        with session_scope() as session:
+            queue_job(session, "mock_job", empty_pb2.Empty())
+            queue_job(session, "mock_job", empty_pb2.Empty())
+            # only delivered on commit
+            assert not listener.wait(0.1)
+
+        assert listener.wait(5)
+        # both notifications were folded into one
+        assert not listener.wait(0.1)
+
+        class Rollback(Exception):
+            pass
+
+        # nothing is sent if the transaction rolls back
+        with pytest.raises(Rollback):
+            with session_scope() as session:
+                queue_job(session, "mock_job", empty_pb2.Empty())
+                raise Rollback()
+        assert not listener.wait(0.1)
+
+
+def test_job_queue_listener_backoff(db):
+    sleeps = []
+
+    with listen_scope(JOB_QUEUE_CHANNEL) as conn:
+        listener = JobQueueListener(conn)
+        with (
+            patch("couchers.jobs.worker.sleep", sleeps.append),
+            patch("couchers.jobs.worker.JobQueueListener.wait", lambda self, timeout: True),
+        ):
+            # woken up every time but never found a job
+            for _ in range(10):
+                listener.idle()
+
+            assert listener.spurious_wakeups == 9
+            assert sleeps[:3] == [0.025, 0.05, 0.1]
+            assert sleeps[-1] == 1
+
+            listener.found_job()
+            assert listener.spurious_wakeups == 0
+
+            listener.idle()
+            assert len(sleeps) == 9
+
+
 def test_send_message_notifications_basic(db):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
@@ -0,0 +1,133 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from sqlalchemy.orm import Session
+
+from couchers.activity import SessionCache
+from couchers.cache import EVERYTHING, TTLCache, invalidate_on_commit, pending_invalidations
+from couchers.db import NodeHierarchyCache
+from couchers.utils import now
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(timedelta(seconds=10))
+    with patch("couchers.cache.monotonic", return_value=100):
+        cache.put("a", 1, cache.generation)
+    with patch("couchers.cache.monotonic", return_value=110):
+        assert cache.get("a") == 1
+    with patch("couchers.cache.monotonic", return_value=111):
+        assert cache.get("a") is None
+        # and dropped
+        assert not cache._entries
+
+    with patch("couchers.cache.monotonic", return_value=100):
+        cache.put("a", 1, cache.generation)
+    with patch("couchers.cache.monotonic", return_value=105):
+        cache.put("b", 2, cache.generation)
+    with patch("couchers.cache.monotonic", return_value=112):
+        # "a" has expired and is the least recently used, so it's dropped on put
+        cache.put("c", 3, cache.generation)
+        assert list(cache._entries) == ["b", "c"]
+
+
+def test_ttl_cache_max_size():
+    cache = TTLCache(timedelta(seconds=10), max_size=2)
+    cache.put_many({"a": 1, "b": 2}, cache.generation)
+    # "b" is now the least recently used
+    assert cache.get("a") == 1
+    cache.put("c", 3, cache.generation)
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+
+
+def test_ttl_cache_stale_put():
+    cache = TTLCache(timedelta(seconds=10))
+    generation = cache.generation
+    # invalidated while we were looking "a" up
+    cache.invalidate(["a"])
+    cache.put("a", 1, generation)
+    assert cache.get("a") is None
+
+    cache.put_many({"a": 1, "b": 2}, cache.generation)
+    cache.invalidate_where(lambda key, value: value == 2)
+    assert cache.get_many(["a", "b"]) == {"a": 1}
+    cache.clear()
+    assert cache.get("a") is None
+
+
+def test_invalidate_on_commit():
+    cache = TTLCache(timedelta(seconds=10))
+    cache.put_many({"a": 1, "b": 2}, cache.generation)
+
+    # not bound to a database, transactions still commit and roll back
+    with Session() as session:
+        session.begin()
+        invalidate_on_commit(session, cache, ["a"])
+        assert pending_invalidations(session, cache) == {"a"}
+        # only once committed
+        assert cache.get("a") == 1
+        session.rollback()
+    assert cache.get("a") == 1
+
+    with Session() as session:
+        session.begin()
+        invalidate_on_commit(session, cache, ["a"])
+        session.commit()
+        assert pending_invalidations(session, cache) == set()
+    assert cache.get_many(["a", "b"]) == {"b": 2}
+
+    with Session() as session:
+        session.begin()
+        invalidate_on_commit(session, cache)
+        invalidate_on_commit(session, cache, ["c"])
+        assert pending_invalidations(session, cache) is EVERYTHING
+        assert "b" in pending_invalidations(session, cache)
+        assert ({"c"} | pending_invalidations(session, cache)) is EVERYTHING
+        session.commit()
+    assert cache.get("b") is None
+
+
+def test_session_cache_invalidation():
+    cache = SessionCache(timedelta(seconds=10), 3, bulk_models=set())
+    expiry = now() + timedelta(hours=1)
+    cache.put("token1", False, (1, False, False, expiry, None), cache.generation)
+    cache.put("token2", True, (1, False, False, expiry, None), cache.generation)
+    cache.put("token3", False, (2, False, False, expiry, None), cache.generation)
+    assert cache.get("token1", False)
+    assert not cache.get("token2", False)
+    assert cache.get("token2", True)
+
+    # only user 1's tokens are dropped
+    cache.invalidate([1])
+    assert not cache.get("token1", False)
+    assert not cache.get("token2", True)
+    assert cache.get("token3", False)
+
+    # evicted tokens are dropped from the user index too
+    for i in range(4, 8):
+        cache.put(f"token{i}", False, (3, False, False, expiry, None), cache.generation)
+    assert cache._cache._tokens_by_user == {3: {"token5", "token6", "token7"}}
+
+    cache.clear()
+    assert not cache.get("token7", False)
+    assert cache._cache._tokens_by_user == {}
+
+
+def test_node_hierarchy_cache_unknown_node():
+    cache = NodeHierarchyCache(timedelta(minutes=5), timedelta(seconds=10))
+    nodes = {1: (None, 10), 2: (1, 20)}
+    with Session() as session, patch.object(cache, "_fetch", return_value=nodes) as fetch:
+        with patch("couchers.db.monotonic", return_value=100), patch("couchers.cache.monotonic", return_value=100):
+            assert cache.get_ancestry(session, 2) == [(2, 1, 20), (1, None, 10)]
+            # unknown, but the hierarchy was only just fetched
+            assert cache.get_ancestry(session, 3) == []
+        assert fetch.call_count == 1
+
+        with patch("couchers.db.monotonic", return_value=120), patch("couchers.cache.monotonic", return_value=120):
+            # already known to be unknown until the cached copy expires
+            assert cache.get_ancestry(session, 3) == []
+            assert fetch.call_count == 1
+            # but the cached copy is old enough to be reloaded for another one
+            assert cache.get_ancestry(session, 4) == []
+            assert fetch.call_count == 2
+            assert cache.get_ancestry(session, 4) == []
+            assert fetch.call_count == 2
@@ -17,6 +17,7 @@ from couchers.models import (
     PageVersion,
     SignupFlow,
     Thread,
+    User,
 )
 from couchers.sql import couchers_select as select
 from couchers.tasks import enforce_community_memberships
@@ -961,6 +962,44 @@ def test_LeaveCommunity_regression(db):
         assert not api.GetCommunity(communities_pb2.GetCommunityReq(community_id=c2_id)).member
 
 
+def test_enforce_community_memberships_incremental(db):
+    user1, token1 = generate_user(geom=create_1d_point(1), geom_radius=0.1)
+    user2, token2 = generate_user(geom=create_1d_point(5), geom_radius=0.1)
+    user3, token3 = generate_user(geom=create_1d_point(500), geom_radius=0.1)
+
+    with session_scope() as session:
+        c0_id = create_community(session, 0, 100, "Community 0", [user1], [], None).id
+
+    def is_member(token):
+        with communities_session(token) as api:
+            return api.GetCommunity(communities_pb2.GetCommunityReq(community_id=c0_id)).member
+
+    # the first incremental run has no watermark and looks at everyone
+    enforce_community_memberships(incremental=True)
+    assert is_member(token2)
+    assert not is_member(token3)
+
+    # user3 moves into the community
+    with session_scope() as session:
+        user = session.execute(select(User).where(User.id == user3.id)).scalar_one()
+        user.geom = create_1d_point(50)
+        user.geom_last_updated = now()
+
+    # user4 is in the community but hasn't moved since well before the last run
+    user4, token4 = generate_user(geom=create_1d_point(10), geom_radius=0.1)
+    with session_scope() as session:
+        user = session.execute(select(User).where(User.id == user4.id)).scalar_one()
+        user.geom_last_updated = now() - timedelta(days=1)
+
+    enforce_community_memberships(incremental=True)
+    assert is_member(token3)
+    assert not is_member(token4)
+
+    # a full run picks them up
+    enforce_community_memberships()
+    assert is_member(token4)
+
+
 def test_enforce_community_memberships_for_user(testing_communities):
     """
     Make sure the user is added to the right communities on signup
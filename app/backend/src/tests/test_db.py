@@ -6,7 +6,8 @@ import pytest
 from sqlalchemy.sql import func
 
 from couchers.config import config
-from couchers.db import apply_migrations, get_parent_node_at_location, session_scope
+from couchers.db import apply_migrations, get_node_parents_recursively, get_parent_node_at_location, session_scope
+from couchers.models import User, UserNode
 from couchers.sql import couchers_select as select
 from couchers.utils import (
     create_coordinate,
@@ -18,7 +19,14 @@ from couchers.utils import (
     parse_date,
 )
 from tests.test_communities import create_1d_point, get_community_id, testing_communities  # noqa
-from tests.test_fixtures import create_schema_from_models, db, drop_all, run_migration_test, testconfig  # noqa
+from tests.test_fixtures import (  # noqa
+    create_schema_from_models,
+    db,
+    drop_all,
+    generate_user,
+    run_migration_test,
+    testconfig,
+)
 
 
 def test_is_valid_user_id():
@@ -92,6 +100,54 @@ def test_get_parent_node_at_location(testing_communities):
         assert get_parent_node_at_location(session, create_1d_point(51)).id == w_id
 
 
+def test_get_node_parents_recursively(testing_communities):
+    with session_scope() as session:
+        w_id = get_community_id(session, "Global")
+        c1_id = get_community_id(session, "Country 1")
+        c1r1_id = get_community_id(session, "Country 1, Region 1")
+        c1r1c1_id = get_community_id(session, "Country 1, Region 1, City 1")
+
+        parents = get_node_parents_recursively(session, c1r1c1_id)
+        assert [(node_id, level) for node_id, _, level, _ in parents] == [
+            (w_id, 3),
+            (c1_id, 2),
+            (c1r1_id, 1),
+            (c1r1c1_id, 0),
+        ]
+        assert [cluster.name for _, _, _, cluster in parents] == [
+            "Global",
+            "Country 1",
+            "Country 1, Region 1",
+            "Country 1, Region 1, City 1",
+        ]
+        assert [parent_node_id for _, parent_node_id, _, _ in parents] == [None, w_id, c1_id, c1r1_id]
+
+
+def test_user_nodes(testing_communities):
+    user, _ = generate_user(geom=create_1d_point(3), geom_radius=0.1)
+
+    def user_node_ids(session):
+        return set(session.execute(select(UserNode.node_id).where(UserNode.user_id == user.id)).scalars())
+
+    with session_scope() as session:
+        assert user_node_ids(session) == {
+            get_community_id(session, "Global"),
+            get_community_id(session, "Country 1"),
+            get_community_id(session, "Country 1, Region 1"),
+            get_community_id(session, "Country 1, Region 1, City 1"),
+        }
+
+        # moving the user updates them on flush
+        session.execute(select(User).where(User.id == user.id)).scalar_one().geom = create_1d_point(60)
+        session.flush()
+        assert user_node_ids(session) == {
+            get_community_id(session, "Global"),
+            get_community_id(session, "Country 2"),
+            get_community_id(session, "Country 2, Region 1"),
+            get_community_id(session, "Country 2, Region 1, City 1"),
+        }
+
+
 def test_create_coordinate():
     test_coords = [
         ((-95, -185), (-85, 175)),
@@ -1,3 +1,4 @@
+import smtplib
 from unittest.mock import patch
 
 import pytest
@@ -7,6 +8,7 @@ import couchers.jobs.handlers
 from couchers.config import config
 from couchers.crypto import random_hex, urlsafe_secure_token
 from couchers.db import session_scope
+from couchers.email.smtp import send_smtp_emails, smtp_pool
 from couchers.models import (
     ContentReport,
     Email,
@@ -26,6 +28,8 @@ from couchers.tasks import (
     send_email_changed_confirmation_to_new_email,
     send_signup_email,
 )
+from couchers.templates.v2 import env as v2_env
+from couchers.templates.v2 import render_email
 from couchers.utils import Timestamp_from_datetime, now, timedelta
 from proto import admin_pb2, api_pb2, events_pb2, notification_data_pb2, notifications_pb2
 from tests.test_communities import create_community
@@ -462,3 +466,65 @@ def test_email_deleted_users_regression(db):
             )
 
         assert mock.call_count == 3
+
+
+def test_render_email_template_cache():
+    plain_unsub_section = "\n\n---\n\nThis is a security email, you cannot unsubscribe from it."
+    html_unsub_section = "This is a security email, you cannot unsubscribe from it."
+    template_args = {
+        "user": {"name": "Jane"},
+        "title": "Your password was changed",
+        "message": "Your login password for Couchers.org was changed.",
+        "_year": 2025,
+        "_timezone_display": "Coordinated Universal Time",
+    }
+
+    plain, html = render_email("security", template_args, plain_unsub_section, html_unsub_section)
+    assert plain.endswith(plain_unsub_section)
+    assert html_unsub_section in html
+    assert "___UNSUB_SECTION___" not in html
+
+    # compiled once, the unsubscribe section is passed in rather than compiled into the template
+    template = v2_env.get_template("security.txt")
+    assert v2_env.get_template("security.txt") is template
+    other_plain, _ = render_email("security", template_args, "\n\nsomething else", html_unsub_section)
+    assert v2_env.get_template("security.txt") is template
+    assert other_plain == plain.removesuffix(plain_unsub_section) + "\n\nsomething else"
+
+
+def test_smtp_connection_pool():
+    emails = [
+        dict(
+            sender_name="Couchers.org",
+            sender_email="notify@couchers.org.invalid",
+            recipient=recipient,
+            subject="subject",
+            plain="plain",
+            html=None,
+            list_unsubscribe_header=None,
+            source_data=None,
+        )
+        for recipient in ["one@example.invalid", "refused@example.invalid", "three@example.invalid"]
+    ]
+
+    def sendmail(from_addr, to_addrs, msg):
+        if to_addrs == "refused@example.invalid":
+            raise smtplib.SMTPRecipientsRefused({to_addrs: (550, b"no")})
+
+    with patch("couchers.email.smtp.smtplib.SMTP") as mock_smtp:
+        mock_smtp.return_value.sendmail.side_effect = sendmail
+        smtp_pool.close()
+
+        results = send_smtp_emails(emails)
+        assert results[0].recipient == "one@example.invalid"
+        assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+        assert results[2].recipient == "three@example.invalid"
+        # the connection that errored is thrown away, the others are reused
+        assert mock_smtp.call_count == 2
+
+        # the server dropping a pooled connection means reconnecting and trying again
+        mock_smtp.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), None]
+        assert send_smtp_emails(emails[:1])[0].recipient == "one@example.invalid"
+        assert mock_smtp.call_count == 3
+
+        smtp_pool.close()
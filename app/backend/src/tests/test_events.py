@@ -1,14 +1,16 @@
 from datetime import timedelta
+from types import SimpleNamespace
 
 import grpc
 import pytest
 from google.protobuf import wrappers_pb2
 from psycopg2.extras import DateTimeTZRange
-from sqlalchemy.sql.expression import update
+from sqlalchemy.sql.expression import select, update
 
 from couchers import errors
 from couchers.db import session_scope
 from couchers.models import EventOccurrence
+from couchers.servicers.events import event_to_pb, event_to_pb_for_viewers
 from couchers.tasks import enforce_community_memberships
 from couchers.utils import Timestamp_from_datetime, now, to_aware_datetime
 from proto import admin_pb2, events_pb2, threads_pb2
@@ -18,6 +20,7 @@ from tests.test_fixtures import (  # noqa
     email_fields,
     events_session,
     generate_user,
+    make_user_block,
     mock_notification_email,
     process_jobs,
     push_collector,
@@ -480,6 +483,60 @@ def test_CreateEvent(db, push_collector):
         assert e.value.details() == errors.EVENT_TOO_LONG
 
 
+def test_event_to_pb_for_viewers(db):
+    # creator, community moderator, maybe attendee, going attendee, subscriber who blocked the going attendee
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+    user4, token4 = generate_user()
+    user5, token5 = generate_user()
+
+    with session_scope() as session:
+        create_community(session, 0, 2, "Community", [user2], [], None)
+
+    start_time = now() + timedelta(hours=2)
+    with events_session(token1) as api:
+        event_id = api.CreateEvent(
+            events_pb2.CreateEventReq(
+                title="Dummy Title",
+                content="Dummy content.",
+                offline_information=events_pb2.OfflineEventInformation(address="Near Null Island", lat=0.1, lng=0.2),
+                start_time=Timestamp_from_datetime(start_time),
+                end_time=Timestamp_from_datetime(start_time + timedelta(hours=3)),
+                timezone="UTC",
+            )
+        ).event_id
+
+    with events_session(token3) as api:
+        api.SetEventAttendance(
+            events_pb2.SetEventAttendanceReq(event_id=event_id, attendance_state=events_pb2.ATTENDANCE_STATE_MAYBE)
+        )
+    with events_session(token4) as api:
+        api.SetEventAttendance(
+            events_pb2.SetEventAttendanceReq(event_id=event_id, attendance_state=events_pb2.ATTENDANCE_STATE_GOING)
+        )
+    with events_session(token5) as api:
+        api.SetEventSubscription(events_pb2.SetEventSubscriptionReq(event_id=event_id, subscribe=True))
+    make_user_block(user5, user4)
+
+    viewer_user_ids = [user1.id, user2.id, user3.id, user4.id, user5.id]
+    with session_scope() as session:
+        occurrence = session.execute(select(EventOccurrence).where(EventOccurrence.id == event_id)).scalar_one()
+        event_pbs = event_to_pb_for_viewers(session, occurrence, viewer_user_ids)
+        for viewer_user_id in viewer_user_ids:
+            assert event_pbs[viewer_user_id] == event_to_pb(
+                session, occurrence, SimpleNamespace(user_id=viewer_user_id)
+            )
+
+    assert event_pbs[user1.id].going_count == 2
+    assert event_pbs[user5.id].going_count == 1
+    assert event_pbs[user1.id].subscriber_count == 2
+    assert event_pbs[user4.id].subscriber_count == 1
+    assert event_pbs[user2.id].can_moderate
+    assert not event_pbs[user3.id].can_edit
+    assert event_pbs[user3.id].attendance_state == events_pb2.ATTENDANCE_STATE_MAYBE
+
+
 def test_CreateEvent_incomplete_profile(db):
     user1, token1 = generate_user(complete_profile=False)
     user2, token2 = generate_user()
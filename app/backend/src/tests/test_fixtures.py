@@ -11,11 +11,14 @@ import pytest
 from sqlalchemy.orm import close_all_sessions
 from sqlalchemy.sql import or_, text
 
+from couchers.activity import activity_buffer, session_cache, user_profile_cache
+from couchers.api_call_log import api_call_log
 from couchers.config import config
 from couchers.constants import GUIDELINES_VERSION, TOS_VERSION
 from couchers.crypto import random_hex
-from couchers.db import _get_base_engine, session_scope
+from couchers.db import _get_base_engine, node_hierarchy_cache, session_scope
 from couchers.descriptor_pool import get_descriptor_pool
+from couchers.email.smtp import smtp_pool
 from couchers.interceptors import (
     AuthValidatorInterceptor,
     CookieInterceptor,
@@ -43,6 +46,7 @@ from couchers.models import (
     UserBlock,
     UserSession,
 )
+from couchers.notifications.settings import notification_preference_cache
 from couchers.servicers.account import Account, Iris
 from couchers.servicers.admin import Admin
 from couchers.servicers.api import API
@@ -54,7 +58,7 @@ from couchers.servicers.conversations import Conversations
 from couchers.servicers.discussions import Discussions
 from couchers.servicers.donations import Donations, Stripe
 from couchers.servicers.events import Events
-from couchers.servicers.gis import GIS
+from couchers.servicers.gis import GIS, geojson_cache
 from couchers.servicers.groups import Groups
 from couchers.servicers.jail import Jail
 from couchers.servicers.media import Media, get_media_auth_interceptor
@@ -217,6 +221,16 @@ def recreate_database():
     # running in non-UTC catches some timezone errors
     os.environ["TZ"] = "America/New_York"
 
+    # forget sessions and bookkeeping from the previous database
+    session_cache.clear()
+    user_profile_cache.clear()
+    node_hierarchy_cache.clear()
+    activity_buffer.clear()
+    api_call_log.clear()
+    geojson_cache.clear()
+    smtp_pool.close()
+    notification_preference_cache.clear()
+
     # drop everything currently in the database
     drop_all()
 
@@ -602,6 +616,7 @@ def _check_user_perms(method, user_id, is_jailed, is_superuser, token_expiry):
 class FakeChannel:
     def __init__(self, user_id=None, is_jailed=None, is_superuser=None, token_expiry=None):
         self.handlers = {}
+        self.metadata = []
         self.user_id = user_id
         self._is_jailed = is_jailed
         self._is_superuser = is_superuser
@@ -610,6 +625,12 @@ class FakeChannel:
     def abort(self, code, details):
         raise FakeRpcError(code, details)
 
+    def invocation_metadata(self):
+        return self.metadata
+
+    def send_initial_metadata(self, metadata):
+        self.initial_metadata = dict(metadata)
+
     def add_generic_rpc_handlers(self, generic_rpc_handlers):
         from grpc._server import _validate_generic_rpc_handlers
 
@@ -1008,6 +1029,10 @@ def push_collector():
         def push_to_user(self, session, user_id, **kwargs):
             self.pushes.append((user_id, Push(kwargs=kwargs)))
 
+        def push_to_users(self, session, pushes):
+            for push in pushes:
+                self.push_to_user(session, **push)
+
         def assert_user_has_count(self, user_id, count):
             assert len(self.by_user(user_id)) == count
 
@@ -1025,5 +1050,8 @@ def push_collector():
 
     collector = PushCollector()
 
-    with patch("couchers.notifications.push._push_to_user", collector.push_to_user):
+    with (
+        patch("couchers.notifications.push._push_to_user", collector.push_to_user),
+        patch("couchers.notifications.push._push_to_users", collector.push_to_users),
+    ):
         yield collector
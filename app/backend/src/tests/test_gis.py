@@ -1,11 +1,24 @@
 import json
 
+import grpc
 import pytest
 from google.protobuf import empty_pb2
 
-from couchers.materialized_views import refresh_materialized_views, refresh_materialized_views_rapid
+from couchers import errors
+from couchers.constants import CLUSTERED_USERS_TILES_MAX_ZOOM
+from couchers.db import session_scope
+from couchers.materialized_views import (
+    refresh_materialized_views,
+    refresh_materialized_views_rapid,
+    update_clustered_users_tiles,
+)
+from couchers.models import User
+from couchers.servicers.gis import GIS, HTTP_STATUS_HEADER
+from couchers.sql import couchers_select as select
+from couchers.utils import create_coordinate
+from proto import gis_pb2, gis_pb2_grpc
 from tests.test_communities import testing_communities  # noqa
-from tests.test_fixtures import generate_user, gis_session, testconfig  # noqa
+from tests.test_fixtures import db, fake_channel, generate_user, gis_session, make_user_block, testconfig  # noqa
 
 
 @pytest.fixture(autouse=True)
@@ -13,6 +26,15 @@ def _(testconfig):
     pass
 
 
+def _gis_channel(token):
+    """
+    Like gis_session, but also gives the channel to get at the metadata sent and received
+    """
+    channel = fake_channel(token)
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), channel)
+    return channel, gis_pb2_grpc.GISStub(channel)
+
+
 class TestGIS:
     @staticmethod
     def test_GetUsers(testing_communities):
@@ -28,6 +50,46 @@ class TestGIS:
             assert data["type"] == "FeatureCollection"
             assert len(data["features"]) > 1
 
+    @staticmethod
+    def test_GetUsers_blocks_and_etags(db):
+        user1, token1 = generate_user()
+        user2, token2 = generate_user()
+        user3, token3 = generate_user()
+        make_user_block(user1, user2)
+
+        refresh_materialized_views_rapid(None)
+
+        def get_user_ids(gis):
+            return {
+                feature["properties"]["id"] for feature in json.loads(gis.GetUsers(empty_pb2.Empty()).data)["features"]
+            }
+
+        channel1, gis1 = _gis_channel(token1)
+        channel2, gis2 = _gis_channel(token2)
+        channel3, gis3 = _gis_channel(token3)
+        assert get_user_ids(gis1) == {user1.id, user3.id}
+        assert get_user_ids(gis2) == {user2.id, user3.id}
+        assert get_user_ids(gis3) == {user1.id, user2.id, user3.id}
+        etag1 = channel1.initial_metadata["etag"]
+        etag3 = channel3.initial_metadata["etag"]
+        assert etag1.startswith("W/")
+        assert len({etag1, channel2.initial_metadata["etag"], etag3}) == 3
+
+        # the client already has this version
+        channel3.metadata = [("if-none-match", etag3)]
+        http_body = gis3.GetUsers(empty_pb2.Empty())
+        assert http_body.data == b""
+        assert channel3.initial_metadata[HTTP_STATUS_HEADER] == "304"
+        assert channel3.initial_metadata["etag"] == etag3
+
+        # the cache is keyed on the lite_users refresh
+        user4, _ = generate_user()
+        refresh_materialized_views_rapid(None)
+
+        assert get_user_ids(gis3) == {user1.id, user2.id, user3.id, user4.id}
+        assert HTTP_STATUS_HEADER not in channel3.initial_metadata
+        assert channel3.initial_metadata["etag"] != etag3
+
     @staticmethod
     def test_GetClusteredUsers(testing_communities):
         _, token = generate_user()
@@ -41,3 +103,43 @@ class TestGIS:
             print(data)
             assert data["type"] == "FeatureCollection"
             assert len(data["features"]) > 1
+
+    @staticmethod
+    def test_GetClusteredUsersTile(testing_communities):
+        user, token = generate_user()
+
+        refresh_materialized_views_rapid(None)
+        update_clustered_users_tiles(empty_pb2.Empty())
+
+        channel, gis = _gis_channel(token)
+
+        http_body = gis.GetClusteredUsersTile(gis_pb2.GetClusteredUsersTileReq(z=0, x=0, y=0))
+        assert http_body.content_type == "application/vnd.mapbox-vector-tile"
+        assert http_body.data
+        etag = channel.initial_metadata["etag"]
+
+        # nothing changed, so the tile is the same
+        refresh_materialized_views_rapid(None)
+        update_clustered_users_tiles(empty_pb2.Empty())
+        assert gis.GetClusteredUsersTile(gis_pb2.GetClusteredUsersTileReq(z=0, x=0, y=0)).data == http_body.data
+        assert channel.initial_metadata["etag"] == etag
+
+        # moving a user rebuilds the tiles they moved between
+        with session_scope() as session:
+            session.execute(select(User).where(User.id == user.id)).scalar_one().geom = create_coordinate(-33.9, 151.2)
+
+        refresh_materialized_views_rapid(None)
+        update_clustered_users_tiles(empty_pb2.Empty())
+        assert gis.GetClusteredUsersTile(gis_pb2.GetClusteredUsersTileReq(z=0, x=0, y=0)).data != http_body.data
+        assert channel.initial_metadata["etag"] != etag
+
+        # there's nobody up by the north pole
+        http_body = gis.GetClusteredUsersTile(
+            gis_pb2.GetClusteredUsersTileReq(z=CLUSTERED_USERS_TILES_MAX_ZOOM, x=0, y=0)
+        )
+        assert http_body.data == b""
+
+        with pytest.raises(grpc.RpcError) as e:
+            gis.GetClusteredUsersTile(gis_pb2.GetClusteredUsersTileReq(z=1, x=2, y=0))
+        assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+        assert e.value.details() == errors.INVALID_TILE
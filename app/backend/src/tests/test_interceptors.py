@@ -1,11 +1,17 @@
 from concurrent import futures
 from contextlib import contextmanager
+from datetime import timedelta
+from unittest.mock import patch
 
 import grpc
 import pytest
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import func
 
 from couchers import errors
+from couchers.activity import activity_buffer
+from couchers.api_call_log import APICallLog, api_call_log, sanitized_bytes
+from couchers.config import config
 from couchers.crypto import random_hex
 from couchers.db import session_scope
 from couchers.interceptors import (
@@ -14,11 +20,17 @@ from couchers.interceptors import (
     ErrorSanitizationInterceptor,
     SessionInterceptor,
     TracingInterceptor,
+    _try_get_and_update_user_details,
 )
-from couchers.metrics import servicer_duration_histogram
-from couchers.models import APICall, UserSession
+from couchers.metrics import (
+    api_call_logs_dropped_counter,
+    api_call_logs_sampled_out_counter,
+    servicer_duration_histogram,
+)
+from couchers.models import APICall, User, UserActivity, UserSession
 from couchers.servicers.account import Account
 from couchers.servicers.api import API
+from couchers.servicers.auth import delete_session
 from couchers.sql import couchers_select as select
 from proto import account_pb2, admin_pb2, api_pb2, auth_pb2
 from tests.test_fixtures import db, generate_user, real_admin_session, testconfig  # noqa
@@ -184,6 +196,8 @@ def test_tracing_interceptor_ok_open(db):
     with interceptor_dummy_api(TestRpc, interceptors=[TracingInterceptor()]) as call_rpc:
         call_rpc(empty_pb2.Empty())
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -212,6 +226,8 @@ def test_tracing_interceptor_sensitive(db):
             auth_pb2.SignupFlowReq(account=auth_pb2.SignupAccount(password="should be removed", username="not removed"))
         )
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -257,6 +273,8 @@ def test_tracing_interceptor_exception(db):
         with pytest.raises(Exception, match="Some error message"):
             call_rpc(auth_pb2.SignupAccount(password="should be removed", username="not removed"))
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -286,6 +304,8 @@ def test_tracing_interceptor_abort(db):
         with pytest.raises(Exception, match="now a grpc abort"):
             call_rpc(auth_pb2.SignupAccount(password="should be removed", username="not removed"))
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -300,6 +320,89 @@ def test_tracing_interceptor_abort(db):
     assert _get_histogram_labels_value("/testing.Test/TestRpc", "False", "Exception", "FAILED_PRECONDITION") == val + 1
 
 
+def _get_api_call_log_counter_value(counter, method):
+    return counter.labels(method)._value.get()
+
+
+def test_tracing_interceptor_sampling(db):
+    sampled_out = _get_api_call_log_counter_value(api_call_logs_sampled_out_counter, "/testing.Test/TestRpc")
+
+    def TestRpc(request, context):
+        if request.username == "fail":
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "failed")
+        return auth_pb2.AuthReq()
+
+    new_config = config.copy()
+    new_config["API_CALL_LOG_SAMPLE_RATES"] = "/testing.Test/OtherRpc=1, /testing.Test/TestRpc=0"
+
+    with patch("couchers.interceptors.config", new_config):
+        interceptor = TracingInterceptor()
+
+    with interceptor_dummy_api(
+        TestRpc,
+        interceptors=[interceptor],
+        request_type=auth_pb2.SignupAccount,
+        response_type=auth_pb2.AuthReq,
+    ) as call_rpc:
+        call_rpc(auth_pb2.SignupAccount(username="ok"))
+        call_rpc(auth_pb2.SignupAccount(username="ok"))
+        # failed calls are always logged
+        with pytest.raises(grpc.RpcError):
+            call_rpc(auth_pb2.SignupAccount(username="fail"))
+
+    api_call_log.flush()
+
+    with session_scope() as session:
+        trace = session.execute(select(APICall)).scalar_one()
+        assert trace.status_code == "FAILED_PRECONDITION"
+
+    assert (
+        _get_api_call_log_counter_value(api_call_logs_sampled_out_counter, "/testing.Test/TestRpc") == sampled_out + 2
+    )
+
+
+def test_api_call_log_overflow(db):
+    dropped = _get_api_call_log_counter_value(api_call_logs_dropped_counter, "/testing.Test/TestRpc")
+
+    def TestRpc(request, context):
+        return empty_pb2.Empty()
+
+    small_log = APICallLog(timedelta(seconds=1), batch_size=2, max_queued=3)
+    with patch("couchers.interceptors.api_call_log", small_log):
+        with interceptor_dummy_api(TestRpc, interceptors=[TracingInterceptor()]) as call_rpc:
+            for _ in range(5):
+                call_rpc(empty_pb2.Empty())
+
+    assert _get_api_call_log_counter_value(api_call_logs_dropped_counter, "/testing.Test/TestRpc") == dropped + 2
+
+    # written out over two batches
+    small_log.flush()
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(APICall)).scalar_one() == 3
+
+
+def test_sanitized_bytes():
+    # no sensitive fields anywhere, passed through as is
+    raw = api_pb2.User(username="user", about_me="hello").SerializeToString()
+    assert sanitized_bytes(api_pb2.User, raw) is raw
+
+    raw = auth_pb2.SignupFlowReq(
+        flow_token="token", account=auth_pb2.SignupAccount(username="user", password="secret")
+    ).SerializeToString()
+    req = auth_pb2.SignupFlowReq.FromString(sanitized_bytes(auth_pb2.SignupFlowReq, raw))
+    assert req.flow_token == "token"
+    assert req.account.username == "user"
+    assert not req.account.password
+
+    # unset submessages stay unset
+    raw = auth_pb2.SignupFlowReq(flow_token="token").SerializeToString()
+    req = auth_pb2.SignupFlowReq.FromString(sanitized_bytes(auth_pb2.SignupFlowReq, raw))
+    assert not req.HasField("account")
+
+    assert sanitized_bytes(auth_pb2.SignupFlowReq, None) is None
+
+
 def test_auth_interceptor(db):
     super_user, super_token = generate_user(is_superuser=True)
     user, token = generate_user()
@@ -382,6 +485,61 @@ def test_auth_interceptor(db):
         assert e.value.details() == "Unauthorized"
 
 
+def test_auth_session_cache_revocation(db):
+    user, token = generate_user()
+
+    auth_info = _try_get_and_update_user_details(token, False, "127.0.0.1", "Testing User-Agent")
+    assert auth_info[0] == user.id
+    assert not auth_info[1]
+
+    # served from the cache, but changes to the user are picked up straight away
+    with session_scope() as session:
+        session.execute(select(User).where(User.id == user.id)).scalar_one().accepted_tos = 0
+    auth_info = _try_get_and_update_user_details(token, False, "127.0.0.1", "Testing User-Agent")
+    assert auth_info[1]
+
+    # as is logging out
+    with session_scope() as session:
+        assert delete_session(session, token)
+    assert not _try_get_and_update_user_details(token, False, "127.0.0.1", "Testing User-Agent")
+
+
+def test_auth_activity_buffer(db):
+    user, token = generate_user()
+
+    with session_scope() as session:
+        api_calls_before = session.execute(select(UserSession).where(UserSession.token == token)).scalar_one().api_calls
+
+    for _ in range(3):
+        _try_get_and_update_user_details(token, False, "127.0.0.1", "Testing User-Agent")
+    _try_get_and_update_user_details(token, False, "127.0.0.1", "Another User-Agent")
+    _try_get_and_update_user_details(token, False, None, None)
+
+    # nothing is written until we flush
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(UserActivity)).scalar_one() == 0
+
+    activity_buffer.flush()
+
+    # null ip and user agent merge into the existing row
+    _try_get_and_update_user_details(token, False, None, None)
+    activity_buffer.flush()
+
+    with session_scope() as session:
+        user_session = session.execute(select(UserSession).where(UserSession.token == token)).scalar_one()
+        assert user_session.api_calls == api_calls_before + 6
+
+        activity = {
+            (a.ip_address, a.user_agent): a.api_calls
+            for a in session.execute(select(UserActivity).where(UserActivity.user_id == user.id)).scalars().all()
+        }
+        assert activity == {
+            ("127.0.0.1", "Testing User-Agent"): 3,
+            ("127.0.0.1", "Another User-Agent"): 1,
+            (None, None): 2,
+        }
+
+
 def test_tracing_interceptor_auth_cookies(db):
     user, token = generate_user()
 
@@ -401,6 +559,8 @@ def test_tracing_interceptor_auth_cookies(db):
         res1 = call_rpc(empty_pb2.Empty(), metadata=(("cookie", f"couchers-sesh={token}"),))
     assert res1.username == user.username
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/org.couchers.api.account.Account/GetAccountInfo"
@@ -438,6 +598,8 @@ def test_tracing_interceptor_auth_api_key(db):
         res1 = call_rpc(empty_pb2.Empty(), metadata=(("authorization", f"Bearer {api_key}"),))
     assert res1.username == user.username
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/org.couchers.api.account.Account/GetAccountInfo"
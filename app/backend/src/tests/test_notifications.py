@@ -1,15 +1,24 @@
 import json
 import re
+from datetime import timedelta
+from time import time
+from unittest.mock import patch
 from urllib.parse import parse_qs, urlparse
 
 import grpc
 import pytest
 from google.protobuf import empty_pb2
 
+import couchers.notifications.background
 from couchers import errors
+from couchers.config import config
+from couchers.constants import PUSH_VAPID_EXPIRY, PUSH_VAPID_REFRESH_MARGIN
 from couchers.crypto import b64decode
+from couchers.jobs.enqueue import queue_job
 from couchers.jobs.worker import process_job
 from couchers.models import (
+    BackgroundJob,
+    BackgroundJobState,
     HostingStatus,
     MeetupStatus,
     Notification,
@@ -18,10 +27,14 @@ from couchers.models import (
     NotificationTopicAction,
     User,
 )
-from couchers.notifications.notify import notify
+from couchers.notifications.background import handle_email_digests
+from couchers.notifications.notify import notify, notify_many
+from couchers.notifications.push_api import gen_vapid_keys, generate_vapid_authorization, send_pushes
+from couchers.notifications.settings import get_preference, get_preferences, set_preference
 from couchers.sql import couchers_select as select
+from couchers.utils import now
 from proto import api_pb2, auth_pb2, conversations_pb2, notification_data_pb2, notifications_pb2
-from proto.internal import unsubscribe_pb2
+from proto.internal import jobs_pb2, unsubscribe_pb2
 from tests.test_fixtures import (  # noqa
     api_session,
     auth_api_session,
@@ -301,6 +314,186 @@ def test_set_do_not_email(db):
         assert not user.do_not_email
 
 
+def test_notify_many(db, push_collector):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    with session_scope() as session:
+        notify_many(
+            session,
+            recipients=[
+                (
+                    user.id,
+                    notification_data_pb2.BadgeAdd(
+                        badge_id="volunteer",
+                        badge_name=f"Active Volunteer {user.id}",
+                        badge_description="This user is an active volunteer for Couchers.org",
+                    ),
+                )
+                for user in [user1, user2, user3]
+            ],
+            topic_action="badge:add",
+        )
+        # nothing to do
+        notify_many(session, recipients=[], topic_action="badge:add")
+
+    with session_scope() as session:
+        notifications = session.execute(select(Notification).order_by(Notification.id)).scalars().all()
+        assert [n.user_id for n in notifications] == [user1.id, user2.id, user3.id]
+        assert all(n.topic_action == NotificationTopicAction.badge__add for n in notifications)
+        for n in notifications:
+            assert notification_data_pb2.BadgeAdd.FromString(n.data).badge_name == f"Active Volunteer {n.user_id}"
+
+        jobs = session.execute(select(BackgroundJob)).scalars().all()
+        assert len(jobs) == 3
+        assert all(job.job_type == "handle_notification" for job in jobs)
+
+    process_jobs()
+
+    for user in [user1, user2, user3]:
+        push_collector.assert_user_has_count(user.id, 1)
+
+
+def test_handle_notifications_batched(db, push_collector):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    with session_scope() as session:
+        set_preference(session, user1.id, NotificationTopicAction.badge__add, NotificationDeliveryType.email, True)
+        set_preference(session, user2.id, NotificationTopicAction.badge__add, NotificationDeliveryType.digest, False)
+
+    with session_scope() as session:
+        notify_many(
+            session,
+            recipients=[
+                (
+                    user.id,
+                    notification_data_pb2.BadgeAdd(
+                        badge_id="volunteer",
+                        badge_name="Active Volunteer",
+                        badge_description="This user is an active volunteer for Couchers.org",
+                    ),
+                )
+                for user in [user1, user2, user3]
+            ],
+            topic_action="badge:add",
+        )
+        # a notification that doesn't exist fails the batch, the others still go out one at a time
+        queue_job(session, "handle_notification", jobs_pb2.HandleNotificationPayload(notification_id=999_999))
+
+    # if IN_TEST is true, then the bg worker will raise on exceptions
+    new_config = config.copy()
+    new_config["IN_TEST"] = False
+
+    with patch("couchers.email._queue_email") as mock, patch("couchers.jobs.worker.config", new_config):
+        # all four jobs go in one run
+        assert process_job()
+        assert mock.call_count == 1
+        assert mock.call_args.kwargs["recipient"] == user1.email
+
+    with session_scope() as session:
+        states = (
+            session.execute(
+                select(BackgroundJob.state)
+                .where(BackgroundJob.job_type == "handle_notification")
+                .order_by(BackgroundJob.id)
+            )
+            .scalars()
+            .all()
+        )
+        assert states == [BackgroundJobState.completed] * 3 + [BackgroundJobState.error]
+
+        deliveries = session.execute(
+            select(
+                Notification.user_id, NotificationDelivery.delivery_type, NotificationDelivery.delivered != None
+            ).join(NotificationDelivery, NotificationDelivery.notification_id == Notification.id)
+        ).all()
+        assert len(deliveries) == 6
+        assert {tuple(delivery) for delivery in deliveries} == {
+            (user1.id, NotificationDeliveryType.email, True),
+            (user1.id, NotificationDeliveryType.push, True),
+            (user1.id, NotificationDeliveryType.digest, False),
+            (user2.id, NotificationDeliveryType.push, True),
+            (user3.id, NotificationDeliveryType.push, True),
+            (user3.id, NotificationDeliveryType.digest, False),
+        }
+
+    for user in [user1, user2, user3]:
+        push_collector.assert_user_has_single_matching(
+            user.id, title="The Active Volunteer badge was added to your profile"
+        )
+
+
+def test_email_digests(db, push_collector, monkeypatch):
+    # due a digest
+    user1, token1 = generate_user()
+    # doesn't want digests
+    user2, token2 = generate_user()
+    # already got an email about their only notification, so there's nothing new for a digest
+    user3, token3 = generate_user()
+    # also due, marked sent in a separate chunk to user1
+    user4, token4 = generate_user()
+
+    with session_scope() as session:
+        for user in [user1, user3, user4]:
+            session.execute(select(User).where(User.id == user.id)).scalar_one().digest_frequency = timedelta(days=1)
+        set_preference(session, user3.id, NotificationTopicAction.badge__add, NotificationDeliveryType.email, True)
+
+    def notify_badge(users):
+        with session_scope() as session:
+            notify_many(
+                session,
+                recipients=[
+                    (
+                        user.id,
+                        notification_data_pb2.BadgeAdd(
+                            badge_id="volunteer",
+                            badge_name="Active Volunteer",
+                            badge_description="This user is an active volunteer for Couchers.org",
+                        ),
+                    )
+                    for user in users
+                ],
+                topic_action="badge:add",
+            )
+
+    notify_badge([user1, user2, user3, user4])
+    notify_badge([user1])
+    with patch("couchers.email._queue_email"):
+        process_jobs()
+
+    monkeypatch.setattr(couchers.notifications.background, "EMAIL_DIGEST_CHUNK_SIZE", 1)
+    handle_email_digests(empty_pb2.Empty())
+
+    def digests(user):
+        with session_scope() as session:
+            return (
+                session.execute(
+                    select(NotificationDelivery.delivered != None)
+                    .join(Notification, Notification.id == NotificationDelivery.notification_id)
+                    .where(Notification.user_id == user.id)
+                    .where(NotificationDelivery.delivery_type == NotificationDeliveryType.digest)
+                )
+                .scalars()
+                .all()
+            )
+
+    def last_digest_sent(user):
+        with session_scope() as session:
+            return session.execute(select(User.last_digest_sent).where(User.id == user.id)).scalar_one()
+
+    assert digests(user1) == [True, True]
+    assert digests(user2) == [False]
+    assert digests(user3) == [False]
+    assert digests(user4) == [True]
+    assert last_digest_sent(user1) > now() - timedelta(minutes=1)
+    assert last_digest_sent(user2) < now() - timedelta(days=1)
+    assert last_digest_sent(user3) < now() - timedelta(days=1)
+    assert last_digest_sent(user4) > now() - timedelta(minutes=1)
+
+
 def test_list_notifications(db, push_collector):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
@@ -419,6 +612,73 @@ def test_GetVapidPublicKey(db):
         )
 
 
+def test_notification_preference_cache(db):
+    user, _ = generate_user()
+    topic_action = NotificationTopicAction.badge__add
+
+    with session_scope() as session:
+        preferences = get_preferences(session, user.id)
+        assert preferences[topic_action] == [dt for dt in NotificationDeliveryType if dt in topic_action.defaults]
+        # one query for all of them, then cached
+        assert get_preferences(session, user.id) is preferences
+
+    with session_scope() as session:
+        set_preference(session, user.id, topic_action, NotificationDeliveryType.push, False)
+        # seen straight away in the same transaction
+        assert NotificationDeliveryType.push not in get_preference(session, user.id, topic_action)
+
+    with session_scope() as session:
+        # and the cache is invalidated once it commits
+        assert NotificationDeliveryType.push not in get_preference(session, user.id, topic_action)
+        assert (
+            get_preference(session, user.id, NotificationTopicAction.badge__remove)
+            == preferences[NotificationTopicAction.badge__remove]
+        )
+
+    with session_scope() as session:
+        set_preference(session, user.id, topic_action, NotificationDeliveryType.push, True)
+        session.rollback()
+
+    with session_scope() as session:
+        assert NotificationDeliveryType.push not in get_preference(session, user.id, topic_action)
+
+
+def test_vapid_authorization_cache():
+    vapid_private_key, _ = gen_vapid_keys()
+
+    def authorization(endpoint):
+        return generate_vapid_authorization(endpoint, "mailto:testing@couchers.org.invalid", vapid_private_key)
+
+    first = authorization("https://push.example.invalid/sub/1")
+    # signed once per push service, not per subscription
+    assert authorization("https://push.example.invalid/sub/2") == first
+    assert authorization("https://other-push.example.invalid/sub/1") != first
+
+    # and signed again once it's about to expire
+    later = time() + PUSH_VAPID_EXPIRY.total_seconds() - PUSH_VAPID_REFRESH_MARGIN.total_seconds() + 1
+    with patch("couchers.notifications.push_api.time", return_value=later):
+        assert authorization("https://push.example.invalid/sub/1") != first
+
+
+def test_send_pushes():
+    def send_push(data, endpoint, **kwargs):
+        if endpoint.endswith("/broken"):
+            raise ConnectionError()
+        return endpoint
+
+    pushes = [
+        dict(data=b"data", endpoint=f"https://push.example.invalid/{path}", auth_key=b"", receiver_key=b"")
+        for path in ["1", "broken", "3"]
+    ]
+    with patch("couchers.notifications.push_api.send_push", send_push):
+        results = send_pushes(pushes)
+
+    # results come back in order, with exceptions in place of failed pushes
+    assert results[0] == "https://push.example.invalid/1"
+    assert isinstance(results[1], ConnectionError)
+    assert results[2] == "https://push.example.invalid/3"
+
+
 def test_RegisterPushNotificationSubscription(db):
     _, token = generate_user()
 
@@ -2,12 +2,15 @@ from datetime import timedelta
 
 import grpc
 import pytest
-from sqlalchemy.sql import select
+from google.protobuf import empty_pb2
+from sqlalchemy.sql import delete, select, update
 
 from couchers import errors
+from couchers.constants import UNANSWERED_RESPONSE_TIME, USER_RESPONSE_TIMES_SKETCH_SIZE
 from couchers.db import session_scope
-from couchers.materialized_views import refresh_materialized_view
-from couchers.models import Message, MessageType
+from couchers.materialized_views import check_user_response_rates
+from couchers.models import Message, MessageType, UserResponseRate
+from couchers.response_rates import add_to_sketch, sketch_percentile
 from couchers.templates.v2 import v2date
 from couchers.utils import now, today
 from proto import api_pb2, conversations_pb2, requests_pb2
@@ -806,9 +809,6 @@ def test_response_rate(db):
     today_plus_2 = (today() + timedelta(days=2)).isoformat()
     today_plus_3 = (today() + timedelta(days=3)).isoformat()
 
-    with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
-
     with requests_session(token1) as api:
         # deleted: not found
         with pytest.raises(grpc.RpcError) as e:
@@ -832,7 +832,6 @@ def test_response_rate(db):
                 .where(Message.conversation_id == host_request_1)
                 .where(Message.message_type == MessageType.chat_created)
             ).scalar_one().time = now() - timedelta(hours=36)
-            refresh_materialized_view(session, "user_response_rates")
 
         # still insufficient
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -850,7 +849,6 @@ def test_response_rate(db):
                 .where(Message.conversation_id == host_request_2)
                 .where(Message.message_type == MessageType.chat_created)
             ).scalar_one().time = now() - timedelta(hours=35)
-            refresh_materialized_view(session, "user_response_rates")
 
         # still insufficient
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -868,7 +866,6 @@ def test_response_rate(db):
                 .where(Message.conversation_id == host_request_3)
                 .where(Message.message_type == MessageType.chat_created)
             ).scalar_one().time = now() - timedelta(hours=34)
-            refresh_materialized_view(session, "user_response_rates")
 
         # now low
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -884,9 +881,6 @@ def test_response_rate(db):
             )
         )
 
-    with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
-
     with requests_session(token1) as api:
         # now some w p33 = 35h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -903,9 +897,6 @@ def test_response_rate(db):
             )
         )
 
-    with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
-
     with requests_session(token1) as api:
         # now most w p33 = 34h, p66 = 35h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -923,9 +914,6 @@ def test_response_rate(db):
             )
         )
 
-    with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
-
     with requests_session(token1) as api:
         # now all w p33 = 34h, p66 = 35h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -945,7 +933,6 @@ def test_response_rate(db):
                 .where(Message.conversation_id == host_request_4)
                 .where(Message.message_type == MessageType.chat_created)
             ).scalar_one().time = now() - timedelta(hours=2)
-            refresh_materialized_view(session, "user_response_rates")
 
         # send a request and back date it by 4 hours
         host_request_5 = api.CreateHostRequest(
@@ -959,7 +946,6 @@ def test_response_rate(db):
                 .where(Message.conversation_id == host_request_5)
                 .where(Message.message_type == MessageType.chat_created)
             ).scalar_one().time = now() - timedelta(hours=4)
-            refresh_materialized_view(session, "user_response_rates")
 
         # now some w p33 = 35h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -976,9 +962,6 @@ def test_response_rate(db):
             )
         )
 
-    with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
-
     with requests_session(token1) as api:
         # now most w p33 = 34h, p66 = 36h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
@@ -996,17 +979,69 @@ def test_response_rate(db):
             )
         )
 
+    with requests_session(token1) as api:
+        # now most w p33 = 4h, p66 = 35h
+        res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
+        assert res.HasField("almost_all")
+        assert res.almost_all.response_time_p33.ToTimedelta() == timedelta(hours=4)
+        assert res.almost_all.response_time_p66.ToTimedelta() == timedelta(hours=35)
+
+    # the drift check puts back rows that went missing, and recomputes wrong ones
     with session_scope() as session:
-        refresh_materialized_view(session, "user_response_rates")
+        expected = session.execute(
+            select(
+                UserResponseRate.requests, UserResponseRate.response_time_33p, UserResponseRate.response_time_66p
+            ).where(UserResponseRate.user_id == user2.id)
+        ).one()
+        session.execute(delete(UserResponseRate))
+
+    check_user_response_rates(empty_pb2.Empty())
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(
+                    UserResponseRate.requests, UserResponseRate.response_time_33p, UserResponseRate.response_time_66p
+                ).where(UserResponseRate.user_id == user2.id)
+            ).one()
+            == expected
+        )
+        session.execute(update(UserResponseRate).values(requests=1))
+
+    check_user_response_rates(empty_pb2.Empty())
 
     with requests_session(token1) as api:
-        # now most w p33 = 4h, p66 = 35h
         res = api.GetResponseRate(requests_pb2.GetResponseRateReq(user_id=user2.id))
         assert res.HasField("almost_all")
         assert res.almost_all.response_time_p33.ToTimedelta() == timedelta(hours=4)
         assert res.almost_all.response_time_p66.ToTimedelta() == timedelta(hours=35)
 
 
+def test_response_time_sketch():
+    # like percentile_disc while it holds every response time
+    response_times = [5.0, 1.0, 3.0, 3.0, 8.0]
+    sketch, counts = [], []
+    for response_time in response_times:
+        sketch, counts = add_to_sketch(sketch, counts, response_time)
+    assert sketch == [1.0, 3.0, 5.0, 8.0]
+    assert counts == [1, 2, 1, 1]
+    assert sketch_percentile(sketch, counts, 5, 0.33) == timedelta(seconds=3)
+    assert sketch_percentile(sketch, counts, 5, 0.66) == timedelta(seconds=5)
+    # unanswered requests count as taking forever
+    assert sketch_percentile(sketch, counts, 9, 0.33) == timedelta(seconds=3)
+    assert sketch_percentile(sketch, counts, 9, 0.66) == UNANSWERED_RESPONSE_TIME
+
+    # past the size limit the closest response times get merged, but nothing is lost
+    sketch, counts = [], []
+    for i in range(USER_RESPONSE_TIMES_SKETCH_SIZE):
+        sketch, counts = add_to_sketch(sketch, counts, 10.0 * i)
+    sketch, counts = add_to_sketch(sketch, counts, 11.0)
+    assert len(sketch) == USER_RESPONSE_TIMES_SKETCH_SIZE
+    assert sum(counts) == USER_RESPONSE_TIMES_SKETCH_SIZE + 1
+    assert sketch[:3] == [0.0, 10.5, 20.0]
+    assert counts[:3] == [1, 2, 1]
+
+
 def test_request_notifications(db, push_collector):
     host, host_token = generate_user(complete_profile=True)
     surfer, surfer_token = generate_user(complete_profile=True)
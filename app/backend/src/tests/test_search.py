@@ -1,10 +1,16 @@
 from datetime import timedelta
 
+import grpc
 import pytest
 from google.protobuf import wrappers_pb2
+from psycopg2.extras import DateTimeTZRange
 
+import couchers.sql
+from couchers import errors
+from couchers.crypto import encrypt_page_token
 from couchers.db import session_scope
-from couchers.models import EventOccurrence, HostingStatus, LanguageAbility, LanguageFluency, MeetupStatus
+from couchers.models import EventOccurrence, HostingStatus, LanguageAbility, LanguageFluency, MeetupStatus, User
+from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime, create_coordinate, millis_from_dt, now
 from proto import api_pb2, communities_pb2, events_pb2, search_pb2
 from tests.test_communities import create_community, testing_communities  # noqa
@@ -283,6 +289,73 @@ def test_user_search_exactly_user_ids(db):
         assert [result.user.user_id for result in res.results] == [user1.id]
 
 
+def test_user_search_query(db):
+    user, token = generate_user()
+    user1, _ = generate_user(name="Frida Kahlo")
+    user2, _ = generate_user(hometown="Coyoacán")
+    user3, _ = generate_user(additional_information="I can cook a mean mole")
+    user4, _ = generate_user(name="Diego", city="Mexico", hometown="City")
+
+    def search(query, name_only=False):
+        with search_session(token) as api:
+            res = api.UserSearch(
+                search_pb2.UserSearchReq(query=wrappers_pb2.StringValue(value=query), query_name_only=name_only)
+            )
+        return sorted(result.user.user_id for result in res.results)
+
+    assert search("kahlo") == [user1.id]
+    assert search("coyoac") == [user2.id]
+    assert search("mean mole") == [user3.id]
+    assert search("mole", name_only=True) == []
+    assert search("diego", name_only=True) == [user4.id]
+    # matches can't span two fields
+    assert search("Mexico") == [user4.id]
+    assert search("Mexico City") == []
+    assert search("Testing city") == sorted([user.id, user1.id, user2.id, user3.id])
+
+
+def test_user_search_pagination(db):
+    user, token = generate_user()
+    others = [generate_user()[0] for _ in range(7)]
+
+    # lots of ties in recommendation score
+    scores = dict(zip([user.id] + [other.id for other in others], [0, 1, 1, 1, 2, 0, 1, 1]))
+    with session_scope() as session:
+        for db_user in session.execute(select(User).where(User.id.in_(scores.keys()))).scalars():
+            db_user.recommendation_score = scores[db_user.id]
+
+    seen = []
+    page_token = ""
+    with search_session(token) as api:
+        while True:
+            res = api.UserSearch(search_pb2.UserSearchReq(page_size=3, page_token=page_token))
+            assert res.total_items == len(scores)
+            seen += [result.user.user_id for result in res.results]
+            page_token = res.next_page_token
+            if not page_token:
+                break
+
+    assert sorted(seen) == sorted(scores.keys())
+    assert seen == sorted(scores.keys(), key=lambda user_id: (scores[user_id], user_id), reverse=True)
+
+
+def test_search_invalid_page_token(db):
+    user, token = generate_user()
+
+    with search_session(token) as api:
+        # a UserSearch page token from before they held the user id too
+        with pytest.raises(grpc.RpcError) as e:
+            api.UserSearch(search_pb2.UserSearchReq(page_token=encrypt_page_token("12.5")))
+        assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+        assert e.value.details() == errors.INVALID_PAGE_TOKEN
+
+        # an EventSearch page token from before they were encrypted
+        with pytest.raises(grpc.RpcError) as e:
+            api.EventSearch(search_pb2.EventSearchReq(page_token=str(millis_from_dt(now()))))
+        assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+        assert e.value.details() == errors.INVALID_PAGE_TOKEN
+
+
 @pytest.fixture
 def sample_event_data() -> dict:
     """Dummy data for creating events."""
@@ -469,25 +542,34 @@ def test_event_search_pagination(sample_community, create_event):
         res = api.EventSearch(search_pb2.EventSearchReq(past=False, page_size=4))
         assert len(res.events) == 4
         assert [event.title for event in res.events] == ["Event 1", "Event 2", "Event 3", "Event 4"]
-        assert res.next_page_token == str(millis_from_dt(anchor_time + timedelta(hours=5, minutes=30)))
+        assert res.next_page_token
+        assert res.total_items == 5
 
         res = api.EventSearch(search_pb2.EventSearchReq(page_size=4, page_token=res.next_page_token))
         assert len(res.events) == 1
         assert res.events[0].title == "Event 5"
         assert res.next_page_token == ""
 
-        res = api.EventSearch(
-            search_pb2.EventSearchReq(
-                past=True, page_size=2, page_token=str(millis_from_dt(anchor_time + timedelta(hours=4, minutes=30)))
+    # move them all into the past
+    with session_scope() as session:
+        for occurrence in session.execute(select(EventOccurrence)).scalars():
+            occurrence.during = DateTimeTZRange(
+                occurrence.start_time - timedelta(hours=10), occurrence.end_time - timedelta(hours=10)
             )
-        )
+
+    with search_session(token) as api:
+        res = api.EventSearch(search_pb2.EventSearchReq(past=True, page_size=2))
         assert len(res.events) == 2
-        assert [event.title for event in res.events] == ["Event 4", "Event 3"]
-        assert res.next_page_token == str(millis_from_dt(anchor_time + timedelta(hours=2, minutes=30)))
+        assert [event.title for event in res.events] == ["Event 5", "Event 4"]
+        assert res.next_page_token
 
         res = api.EventSearch(search_pb2.EventSearchReq(past=True, page_size=2, page_token=res.next_page_token))
         assert len(res.events) == 2
-        assert [event.title for event in res.events] == ["Event 2", "Event 1"]
+        assert [event.title for event in res.events] == ["Event 3", "Event 2"]
+        assert res.next_page_token
+
+        res = api.EventSearch(search_pb2.EventSearchReq(past=True, page_size=2, page_token=res.next_page_token))
+        assert [event.title for event in res.events] == ["Event 1"]
         assert res.next_page_token == ""
 
 
@@ -533,6 +615,41 @@ def test_event_search_pagination_with_page_number(sample_community, create_event
         assert not res.events
         assert res.total_items == 5
 
+        # the page token is ignored when asking for a numbered page
+        page_token = api.EventSearch(search_pb2.EventSearchReq(page_size=2)).next_page_token
+        res = api.EventSearch(search_pb2.EventSearchReq(page_size=2, page_number=2, page_token=page_token))
+        assert [event.title for event in res.events] == ["Event 3", "Event 4"]
+
+
+def test_event_search_count_cached(sample_community, create_event, monkeypatch):
+    user, token = generate_user()
+
+    anchor_time = now()
+    with events_session(token) as api:
+        for i in range(3):
+            create_event(
+                api,
+                title=f"Event {i + 1}",
+                start_time=Timestamp_from_datetime(anchor_time + timedelta(hours=i + 1)),
+                end_time=Timestamp_from_datetime(anchor_time + timedelta(hours=i + 1, minutes=30)),
+            )
+
+    # counts above the limit are estimated and cached
+    monkeypatch.setattr(couchers.sql, "APPROXIMATE_COUNT_EXACT_LIMIT", 1)
+    monkeypatch.setattr(couchers.sql, "_approximate_counts", {})
+
+    with search_session(token) as api:
+        api.EventSearch(search_pb2.EventSearchReq(page_size=2))
+        assert len(couchers.sql._approximate_counts) == 1
+        (key,) = couchers.sql._approximate_counts
+        expires_at, _ = couchers.sql._approximate_counts[key]
+        couchers.sql._approximate_counts[key] = (expires_at, 12345)
+
+        # a moment later, the same search hits the cache
+        res = api.EventSearch(search_pb2.EventSearchReq(page_size=2))
+        assert res.total_items == 12345
+        assert len(couchers.sql._approximate_counts) == 1
+
 
 def test_event_search_online_status(sample_community, create_event):
     """Test that EventSearch respects only_online and only_offline filters and by default returns both."""